@@ -0,0 +1,134 @@
+'''
+/batch mode benchmark.
+Runs the bot application from src/chatbot.py against local mock Telegram Bot API and OpenAI servers, with the OpenAI
+token rate limit enforced by the mock and paced by the bot: one user forwards --documents documents and --voice voice
+notes to be summarized, one after the other, while --users other users chat, each sending --messages text messages
+and waiting for each reply. Once with the forwarded messages answered at once (as before), and once in batch mode
+(/batch on), where they are summarized through the mock Batch API, which completes a batch after --batch-latency seconds.
+
+Reports the reply latency of the chatting users, the chat completions sent to the interactive endpoint and as batch
+requests, the estimated cost from model_prices (batch requests at the Batch API discount), and the time until the
+forwarding user had all the summaries.
+
+Usage:
+python benchmarks/bench_batch.py [--documents 20] [--voice 5] [--users 10] [--messages 5] [--tokens-per-minute 60000]
+'''
+
+import argparse, asyncio, json, logging, os, sys, tempfile, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'src'))
+
+from telegram import Update
+import chatbot, metrics
+from conversation import count_message_tokens, get_token_counter
+from model_router import get_model_price
+from mock_servers import MockOpenAIServer, MockTelegramServer
+from bench_utils import make_update, percentile
+
+
+reply = 'This is a mock reply standing in for an answer or a summary, with a few sentences like a typical one.'
+texts = ['What is the capital of Peru?', 'Explain how a hash map works', 'Write a haiku about autumn', 'How far is the moon?']
+bulk_user_id = 999
+
+
+def estimate_cost(request:dict, price_factor:float=1) -> float:
+    model = request['model']
+    price = get_model_price(model, chatbot.model_prices)
+    prompt_tokens = sum(count_message_tokens(message, model) for message in request['messages'])
+    return (prompt_tokens*price[0]+get_token_counter(model)(reply)*price[1])*price_factor/1e6
+
+async def run(telegram:MockTelegramServer, openai_server:MockOpenAIServer, batch_mode:bool, args, files_dir:str) -> dict:
+    loop = asyncio.get_running_loop()
+    messages = {}  # chat ID -> queue of the (time, text) of the messages sent to it
+    telegram.on_call = lambda call: loop.call_soon_threadsafe(messages.setdefault(int(call['params']['chat_id']), asyncio.Queue()).put_nowait, (call['time'], call['params'].get('text', ''))) \
+        if call['method'] == 'sendMessage' else None
+    requests = []
+    openai_server.on_request = requests.append
+    application = chatbot.build_application('123456:mock', 'mock', telegram_base_url=telegram.address, openai_base_url=openai_server.base_url,
+                                            conversation_store_path=os.path.join(files_dir, 'conversations.sqlite'), batch_store_path=os.path.join(files_dir, 'batch_jobs.sqlite'))
+    await application.initialize()
+    await application.post_init(application)
+    await application.start()
+    update_ids = iter(range(1, 10**6))
+    get_messages = lambda chat_id: messages.setdefault(chat_id, asyncio.Queue())
+    latencies = []
+
+    async def chat(user_id:int):
+        for i in range(args.messages):
+            update = make_update(next(update_ids), user_id, text=texts[(user_id+i) % len(texts)])
+            t0 = time.perf_counter()
+            await application.update_queue.put(Update.de_json(update, application.bot))
+            await get_messages(user_id).get()
+            latencies.append(time.perf_counter()-t0)
+            await asyncio.sleep(0.2)
+
+    async def forward():
+        if batch_mode:
+            update = make_update(next(update_ids), bulk_user_id, text='/batch on', entities=[{'type': 'bot_command', 'offset': 0, 'length': 6}])
+            await application.update_queue.put(Update.de_json(update, application.bot))
+            await get_messages(bulk_user_id).get()
+        for i in range(args.documents+args.voice):
+            if i < args.documents:
+                update = make_update(next(update_ids), bulk_user_id, document={'file_id': f'report-{i}', 'file_unique_id': f'report-{i}', 'file_name': f'report-{i}.txt', 'mime_type': 'text/plain'})
+            else:
+                update = make_update(next(update_ids), bulk_user_id, voice={'file_id': 'voice', 'file_unique_id': 'voice', 'duration': 30, 'mime_type': 'audio/ogg'})
+            await application.update_queue.put(Update.de_json(update, application.bot))
+            # the next one is forwarded once this one is answered or queued; a voice note's transcript comes first
+            for _ in range(1 if i < args.documents else 2):
+                await get_messages(bulk_user_id).get()
+
+    t0 = time.perf_counter()
+    await asyncio.gather(forward(), *(chat(1000+i) for i in range(args.users)))
+    forwarded = time.perf_counter()-t0
+    n_results = 0
+    while batch_mode and n_results < args.documents+args.voice and time.perf_counter()-t0 < args.timeout:
+        _, text = await get_messages(bulk_user_id).get()
+        n_results += text.startswith(('report-', 'Voice note'))
+    bulk_done = time.perf_counter()-t0
+    await application.stop()
+    await application.post_stop(application)
+    await application.shutdown()
+    await application.post_shutdown(application)
+
+    batch_requests = [json.loads(line)['body'] for _, purpose, content in openai_server.files.values() if purpose == 'batch' for line in content.decode('utf-8').splitlines()]
+    return {'p50': percentile(latencies, 50), 'p95': percentile(latencies, 95), 'completions': len(requests), 'batch requests': len(batch_requests),
+            'cost': sum(estimate_cost(request) for request in requests)+sum(estimate_cost(request, 1-chatbot.batch_price_discount) for request in batch_requests),
+            'forwarded': forwarded, 'bulk done': bulk_done, 'rate limited': openai_server.requests_rate_limited}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--documents', type=int, default=20, help='documents forwarded to be summarized')
+    parser.add_argument('--voice', type=int, default=5, help='voice notes forwarded to be summarized')
+    parser.add_argument('--users', type=int, default=10, help='users chatting meanwhile')
+    parser.add_argument('--messages', type=int, default=5, help='text messages sent by each chatting user')
+    parser.add_argument('--document-lines', type=int, default=150, help='lines of each document, about 20 tokens each')
+    parser.add_argument('--tokens-per-minute', type=int, default=60000, help='token rate limit of each model, enforced by the mock and paced by the bot')
+    parser.add_argument('--openai-latency', type=float, default=0.3, help='seconds before the mock OpenAI server answers')
+    parser.add_argument('--batch-latency', type=float, default=5, help='seconds until the mock Batch API completes a batch')
+    parser.add_argument('--timeout', type=float, default=120, help='max seconds to wait for the batch results')
+    args = parser.parse_args()
+
+    models = set(chatbot.model_routes.values())
+    chatbot.openai_requests_per_minute = {}
+    chatbot.openai_tokens_per_minute = {model: args.tokens_per_minute for model in models}
+    chatbot.stream_responses = False
+    chatbot.metrics_port = None
+    chatbot.batch_submit_delay, chatbot.batch_poll_interval = 1, 0.5
+    metrics.logger.setLevel(logging.ERROR)
+
+    print(f'{args.documents} documents and {args.voice} voice notes forwarded while {args.users} users send {args.messages} messages each; '
+          f'{args.tokens_per_minute} tokens per minute per model')
+    print(f'{"method":>11} {"chat p50 s":>11} {"chat p95 s":>11} {"completions":>12} {"batch reqs":>11} {"429s":>5} {"cost USD":>9} {"forwarded s":>12} {"summaries s":>12}')
+    for batch_mode in (False, True):
+        with MockOpenAIServer(latency=args.openai_latency, token_delay=0.005, reply=reply, tokens_per_minute=args.tokens_per_minute, batch_latency=args.batch_latency) as openai_server, \
+                MockTelegramServer(latency=0.005) as telegram, tempfile.TemporaryDirectory() as tmp:
+            for i in range(args.documents):
+                telegram.files[f'report-{i}'] = '\n'.join(f'{j}. Report {i}: a line about the quarter, the revenue, the costs and the outlook.' for j in range(args.document_lines)).encode('utf-8')
+            telegram.files['voice'] = os.urandom(64*1024)
+            result = asyncio.run(run(telegram, openai_server, batch_mode, args, tmp))
+        print(f'{"/batch on" if batch_mode else "at once":>11} {result["p50"]:>11.2f} {result["p95"]:>11.2f} {result["completions"]:>12} {result["batch requests"]:>11} '
+              f'{result["rate limited"]:>5} {result["cost"]:>9.4f} {result["forwarded"]:>12.1f} {result["bulk done"]:>12.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+'''
+Message burst benchmark.
+Runs the bot application from src/chatbot.py against local mock Telegram Bot API and OpenAI servers: --users users
+each send --bursts bursts of --burst-size text messages, like a thought typed across several quick messages,
+and wait --pause seconds between bursts. Once answering each message as it arrives (coalesce_window = None,
+cancel_superseded_replies = False, as before) and once coalescing each burst into one turn, for each of --gaps,
+the seconds between the messages of a burst: shorter gaps than coalesce_window are merged while waiting,
+longer ones cancel the reply being generated.
+
+Reports per burst: the completions requested, the prompt characters sent and the replies sent to the user,
+the completions cut off by a newer message, and the time from the last message of a burst until its reply was complete.
+
+Usage:
+python benchmarks/bench_coalescing.py [--users 10] [--bursts 3] [--burst-size 3] [--gaps 0.3 1.5] [--pause 5]
+'''
+
+import argparse, asyncio, json, logging, os, sys, tempfile, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'src'))
+
+from telegram import Update
+import chatbot, metrics
+from mock_servers import MockOpenAIServer, MockTelegramServer
+from bench_utils import make_update, percentile
+
+
+async def run_bursts(telegram:MockTelegramServer, openai_server:MockOpenAIServer, gap:float, args) -> dict:
+    loop = asyncio.get_running_loop()
+    requests, reply_times = [], {}
+    openai_server.on_request = requests.append
+    # the time of each chat's latest reply, complete once no more edits follow
+    telegram.on_call = lambda call: loop.call_soon_threadsafe(reply_times.__setitem__, int(call['params']['chat_id']), time.perf_counter()) \
+        if call['method'] in ('sendMessage', 'editMessageText') else None
+    with tempfile.TemporaryDirectory() as tmp:
+        application = chatbot.build_application('123456:mock', 'mock', telegram_base_url=telegram.address, openai_base_url=openai_server.base_url,
+                                                conversation_store_path=os.path.join(tmp, 'conversations.sqlite'), batch_store_path=os.path.join(tmp, 'batch_jobs.sqlite'))
+        await application.initialize()
+        await application.post_init(application)
+        await application.start()
+        update_ids = iter(range(1, 10**6))
+        latencies = []
+
+        async def user(user_id:int):
+            for burst in range(args.bursts):
+                for i in range(args.burst_size):
+                    if i > 0:
+                        await asyncio.sleep(gap)
+                    await application.update_queue.put(Update.de_json(make_update(next(update_ids), user_id, text=f'part {i+1} of question {burst+1}, with some detail'), application.bot))
+                last_message = time.perf_counter()
+                await asyncio.sleep(args.pause)
+                latencies.append(reply_times.get(user_id, last_message)-last_message)
+
+        n_messages = len(telegram.calls)
+        await asyncio.gather(*(user(1000+i) for i in range(args.users)))
+        replies = sum(1 for call in telegram.calls[n_messages:] if call['method'] == 'sendMessage')
+        await application.stop()
+        await application.post_stop(application)
+        await application.shutdown()
+        await application.post_shutdown(application)
+    n_bursts = args.users*args.bursts
+    return {'completions': len(requests)/n_bursts, 'prompt chars': sum(len(json.dumps(request['messages'])) for request in requests)/n_bursts,
+            'replies': replies/n_bursts, 'cut off': openai_server.requests_disconnected/n_bursts, 'p50': percentile(latencies, 50), 'p95': percentile(latencies, 95)}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=10, help='concurrent users')
+    parser.add_argument('--bursts', type=int, default=3, help='bursts sent by each user')
+    parser.add_argument('--burst-size', type=int, default=3, help='messages in each burst')
+    parser.add_argument('--gaps', type=float, nargs='+', default=[0.3, 1.5], help='seconds between the messages of a burst, one run each')
+    parser.add_argument('--pause', type=float, default=5, help='seconds between bursts, for the replies to complete')
+    parser.add_argument('--openai-latency', type=float, default=0.3, help='seconds before the mock OpenAI server answers')
+    parser.add_argument('--token-delay', type=float, default=0.01, help='seconds between streamed tokens')
+    args = parser.parse_args()
+
+    chatbot.openai_requests_per_minute, chatbot.openai_tokens_per_minute = {}, {}
+    chatbot.metrics_port = None
+    metrics.logger.setLevel(logging.ERROR)
+    reply = ' '.join(['This is a longer mock reply, as a model would write.']*10)
+    coalesce_window = chatbot.coalesce_window
+    print(f'{args.users} users x {args.bursts} bursts of {args.burst_size} messages, coalesce_window {coalesce_window} s; per burst:')
+    print(f'{"gap s":>6} {"method":>7} {"completions":>12} {"prompt chars":>13} {"replies":>8} {"cut off":>8} {"reply p50 s":>12} {"reply p95 s":>12}')
+    for gap in args.gaps:
+        for method in ('before', 'after'):
+            chatbot.coalesce_window, chatbot.cancel_superseded_replies = (None, False) if method == 'before' else (coalesce_window, True)
+            with MockOpenAIServer(latency=args.openai_latency, token_delay=args.token_delay, reply=reply) as openai_server, MockTelegramServer(latency=0.005) as telegram:
+                result = asyncio.run(run_bursts(telegram, openai_server, gap, args))
+            print(f'{gap:>6} {method:>7} {result["completions"]:>12.2f} {result["prompt chars"]:>13.0f} {result["replies"]:>8.2f} {result["cut off"]:>8.2f} {result["p50"]:>12.3f} {result["p95"]:>12.3f}')
+
+
+if __name__ == '__main__':
+    main()
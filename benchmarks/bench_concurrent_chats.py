@@ -0,0 +1,76 @@
+'''
+Load benchmark for the OpenAI completion path.
+Simulates N chats that each send a few messages back to back, against a local mock OpenAI server with a fixed latency,
+and reports the completion throughput for an increasing number of concurrent chats.
+
+The 'blocking' mode reproduces the previous behaviour (a synchronous client called from inside the coroutine),
+which serializes all chats on the event loop and keeps throughput flat.
+The 'async' mode uses interact_with_gpt_model from src/chatbot.py with the async client and a shared rate limit governor
+that only bounds the requests in flight.
+
+Usage:
+python benchmarks/bench_concurrent_chats.py [--latency 0.2] [--messages 3] [--chats 1 2 4 8 16 32]
+'''
+
+import argparse, asyncio, os, sys, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'src'))
+
+import openai
+import chatbot
+from mock_servers import MockOpenAIServer
+from rate_limiter import RateLimitGovernor
+
+
+async def run_blocking(base_url:str, n_chats:int, n_messages:int) -> int:
+    client = openai.OpenAI(api_key='mock', base_url=base_url)
+
+    async def chat():
+        conversation = [{'role': 'system', 'content': 'mock'}]
+        for i in range(n_messages):
+            conversation.append({'role': 'user', 'content': f'message {i}'})
+            response = client.chat.completions.create(model=chatbot.default_gpt_model, messages=conversation, n=1, temperature=chatbot.temperature, stream=False)
+            conversation.append({'role': 'assistant', 'content': response.choices[0].message.content})
+
+    await asyncio.gather(*(chat() for _ in range(n_chats)))
+    return n_chats*n_messages
+
+async def run_async(base_url:str, n_chats:int, n_messages:int, max_in_flight:int) -> int:
+    client = openai.AsyncOpenAI(api_key='mock', base_url=base_url)
+    governor = RateLimitGovernor(max_in_flight=max_in_flight)
+
+    async def chat():
+        conversation = [{'role': 'system', 'content': 'mock'}]
+        for i in range(n_messages):
+            conversation.append({'role': 'user', 'content': f'message {i}'})
+            response = await chatbot.interact_with_gpt_model(client, conversation, temperature=chatbot.temperature, governor=governor)
+            conversation.append({'role': 'assistant', 'content': response})
+
+    await asyncio.gather(*(chat() for _ in range(n_chats)))
+    await client.close()
+    return n_chats*n_messages
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--latency', type=float, default=0.2, help='mock completion latency in seconds')
+    parser.add_argument('--messages', type=int, default=3, help='messages sent by each chat')
+    parser.add_argument('--chats', type=int, nargs='+', default=[1, 2, 4, 8, 16, 32], help='numbers of concurrent chats to test')
+    parser.add_argument('--max-in-flight', type=int, default=chatbot.max_concurrent_api_requests, help='max requests in flight for the async mode')
+    args = parser.parse_args()
+
+    with MockOpenAIServer(latency=args.latency) as server:
+        print(f'mock OpenAI server at {server.base_url}, latency {args.latency}s, {args.messages} messages per chat')
+        print(f'{"chats":>6} {"mode":>9} {"requests":>9} {"seconds":>8} {"req/s":>8}')
+        for n_chats in args.chats:
+            for mode in ('blocking', 'async'):
+                t0 = time.perf_counter()
+                if mode == 'blocking':
+                    n_requests = asyncio.run(run_blocking(server.base_url, n_chats, args.messages))
+                else:
+                    n_requests = asyncio.run(run_async(server.base_url, n_chats, args.messages, args.max_in_flight))
+                elapsed = time.perf_counter()-t0
+                print(f'{n_chats:>6} {mode:>9} {n_requests:>9} {elapsed:>8.2f} {n_requests/elapsed:>8.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+'''
+Scaling benchmark for the conversation store.
+Fills an SQLite conversation store with a growing number of users, then measures the startup cost of opening it,
+the latency of lazily loading one user's history on their first message, and the resident memory after a burst of
+activity from many users, which should stay flat thanks to the LRU eviction of idle histories.
+
+Usage:
+python benchmarks/bench_conversation_store.py [--users 1000 10000 50000] [--turns 20] [--active 5000] [--max-cached 1000]
+'''
+
+import argparse, asyncio, gc, os, random, statistics, sys, tempfile, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'src'))
+
+from conversation import Conversation
+from conversation_store import SQLiteConversationStore, ConversationCache
+
+
+def current_rss_mb() -> float:
+    try:
+        with open('/proc/self/statm') as file:
+            return int(file.read().split()[1])*os.sysconf('SC_PAGE_SIZE')/2**20
+    except OSError:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024  # peak, not current, outside Linux
+
+def make_conversation(turns:int) -> dict:
+    conversation = Conversation({'role': 'system', 'content': 'You are a helpful assistant.'}, 'gpt-4o')
+    for i in range(turns):
+        conversation.append({'role': 'user', 'content': f'question {i}: '+'lorem ipsum dolor sit amet '*8})
+        conversation.append({'role': 'assistant', 'content': f'answer {i}: '+'consectetur adipiscing elit '*20})
+    return conversation.to_dict()
+
+def fill_store(filename:str, n_users:int, turns:int):
+    store = SQLiteConversationStore(filename)
+    data = make_conversation(turns)
+    batch = {}
+    for user_id in range(n_users):
+        batch[str(user_id)] = data
+        if len(batch) == 1000:
+            store.save_many(batch)
+            batch = {}
+    store.save_many(batch)
+    store.close()
+
+async def measure(filename:str, n_users:int, n_active:int, max_cached:int) -> dict:
+    t0 = time.perf_counter()
+    cache = ConversationCache(SQLiteConversationStore(filename), max_cached=max_cached, flush_interval=1)
+    cache.start()
+    startup = time.perf_counter()-t0
+    load_times = []
+    for user_id in random.sample(range(n_users), min(n_active, n_users)):
+        t0 = time.perf_counter()
+        conversation = await cache.get(str(user_id))
+        load_times.append(time.perf_counter()-t0)
+        conversation.append({'role': 'user', 'content': 'one more question'})
+        cache.mark_dirty(str(user_id), conversation)
+    t0 = time.perf_counter()
+    n_flushed = await cache.flush()
+    flush = time.perf_counter()-t0
+    gc.collect()
+    rss = current_rss_mb()
+    await cache.close()
+    return {'startup s': startup, 'first load ms': 1000*statistics.mean(load_times), 'flush s': flush, 'flushed': n_flushed, 'rss MB': rss}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, nargs='+', default=[1000, 10000, 50000], help='numbers of stored users to test')
+    parser.add_argument('--turns', type=int, default=20, help='conversation turns per stored user')
+    parser.add_argument('--active', type=int, default=5000, help='number of users sending a message after startup')
+    parser.add_argument('--max-cached', type=int, default=1000, help='max number of conversations kept in memory')
+    args = parser.parse_args()
+
+    print(f'{"users":>7} {"startup s":>10} {"first load ms":>14} {"flush s":>8} {"flushed":>8} {"rss MB":>8}')
+    with tempfile.TemporaryDirectory() as workdir:
+        for n_users in args.users:
+            filename = os.path.join(workdir, f'conversations_{n_users}.sqlite')
+            fill_store(filename, n_users, args.turns)
+            result = asyncio.run(measure(filename, n_users, args.active, args.max_cached))
+            print(f'{n_users:>7} {result["startup s"]:>10.4f} {result["first load ms"]:>14.3f} {result["flush s"]:>8.3f} {result["flushed"]:>8} {result["rss MB"]:>8.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+'''
+Reply delivery benchmark.
+Sends typical model replies (short answers, GPT-style Markdown with **bold**, # headings and snake_case words, replies
+over Telegram's 4096-character limit, code blocks, and a reply cut off inside a code block) to a local mock Telegram
+Bot API server, which rejects long and unparsable messages like Telegram does, once the way the bot sent them before
+(a single send_message in Markdown, the reply being lost when it raises) and once through delivery.MessageDelivery.
+Reports the replies delivered and lost, the messages sent and the Markdown fallbacks.
+
+Then a flood scenario: the mock limits each chat to --chat-rate messages per second, answering a 429 with a retry_after
+above it; one chat receives a burst of --burst replies while --chats other chats each receive one reply.
+Reports the replies lost to the 429s and the delivery latency of the other chats.
+
+Usage:
+python benchmarks/bench_delivery.py [--copies 20] [--burst 10] [--chats 20] [--chat-rate 1]
+'''
+
+import argparse, asyncio, logging, os, sys, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'src'))
+
+from telegram import Bot, error as telegram_error
+from telegram.request import HTTPXRequest
+import metrics
+from delivery import MessageDelivery
+from mock_servers import MockTelegramServer
+from bench_utils import percentile
+
+
+code = '\n'.join(f'    result_{i} = compute_value(item_{i}) * 2  # step {i}' for i in range(120))
+replies = {
+    'short answer': 'The capital of Peru is Lima.',
+    'GPT Markdown': '# Summary\n\n**Key points:**\n* use `asyncio.gather` for the requests\n* set max_retries in the client_config\n\nThat is 2*3 times faster.',
+    'long prose': '\n\n'.join(f'Paragraph {i}. ' + 'The meeting covered the roadmap, the budget and the hiring plan in some detail. '*12 for i in range(10)),
+    'long code': f'Here is the function:\n\n```python\ndef process(items):\n{code}\n    return result_0\n```\n\nIt runs in *linear* time.',
+    'cut-off code': 'Sure, here is the script:\n\n```python\nfor item in items:\n    print(item)',
+}
+burst_reply = 'Here is the next part of the story. '*20
+
+
+def make_bot(telegram:MockTelegramServer) -> Bot:
+    return Bot('123456:mock', base_url=telegram.address+'/bot', request=HTTPXRequest(connection_pool_size=64))
+
+async def send_before(bot:Bot, chat_id:int, text:str) -> bool:
+    # the send the handlers used to make: one message in Markdown, the reply being lost if it raises
+    try:
+        await bot.send_message(chat_id=chat_id, text=text, parse_mode='Markdown')
+        return True
+    except telegram_error.TelegramError:
+        return False
+
+async def send_after(delivery:MessageDelivery, chat_id:int, text:str) -> bool:
+    try:
+        await delivery.send(chat_id, text)
+        return True
+    except telegram_error.TelegramError:
+        return False
+
+async def run_replies(telegram:MockTelegramServer, copies:int) -> dict:
+    results = {}
+    async with make_bot(telegram) as bot:
+        delivery = MessageDelivery(bot)
+        for method in ('before', 'after'):
+            n_calls = len(telegram.calls)
+            fallbacks = metrics.telegram_markdown_fallbacks_total.value()
+            delivered = {}
+            for name, text in replies.items():
+                sends = [send_before(bot, 1000+i, text) if method == 'before' else send_after(delivery, 1000+i, text) for i in range(copies)]
+                delivered[name] = sum(await asyncio.gather(*sends))
+            results[method] = {'delivered': delivered, 'messages': len(telegram.calls)-n_calls,
+                               'fallbacks': metrics.telegram_markdown_fallbacks_total.value()-fallbacks}
+    return results
+
+async def run_flood(telegram:MockTelegramServer, method:str, n_burst:int, n_chats:int) -> dict:
+    async with make_bot(telegram) as bot:
+        delivery = MessageDelivery(bot)
+        send = (lambda chat_id, text: send_before(bot, chat_id, text)) if method == 'before' else (lambda chat_id, text: send_after(delivery, chat_id, text))
+        latencies = []
+
+        async def timed_send(chat_id:int, text:str):
+            await asyncio.sleep(0.05)  # the other replies arrive while the burst is being sent
+            t0 = time.perf_counter()
+            delivered = await send(chat_id, text)
+            latencies.append(time.perf_counter()-t0)
+            return delivered
+
+        burst = [send(1, burst_reply) for _ in range(n_burst)]
+        others = [timed_send(2000+i, replies['short answer']) for i in range(n_chats)]
+        t0 = time.perf_counter()
+        delivered = await asyncio.gather(*burst, *others)
+        elapsed = time.perf_counter()-t0
+    return {'burst delivered': sum(delivered[:n_burst]), 'others delivered': sum(delivered[n_burst:]),
+            'p50': percentile(latencies, 50), 'p95': percentile(latencies, 95), 'elapsed': elapsed}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--copies', type=int, default=20, help='chats receiving each reply')
+    parser.add_argument('--burst', type=int, default=10, help='replies sent to the flooded chat')
+    parser.add_argument('--chats', type=int, default=20, help='other chats receiving a reply during the burst')
+    parser.add_argument('--chat-rate', type=float, default=1, help='messages per chat and second the mock accepts in the flood scenario')
+    args = parser.parse_args()
+
+    metrics.logger.setLevel(logging.ERROR)  # the flood waits and fallbacks are counted rather than logged
+
+    with MockTelegramServer(latency=0.005) as telegram:
+        results = asyncio.run(run_replies(telegram, args.copies))
+    print(f'{args.copies} chats receiving each reply; replies delivered')
+    print(f'{"reply":>14} {"chars":>6} {"before":>7} {"after":>6}')
+    for name, text in replies.items():
+        print(f'{name:>14} {len(text):>6} {results["before"]["delivered"][name]:>7} {results["after"]["delivered"][name]:>6}')
+    for method, result in results.items():
+        print(f'{method}: {sum(result["delivered"].values())} of {args.copies*len(replies)} replies delivered in {result["messages"]} messages, {result["fallbacks"]:.0f} sent as plain text')
+
+    print(f'\nflood: {args.burst} replies to one chat while {args.chats} other chats get a reply, {args.chat_rate} messages per chat and second')
+    print(f'{"delivery":>9} {"burst delivered":>16} {"others delivered":>17} {"others p50 s":>13} {"others p95 s":>13} {"elapsed s":>10}')
+    for method in ('before', 'after'):
+        with MockTelegramServer(latency=0.005, chat_messages_per_second=args.chat_rate) as telegram:
+            result = asyncio.run(run_flood(telegram, method, args.burst, args.chats))
+        print(f'{method:>9} {result["burst delivered"]:>16} {result["others delivered"]:>17} {result["p50"]:>13.3f} {result["p95"]:>13.3f} {result["elapsed"]:>10.2f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+'''
+Document ingestion benchmark.
+Generates log files of increasing size, reads them with read_document from src/documents.py (encoding detection,
+block-wise decoding and chunking), indexes them in a DocumentIndex and asks about a line buried in the file.
+Reports the time to read, index and search each file, and the prompt tokens of the question with the chunks that
+are sent along, against the prompt tokens of the whole file, which is what the bot sent before.
+
+Usage:
+python benchmarks/bench_documents.py [--lines 1000 10000 100000 300000]
+'''
+
+import argparse, os, sys, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'src'))
+
+import chatbot
+from conversation import count_message_tokens
+from documents import DocumentIndex, read_document, format_excerpts
+
+
+def make_log(n_lines:int) -> bytes:
+    lines = [f'2024-05-01 12:{i//60%60:02d}:{i%60:02d} INFO worker-{i%7} processed job {i} in {i*37%1000}ms\n' for i in range(n_lines)]
+    lines[n_lines*2//3] = '2024-05-01 13:13:13 ERROR worker-3 lost the connection to replica-9: quota exceeded\n'
+    return ''.join(lines).encode('utf-8')
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--lines', type=int, nargs='+', default=[1000, 10000, 100000, 300000], help='numbers of log lines to test')
+    args = parser.parse_args()
+
+    model = chatbot.default_gpt_model
+    question = 'Why did worker-3 lose the connection to replica-9?'
+    print(f'{"lines":>8} {"MB":>6} {"read s":>7} {"index s":>8} {"search ms":>10} {"found":>6} {"whole-file prompt":>18} {"prompt":>7}')
+    for n_lines in args.lines:
+        file_bytes = make_log(n_lines)
+        t0 = time.perf_counter()
+        chunks, n_tokens, _ = read_document(file_bytes, model, chatbot.document_chunk_tokens)
+        t1 = time.perf_counter()
+        index = DocumentIndex(chatbot.max_document_chunks)
+        index.add_document('app.log', chunks)
+        t2 = time.perf_counter()
+        excerpts = format_excerpts(index.search(question, chatbot.document_context_tokens))
+        t3 = time.perf_counter()
+        question_tokens = count_message_tokens({'role': 'user', 'content': question}, model)
+        prompt_tokens = question_tokens+count_message_tokens({'role': 'system', 'content': excerpts}, model)
+        found = 'replica-9' in excerpts
+        print(f'{n_lines:>8} {len(file_bytes)/1e6:>6.1f} {t1-t0:>7.2f} {t2-t1:>8.2f} {(t3-t2)*1000:>10.1f} {str(found):>6} {question_tokens+n_tokens:>18} {prompt_tokens:>7}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+'''
+Photo lifecycle benchmark.
+Runs the real bot application from src/chatbot.py against local mock Telegram Bot API and OpenAI servers, for chats
+that send a photo and then text messages about it, some of which refer to the photo again, and records every request
+sent to the mock OpenAI server. Reports the photo bytes downloaded, and the vision tokens and request bytes sent with
+the chat turns, against what the previous lifecycle sent: the largest photo size at 'auto' detail, kept in the history
+and sent with every later turn (by URL, so the request bytes of that lifecycle are not comparable and not shown).
+
+Usage:
+python benchmarks/bench_images.py [--chats 20] [--turns 10] [--refer-every 4]
+'''
+
+import argparse, asyncio, json, os, sys, tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'src'))
+
+from telegram import Update
+import chatbot
+from conversation import image_tokens
+from mock_servers import MockOpenAIServer, MockTelegramServer
+from bench_utils import make_update
+
+
+photo_sizes = [(90, 67), (320, 240), (800, 600), (1280, 960), (2560, 1920)]  # the sizes Telegram sends of a 4:3 photo
+bytes_per_pixel = 0.15  # about the size of a Telegram JPEG
+
+
+async def run(n_chats:int, n_turns:int, refer_every:int, telegram:MockTelegramServer, openai_server:MockOpenAIServer, store_path:str) -> dict:
+    chat_requests = []
+    description_requests = []
+    # chat requests start with the system message, photo descriptions are a single user message (the chat requests' model depends on their route)
+    openai_server.on_request = lambda request: (chat_requests if request['messages'][0]['role'] == 'system' else description_requests).append(request)
+    downloaded = []
+    telegram.on_call = lambda call: downloaded.append(len(telegram.files[call['params']['file_id']])) if call['method'] == 'getFile' else None
+    application = chatbot.build_application('123456:mock', 'mock', telegram_base_url=telegram.address, openai_base_url=openai_server.base_url, conversation_store_path=store_path,
+                                            batch_store_path=os.path.join(os.path.dirname(store_path), 'batch_jobs.sqlite'))
+    await application.initialize()
+    await application.post_init(application)
+    await application.start()
+    update_id = 0
+    for turn in range(n_turns):
+        for chat in range(n_chats):
+            update_id += 1
+            user_id = 1000+chat
+            if turn == 0:
+                photo = [{'file_id': f'{user_id}-{w}', 'file_unique_id': f'{user_id}-{w}', 'width': w, 'height': h} for w, h in photo_sizes]
+                update = make_update(update_id, user_id, photo=photo, caption='What do you see here?')
+            elif turn % refer_every == 0:
+                update = make_update(update_id, user_id, text=f'Look at the photo again: what is in the background? ({turn})')
+            else:
+                update = make_update(update_id, user_id, text=f'Tell me more about that, part {turn}.')
+            await application.update_queue.put(Update.de_json(update, application.bot))
+        # wait for the replies and the background descriptions, like a user reading the reply before typing
+        while len(chat_requests) < n_chats*(turn+1) or application.bot_data['scheduler'].n_pending > 0:
+            await asyncio.sleep(0.05)
+        await asyncio.sleep(0.5)
+    await application.stop()
+    await application.post_stop(application)
+    await application.shutdown()
+    await application.post_shutdown(application)
+
+    vision_tokens = 0
+    request_bytes = 0
+    for request in chat_requests:
+        request_bytes += len(json.dumps(request))
+        for message in request['messages']:
+            if isinstance(message['content'], list):
+                vision_tokens += sum(image_tokens[part['image_url'].get('detail', 'auto')] for part in message['content'] if part['type'] == 'image_url')
+    return {'chat requests': len(chat_requests), 'description requests': len(description_requests), 'downloaded': sum(downloaded), 'vision tokens': vision_tokens, 'request bytes': request_bytes}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--chats', type=int, default=20, help='number of chats')
+    parser.add_argument('--turns', type=int, default=10, help='messages per chat, the first being the photo')
+    parser.add_argument('--refer-every', type=int, default=4, help='every n-th message refers to the photo again')
+    args = parser.parse_args()
+
+    chatbot.openai_requests_per_minute, chatbot.openai_tokens_per_minute = {}, {}
+    with MockOpenAIServer(latency=0.05, token_delay=0) as openai_server, MockTelegramServer(latency=0.005) as telegram, tempfile.TemporaryDirectory() as tmp:
+        for chat in range(args.chats):
+            for w, h in photo_sizes:
+                telegram.files[f'{1000+chat}-{w}'] = b'\xff\xd8'+os.urandom(int(w*h*bytes_per_pixel))
+        result = asyncio.run(run(args.chats, args.turns, args.refer_every, telegram, openai_server, os.path.join(tmp, 'conversations.sqlite')))
+
+    largest = photo_sizes[-1]
+    before_downloaded = args.chats*int(largest[0]*largest[1]*bytes_per_pixel)
+    before_vision_tokens = args.chats*args.turns*image_tokens['auto']
+    print(f'{args.chats} chats, a photo and {args.turns-1} text messages each, every {args.refer_every}th referring to the photo')
+    print(f'{"lifecycle":>10} {"photo MB downloaded":>20} {"vision tokens":>14} {"request MB":>11}')
+    print(f'{"before":>10} {before_downloaded/1e6:>20.2f} {before_vision_tokens:>14} {"-":>11}')
+    print(f'{"after":>10} {result["downloaded"]/1e6:>20.2f} {result["vision tokens"]:>14} {result["request bytes"]/1e6:>11.2f}')
+    print(f'plus {result["description requests"]} background description requests to {chatbot.summary_gpt_model}, one per photo')
+
+
+if __name__ == '__main__':
+    main()
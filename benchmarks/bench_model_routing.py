@@ -0,0 +1,135 @@
+'''
+Model routing replay benchmark.
+Runs the real bot application from src/chatbot.py against local mock Telegram Bot API and OpenAI servers, where the
+cheaper model answers faster, and replays the same chats under each routing policy:
+- 'fixed, no fallback': every request to default_gpt_model, as before the router
+- 'fixed': every request to default_gpt_model, switching to its fallback model when it fails
+- 'heuristic': each request to the model of its route in model_routes, with fallbacks
+once with both models up and once during an outage of default_gpt_model (every request to it fails with a 500).
+Reports the requests per model, the reply latency, the failed replies and the estimated cost from model_prices,
+counting the prompt tokens of each request the mock server answered and the tokens of its reply.
+
+Recorded chats can be replayed from a JSON lines file with one Telegram Update object (text messages) per line;
+otherwise --chats chats of --messages messages are generated from a mix of acknowledgements, short questions,
+complex requests and pasted texts.
+
+Usage:
+python benchmarks/bench_model_routing.py [--chats 20] [--messages 8] [--recorded updates.jsonl] [--retry-time 5]
+'''
+
+import argparse, asyncio, json, os, random, sys, tempfile, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'src'))
+
+from telegram import Update
+import chatbot
+from conversation import count_message_tokens, get_token_counter
+from model_router import get_model_price
+from mock_servers import MockOpenAIServer, MockTelegramServer
+from bench_utils import make_update, percentile
+
+
+model_latency = {'gpt-4o': 0.6, 'gpt-4o-mini': 0.3}  # mock latency per model, the cheaper model is faster
+reply = 'This is a mock reply of about twenty words, standing in for a typical answer of the assistant to the message.'
+message_mix = [
+    (0.25, ['Thanks!', 'great', 'Got it, thank you', 'hi', 'cool :)']),
+    (0.35, ['What is the capital of Peru?', 'How many ounces are in a pound?', 'Who wrote Dune?', 'Is it going to rain in Lisbon in May?', 'Give me a synonym for quick']),
+    (0.25, ['Explain step by step how TLS certificate validation works', 'Write a Python function that merges overlapping intervals',
+            'Compare PostgreSQL and MySQL for a write-heavy workload', 'Why does my recursive function overflow the stack? Debug it with me']),
+    (0.15, [' '.join(f'Line {i} of the meeting notes: the team discussed the roadmap, the budget and the hiring plan.' for i in range(30))]),
+]
+
+
+def synthetic_chats(n_chats:int, n_messages:int, seed:int=0) -> dict:
+    generator = random.Random(seed)
+    weights = [weight for weight, _ in message_mix]
+    return {1000+chat: [generator.choice(generator.choices(message_mix, weights)[0][1]) for _ in range(n_messages)] for chat in range(n_chats)}
+
+def recorded_chats(path:str) -> dict:
+    chats = {}
+    with open(path) as file:
+        for line in file:
+            message = json.loads(line).get('message') or {}
+            if message.get('text'):
+                chats.setdefault(message['chat']['id'], []).append(message['text'])
+    return chats
+
+async def replay(chats:dict, telegram:MockTelegramServer, openai_server:MockOpenAIServer, store_path:str) -> dict:
+    loop = asyncio.get_running_loop()
+    replies = {chat_id: asyncio.Queue() for chat_id in chats}
+    telegram.on_call = lambda call: loop.call_soon_threadsafe(replies[call['params']['chat_id']].put_nowait, (call['time'], call['params'].get('text'))) if call['method'] == 'sendMessage' else None
+    costs = {}
+    requests = {}
+
+    def on_request(request):
+        # called from a mock server thread; failed requests are not billed
+        model = request.get('model')
+        requests[model] = requests.get(model, 0)+1
+        if model in openai_server.failing_models or request.get('temperature') == 0:
+            return  # background summaries, sent at temperature 0, are the same under every policy
+        prompt_tokens = sum(count_message_tokens(message, model) for message in request['messages'])
+        price = get_model_price(model, chatbot.model_prices)
+        costs[model] = costs.get(model, 0)+(prompt_tokens*price[0]+get_token_counter(model)(reply)*price[1])/1e6
+
+    openai_server.on_request = on_request
+    application = chatbot.build_application('123456:mock', 'mock', telegram_base_url=telegram.address, openai_base_url=openai_server.base_url, conversation_store_path=store_path,
+                                            batch_store_path=os.path.join(os.path.dirname(store_path), 'batch_jobs.sqlite'))
+    await application.initialize()
+    await application.post_init(application)
+    await application.start()
+    latencies = []
+    n_failed = 0
+    update_ids = iter(range(1, 1+sum(len(messages) for messages in chats.values())))
+
+    async def run_chat(chat_id:int, messages:list):
+        nonlocal n_failed
+        for text in messages:
+            update = make_update(next(update_ids), chat_id, text=text)
+            t0 = time.perf_counter()
+            await application.update_queue.put(Update.de_json(update, application.bot))
+            reply_time, reply_text = await replies[chat_id].get()
+            latencies.append(reply_time-t0)
+            n_failed += reply_text == chatbot.gpt_error_response
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*(run_chat(chat_id, messages) for chat_id, messages in chats.items()))
+    elapsed = time.perf_counter()-t0
+    await application.stop()
+    await application.post_stop(application)
+    await application.shutdown()
+    await application.post_shutdown(application)
+    return {'requests': requests, 'p50': percentile(latencies, 50), 'p95': percentile(latencies, 95), 'failed': n_failed, 'cost': sum(costs.values()), 'elapsed': elapsed}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--chats', type=int, default=20, help='number of generated chats')
+    parser.add_argument('--messages', type=int, default=8, help='messages per generated chat')
+    parser.add_argument('--recorded', help='JSON lines file of recorded Telegram updates to replay instead')
+    parser.add_argument('--retry-time', type=float, default=5, help='api_retry_time, how long a failing request is retried')
+    args = parser.parse_args()
+
+    chats = recorded_chats(args.recorded) if args.recorded else synthetic_chats(args.chats, args.messages)
+    n_messages = sum(len(messages) for messages in chats.values())
+    chatbot.openai_requests_per_minute, chatbot.openai_tokens_per_minute = {}, {}
+    chatbot.stream_responses = False  # one sendMessage per reply
+    chatbot.api_retry_time = args.retry_time
+    policies = {
+        'fixed, no fallback': ('fixed', {}),
+        'fixed': ('fixed', chatbot.fallback_models),
+        'heuristic': ('heuristic', chatbot.fallback_models),
+    }
+    print(f'{len(chats)} chats, {n_messages} messages; mock latency {model_latency}')
+    print(f'{"scenario":>8} {"policy":>19} {"requests per model":>40} {"p50 s":>6} {"p95 s":>6} {"failed":>7} {"cost USD":>9}')
+    for scenario in ('normal', 'outage'):
+        for policy, (routing_policy, fallback_models) in policies.items():
+            chatbot.routing_policy, chatbot.fallback_models = routing_policy, fallback_models
+            failing_models = {chatbot.default_gpt_model} if scenario == 'outage' else set()
+            with MockOpenAIServer(latency=0.3, token_delay=0, reply=reply, model_latency=model_latency, failing_models=failing_models) as openai_server, \
+                    MockTelegramServer(latency=0.005) as telegram, tempfile.TemporaryDirectory() as tmp:
+                result = asyncio.run(replay(chats, telegram, openai_server, os.path.join(tmp, 'conversations.sqlite')))
+            requests = ', '.join(f'{model}: {n}' for model, n in sorted(result['requests'].items()))
+            print(f'{scenario:>8} {policy:>19} {requests:>40} {result["p50"]:>6.2f} {result["p95"]:>6.2f} {result["failed"]:>7} {result["cost"]:>9.4f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+'''
+Rate limit benchmark for the OpenAI completion path.
+Sends completion requests from many chats at a steady arrival rate above the limits, a fifth of them background summaries,
+to a local mock OpenAI server that enforces requests and tokens per minute like the API does (429 responses with
+retry-after headers), and compares:
+- 'blind retries': the previous policy, every error retried after the same doubling sleeps, with no pacing
+- 'learned limits': interact_with_gpt_model with a governor that only knows the limits from the response headers
+- 'configured limits': interact_with_gpt_model with a governor configured with the mock's limits
+and reports the completed requests, the 429s received, the sustained throughput and the latency of interactive
+and background requests.
+
+Usage:
+python benchmarks/bench_rate_limits.py [--requests 600] [--arrival-rate 15] [--rpm 600] [--tpm 200000] [--latency 0.2]
+'''
+
+import argparse, asyncio, os, sys, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'src'))
+
+import openai
+import chatbot
+from rate_limiter import RateLimitGovernor
+from mock_servers import MockOpenAIServer
+from bench_utils import percentile
+
+
+async def blind_retries(client:openai.AsyncOpenAI, conversation:list, semaphore:asyncio.Semaphore) -> str:
+    # the retry loop interact_with_gpt_model had before the governor: every error, doubling sleeps, no pacing
+    time_to_wait = 1
+    t0 = time.time()
+    while time.time()-t0 < chatbot.api_retry_time:
+        try:
+            async with semaphore:
+                response = await client.chat.completions.create(model=chatbot.default_gpt_model, messages=conversation, n=1, temperature=chatbot.temperature, stream=False)
+            return response.choices[0].message.content
+        except Exception:
+            pass
+        await asyncio.sleep(max(0, min(time_to_wait, chatbot.api_retry_time-(time.time()-t0))))
+        time_to_wait = time_to_wait*2
+    return chatbot.gpt_error_response
+
+async def run(mode:str, server:MockOpenAIServer, n_requests:int, arrival_rate:float, max_in_flight:int) -> dict:
+    client = openai.AsyncOpenAI(api_key='mock', base_url=server.base_url, max_retries=0)
+    semaphore = asyncio.Semaphore(max_in_flight)
+    limits = {chatbot.default_gpt_model: server.limits['requests']}, {chatbot.default_gpt_model: server.limits['tokens']}
+    governor = RateLimitGovernor(*limits, max_in_flight=max_in_flight) if mode == 'configured limits' else RateLimitGovernor(max_in_flight=max_in_flight)
+    latencies = {'chat': [], 'summary': []}
+    n_failed = 0
+    rate_limited_before = server.requests_rate_limited
+
+    async def request(i:int):
+        nonlocal n_failed
+        await asyncio.sleep(i/arrival_rate)
+        kind = 'summary' if i % 5 == 4 else 'chat'
+        conversation = [{'role': 'system', 'content': 'mock'}, {'role': 'user', 'content': f'message {i} '*20}]
+        t0 = time.perf_counter()
+        if mode == 'blind retries':
+            response = await blind_retries(client, conversation, semaphore)
+        else:
+            response = await chatbot.interact_with_gpt_model(client, conversation, temperature=chatbot.temperature, governor=governor, kind=kind)
+        if response == chatbot.gpt_error_response:
+            n_failed += 1
+        else:
+            latencies[kind].append(time.perf_counter()-t0)
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*(request(i) for i in range(n_requests)))
+    elapsed = time.perf_counter()-t0
+    await client.close()
+    n_completed = n_requests-n_failed
+    return {
+        'completed': n_completed, 'failed': n_failed, '429s': server.requests_rate_limited-rate_limited_before,
+        'throughput': n_completed/elapsed, 'chat p95': percentile(latencies['chat'], 95), 'summary p95': percentile(latencies['summary'], 95),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=600, help='number of requests sent')
+    parser.add_argument('--arrival-rate', type=float, default=15, help='requests sent per second')
+    parser.add_argument('--rpm', type=int, default=600, help='requests per minute allowed by the mock server')
+    parser.add_argument('--tpm', type=int, default=200000, help='tokens per minute allowed by the mock server')
+    parser.add_argument('--latency', type=float, default=0.2, help='mock completion latency in seconds')
+    parser.add_argument('--max-in-flight', type=int, default=chatbot.max_concurrent_api_requests, help='max requests in flight')
+    args = parser.parse_args()
+
+    print(f'{args.requests} requests at {args.arrival_rate}/s, mock limits {args.rpm} requests and {args.tpm} tokens per minute, ideal sustained rate {args.rpm/60:.1f}/s')
+    print(f'{"mode":>18} {"done":>6} {"failed":>6} {"429s":>6} {"req/s":>7} {"chat p95 s":>11} {"summary p95 s":>14}')
+    for mode in ('blind retries', 'learned limits', 'configured limits'):
+        # a fresh server per mode, so every mode starts with full rate limit buckets
+        with MockOpenAIServer(latency=args.latency, token_delay=0, requests_per_minute=args.rpm, tokens_per_minute=args.tpm) as server:
+            result = asyncio.run(run(mode, server, args.requests, args.arrival_rate, args.max_in_flight))
+        print(f'{mode:>18} {result["completed"]:>6} {result["failed"]:>6} {result["429s"]:>6} {result["throughput"]:>7.1f} {result["chat p95"]:>11.2f} {result["summary p95"]:>14.2f}')
+
+
+if __name__ == '__main__':
+    main()
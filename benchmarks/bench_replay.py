@@ -0,0 +1,257 @@
+'''
+End-to-end load and latency benchmark.
+Runs the real bot application from src/chatbot.py the way main() does in polling mode, against local mock Telegram
+Bot API and OpenAI servers: --users users each send --messages messages, a random mix of texts, voice messages,
+documents and photos, each waiting for the reply to the previous one (and --think-time seconds) before sending the next.
+The updates are served to the bot's getUpdates polling by the mock Telegram server. The mock servers have configurable
+latencies, and can fail a fraction of the OpenAI requests (500) and of the Telegram messages (429 flood control).
+
+Reports, overall and per message type:
+- the first response latency: from the update until the first message to the user (the start of a streamed reply,
+  or a voice message's transcript)
+- the reply latency: from the update until the complete reply
+- the throughput (replies per second) and the failed replies (error replies, or no reply within --reply-timeout)
+- the event loop lag: how late a task that sleeps every --lag-interval seconds wakes up, showing blocking work on the loop
+- the peak RSS of the process, which includes the mock servers' threads
+The results are written as JSON to --output. With --baseline, they are compared with an earlier results file,
+and the script exits with status 1 if the p95 reply latency, the throughput or the failures regressed by more than
+--tolerance.
+
+Usage:
+python benchmarks/bench_replay.py [--users 20] [--messages 5] [--mix text=0.6,voice=0.15,document=0.1,photo=0.15]
+    [--openai-latency 0.3] [--token-delay 0.01] [--telegram-latency 0.01] [--openai-error-rate 0] [--telegram-error-rate 0]
+    [--no-stream] [--output bench_replay.json] [--baseline previous.json] [--tolerance 0.2]
+'''
+
+import argparse, asyncio, json, os, platform, random, resource, subprocess, sys, tempfile, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'src'))
+
+import chatbot
+from mock_servers import MockOpenAIServer, MockTelegramServer
+from bench_utils import make_update, percentile
+
+
+reply = ('This is a mock reply standing in for an answer of the assistant. It has a few sentences, so that a streamed '
+         'reply is edited a couple of times before it is complete, like a typical answer to a short question.')
+texts = ['What is the capital of Peru?', 'Explain how a hash map works', 'Thanks!', 'Write a haiku about autumn', 'How far is the moon?']
+document_text = '\n'.join(f'{i}. A line of the attached notes, about the roadmap, the budget and the hiring plan.' for i in range(40))
+photo_sizes = [(90, 67), (320, 240), (800, 600), (1280, 960)]
+
+
+def parse_mix(mix:str) -> dict:
+    weights = {}
+    for item in mix.split(','):
+        kind, weight = item.split('=')
+        if kind not in ('text', 'voice', 'document', 'photo'):
+            raise argparse.ArgumentTypeError(f'unknown message type {kind}')
+        weights[kind] = float(weight)
+    return weights
+
+def make_replay_update(update_id:int, user_id:int, kind:str, generator:random.Random) -> dict:
+    if kind == 'text':
+        return make_update(update_id, user_id, text=generator.choice(texts))
+    if kind == 'voice':
+        return make_update(update_id, user_id, voice={'file_id': 'voice', 'file_unique_id': 'voice', 'duration': 3, 'mime_type': 'audio/ogg'})
+    if kind == 'document':
+        return make_update(update_id, user_id, caption='Summarize these notes',
+                           document={'file_id': 'document', 'file_unique_id': 'document', 'file_name': 'notes.txt', 'mime_type': 'text/plain'})
+    # a different photo in each update, so the image cache doesn't spare the download
+    return make_update(update_id, user_id, caption='What is in this photo?',
+                       photo=[{'file_id': f'photo-{w}', 'file_unique_id': f'photo-{update_id}-{w}', 'width': w, 'height': h} for w, h in photo_sizes])
+
+def classify_message(method:str, params:dict) -> str:
+    # what a message the bot sent means for the user's pending message: 'preview', 'transcript', 'partial', 'reply' or 'failed'
+    text = str(params.get('text', ''))
+    markdown = params.get('parse_mode') == 'Markdown'
+    if method == 'editMessageText' and not markdown:
+        return 'preview'
+    if text.startswith('transcripted voice message'):
+        return 'transcript'
+    if chatbot.gpt_error_response in text:
+        return 'failed'
+    if markdown:
+        return 'reply'
+    # the plain first message of a streamed reply is the start of the reply; other plain messages are errors
+    return 'partial' if text and reply.startswith(text) else 'failed'
+
+async def monitor_loop_lag(interval:float, lags:list):
+    while True:
+        t0 = time.perf_counter()
+        await asyncio.sleep(interval)
+        lags.append(time.perf_counter()-t0-interval)
+
+async def replay(args, telegram:MockTelegramServer, store_path:str) -> dict:
+    loop = asyncio.get_running_loop()
+    pending = {}  # user ID -> the state of the user's message waiting for its reply
+
+    def on_call(call):
+        # called from a mock server thread
+        if call['method'] in ('sendMessage', 'editMessageText'):
+            loop.call_soon_threadsafe(on_message, call)
+
+    def on_message(call):
+        state = pending.get(call['params'].get('chat_id'))
+        if state is None:
+            return
+        kind = classify_message(call['method'], call['params'])
+        if kind != 'preview' and state['first'] is None:
+            state['first'] = call['time']
+        if kind in ('reply', 'failed') and not state['done'].done():
+            state['done'].set_result((call['time'], kind == 'reply'))
+
+    telegram.on_call = on_call
+    application = chatbot.build_application('123456:mock', 'mock', telegram_base_url=telegram.address, openai_base_url=args.openai_base_url, conversation_store_path=store_path,
+                                            batch_store_path=os.path.join(os.path.dirname(store_path), 'batch_jobs.sqlite'))
+    # what Application.run_polling does, without taking over the event loop and the signal handlers
+    await application.initialize()
+    await application.post_init(application)
+    await application.updater.start_polling(poll_interval=0, timeout=10)
+    await application.start()
+
+    lags = []
+    lag_task = asyncio.create_task(monitor_loop_lag(args.lag_interval, lags))
+    generator = random.Random(args.seed)
+    kinds = list(args.mix)
+    weights = [args.mix[kind] for kind in kinds]
+    update_ids = iter(range(1, args.users*args.messages+1))
+    results = []
+
+    async def run_user(user_id:int):
+        for _ in range(args.messages):
+            kind = generator.choices(kinds, weights)[0]
+            update = make_replay_update(next(update_ids), user_id, kind, generator)
+            state = pending[user_id] = {'first': None, 'done': loop.create_future()}
+            t0 = time.perf_counter()
+            telegram.push_update(update)
+            try:
+                done_time, ok = await asyncio.wait_for(asyncio.shield(state['done']), args.reply_timeout)
+            except asyncio.TimeoutError:
+                done_time, ok = None, False
+            first = state['first']
+            results.append({'kind': kind, 'ok': ok, 'first': None if first is None else first-t0, 'reply': None if done_time is None else done_time-t0})
+            del pending[user_id]
+            await asyncio.sleep(args.think_time)
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*(run_user(10000+i) for i in range(args.users)))
+    elapsed = time.perf_counter()-t0
+    lag_task.cancel()
+    await application.updater.stop()
+    await application.stop()
+    await application.post_stop(application)
+    await application.shutdown()
+    await application.post_shutdown(application)
+    return {'results': results, 'elapsed': elapsed, 'lags': lags}
+
+def summarize(results:list) -> dict:
+    replied = [result for result in results if result['ok']]
+    first = [result['first'] for result in results if result['first'] is not None]
+    latencies = [result['reply'] for result in replied]
+    return {
+        'messages': len(results),
+        'failed': len(results)-len(replied),
+        'first_response_p50': percentile(first, 50), 'first_response_p95': percentile(first, 95), 'first_response_p99': percentile(first, 99),
+        'reply_p50': percentile(latencies, 50), 'reply_p95': percentile(latencies, 95), 'reply_p99': percentile(latencies, 99),
+    }
+
+def get_git_revision() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.realpath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def get_peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak/2**20 if sys.platform == 'darwin' else peak/2**10  # bytes on macOS, kilobytes on Linux
+
+def compare_with_baseline(report:dict, baseline:dict, tolerance:float) -> list:
+    # returns the regressions of the report against the baseline, as text lines
+    regressions = []
+    current, previous = report['overall'], baseline['overall']
+    if previous['reply_p95'] > 0 and current['reply_p95'] > previous['reply_p95']*(1+tolerance):
+        regressions.append(f'p95 reply latency {current["reply_p95"]:.3f} s, was {previous["reply_p95"]:.3f} s')
+    if report['throughput'] < baseline['throughput']*(1-tolerance):
+        regressions.append(f'throughput {report["throughput"]:.2f} replies/s, was {baseline["throughput"]:.2f}')
+    if current['failed'] > previous['failed']*(1+tolerance) and current['failed'] > previous['failed']:
+        regressions.append(f'{current["failed"]} failed replies, was {previous["failed"]}')
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=20, help='concurrent users')
+    parser.add_argument('--messages', type=int, default=5, help='messages sent by each user')
+    parser.add_argument('--mix', type=parse_mix, default='text=0.6,voice=0.15,document=0.1,photo=0.15', help='weights of the message types')
+    parser.add_argument('--think-time', type=float, default=0, help='seconds a user waits after a reply before sending the next message')
+    parser.add_argument('--openai-latency', type=float, default=0.3, help='mock OpenAI latency in seconds, until the first token')
+    parser.add_argument('--token-delay', type=float, default=0.01, help='mock OpenAI seconds per generated word')
+    parser.add_argument('--telegram-latency', type=float, default=0.01, help='mock Telegram latency in seconds')
+    parser.add_argument('--openai-error-rate', type=float, default=0, help='fraction of OpenAI requests failing with a 500')
+    parser.add_argument('--telegram-error-rate', type=float, default=0, help='fraction of Telegram messages rejected with a 429')
+    parser.add_argument('--no-stream', action='store_true', help='send each reply whole instead of streaming it')
+    parser.add_argument('--reply-timeout', type=float, default=120, help='seconds after which a message without reply counts as failed')
+    parser.add_argument('--lag-interval', type=float, default=0.01, help='seconds between the event loop lag probes')
+    parser.add_argument('--retry-time', type=float, default=10, help='api_retry_time, how long a failing OpenAI request is retried')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the message mix and the injected errors')
+    parser.add_argument('--output', default='bench_replay.json', help='JSON file the results are written to')
+    parser.add_argument('--baseline', help='JSON results file of an earlier run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='relative change counted as a regression')
+    args = parser.parse_args()
+
+    chatbot.openai_requests_per_minute, chatbot.openai_tokens_per_minute = {}, {}
+    chatbot.stream_responses = not args.no_stream
+    chatbot.api_retry_time = args.retry_time
+    chatbot.metrics_port = None
+    rss_before = get_peak_rss_mb()
+    with MockOpenAIServer(latency=args.openai_latency, token_delay=args.token_delay, reply=reply, error_rate=args.openai_error_rate, seed=args.seed) as openai_server, \
+            MockTelegramServer(latency=args.telegram_latency, error_rate=args.telegram_error_rate, seed=args.seed) as telegram, tempfile.TemporaryDirectory() as tmp:
+        telegram.files['voice'] = os.urandom(16*1024)
+        telegram.files['document'] = document_text.encode('utf-8')
+        for w, h in photo_sizes:
+            telegram.files[f'photo-{w}'] = b'\xff\xd8'+os.urandom(int(w*h*0.15))
+        args.openai_base_url = openai_server.base_url
+        run = asyncio.run(replay(args, telegram, os.path.join(tmp, 'conversations.sqlite')))
+        injected = {'openai_errors': openai_server.requests_failed, 'telegram_rejections': telegram.n_rejected}
+
+    results = run['results']
+    report = {
+        'benchmark': 'bench_replay',
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'git_revision': get_git_revision(),
+        'python': platform.python_version(),
+        'config': {key: value for key, value in vars(args).items() if key not in ('openai_base_url', 'output', 'baseline')},
+        'overall': summarize(results),
+        'by_type': {kind: summarize([result for result in results if result['kind'] == kind]) for kind in args.mix if any(result['kind'] == kind for result in results)},
+        'throughput': sum(result['ok'] for result in results)/run['elapsed'],
+        'elapsed': run['elapsed'],
+        'loop_lag_p50': percentile(run['lags'], 50), 'loop_lag_p99': percentile(run['lags'], 99), 'loop_lag_max': max(run['lags'], default=0.0),
+        'peak_rss_mb': get_peak_rss_mb(), 'peak_rss_before_run_mb': rss_before,
+        'injected': injected,
+    }
+    with open(args.output, 'w') as file:
+        json.dump(report, file, indent=2)
+
+    print(f'{args.users} users x {args.messages} messages, {"streamed" if chatbot.stream_responses else "whole"} replies, '
+          f'injected {injected["openai_errors"]} OpenAI errors and {injected["telegram_rejections"]} Telegram rejections')
+    print(f'{"type":>9} {"messages":>9} {"failed":>7} {"first p50":>10} {"first p95":>10} {"reply p50":>10} {"reply p95":>10} {"reply p99":>10}')
+    for kind, summary in [('all', report['overall'])]+list(report['by_type'].items()):
+        print(f'{kind:>9} {summary["messages"]:>9} {summary["failed"]:>7} {summary["first_response_p50"]:>10.3f} {summary["first_response_p95"]:>10.3f} '
+              f'{summary["reply_p50"]:>10.3f} {summary["reply_p95"]:>10.3f} {summary["reply_p99"]:>10.3f}')
+    print(f'throughput {report["throughput"]:.2f} replies/s over {report["elapsed"]:.1f} s; event loop lag p50 {report["loop_lag_p50"]*1000:.1f} ms, '
+          f'p99 {report["loop_lag_p99"]*1000:.1f} ms, max {report["loop_lag_max"]*1000:.1f} ms; peak RSS {report["peak_rss_mb"]:.0f} MB')
+    print(f'results written to {args.output}')
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        regressions = compare_with_baseline(report, baseline, args.tolerance)
+        for regression in regressions:
+            print(f'REGRESSION: {regression}')
+        if regressions:
+            sys.exit(1)
+        print(f'no regression against {args.baseline} (git revision {baseline.get("git_revision")})')
+
+
+if __name__ == '__main__':
+    main()
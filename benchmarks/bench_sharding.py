@@ -0,0 +1,92 @@
+'''
+Scale-out benchmark for the sharded webhook mode.
+Runs the front webhook server of src/sharding.py with an increasing number of worker processes, each running the real
+bot application, against local mock Telegram Bot API and OpenAI servers, sends a burst of text updates from many users
+and reports the reply throughput. With the OpenAI latency hidden by concurrency, a single process is bound by the CPU
+time of handling updates, so throughput should grow with the number of workers up to the number of cores.
+
+Usage:
+python benchmarks/bench_sharding.py [--workers 1 2 4] [--updates 2000] [--users 200]
+'''
+
+import argparse, asyncio, os, sys, tempfile, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'src'))
+
+import aiohttp
+from aiohttp import web
+from sharding import ShardRouter, create_router_app
+from webhook_server import secret_token_header
+from mock_servers import MockOpenAIServer, MockTelegramServer
+from bench_webhook import synthetic_updates
+
+
+async def run(n_workers:int, updates:list, telegram:MockTelegramServer, openai_url:str, workdir:str) -> dict:
+    secret = 'benchmark-secret'
+    loop = asyncio.get_running_loop()
+    replies = {}  # chat_id -> reply texts
+    done = asyncio.Event()
+    n_replies = 0
+
+    def record_reply(chat_id, text):
+        nonlocal n_replies
+        replies.setdefault(chat_id, []).append(text)
+        n_replies += 1
+        if n_replies >= len(updates):
+            done.set()
+
+    telegram.on_call = lambda call: call['method'] == 'sendMessage' and loop.call_soon_threadsafe(record_reply, call['params'].get('chat_id'), call['params'].get('text'))
+    overrides = {
+        'stream_responses': False,
+        'max_concurrent_api_requests': 1000,
+        'max_pending_jobs_per_user': len(updates),
+        'conversation_store_file': os.path.join(workdir, f'conversations_{n_workers}.sqlite'),
+        'batch_store_file': os.path.join(workdir, f'batch_jobs_{n_workers}.sqlite'),
+        'coalesce_window': None,  # one reply per update, as the updates of a user arrive at once
+        'cancel_superseded_replies': False,
+        'metrics_port': None,
+        'openai_requests_per_minute': {},  # the mock server has no rate limits
+        'openai_tokens_per_minute': {},
+    }
+    router = ShardRouter(n_workers)
+    router.start('123456:mock', 'mock', os.path.join(workdir, f'shared_state_{n_workers}.sqlite'), overrides, {'telegram_base_url': telegram.address, 'openai_base_url': openai_url})
+    runner = web.AppRunner(create_router_app(router, secret, '/telegram'), access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, '127.0.0.1', 0).start()
+    url = 'http://{}:{}/telegram'.format(*runner.addresses[0][:2])
+    await asyncio.sleep(3)  # let the workers start
+
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=50)) as session:
+        t0 = time.perf_counter()
+        for update in updates:
+            async with session.post(url, json=update, headers={secret_token_header: secret}) as response:
+                assert response.status == 200
+        try:
+            await asyncio.wait_for(done.wait(), timeout=120)
+        except asyncio.TimeoutError:
+            print(f'timed out waiting for replies, got {n_replies} of {len(updates)}')
+        elapsed = time.perf_counter()-t0
+    await runner.cleanup()
+    await router.stop()
+    telegram.on_call = None
+    return {'replies': n_replies, 'seconds': elapsed, 'throughput': n_replies/elapsed}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4], help='numbers of worker processes to test')
+    parser.add_argument('--updates', type=int, default=2000, help='number of updates sent')
+    parser.add_argument('--users', type=int, default=200, help='number of users sending them')
+    parser.add_argument('--openai-latency', type=float, default=0.05, help='mock OpenAI latency in seconds')
+    args = parser.parse_args()
+
+    updates = synthetic_updates(args.updates, args.users)
+    print(f'{os.cpu_count()} cores available')
+    print(f'{"workers":>8} {"replies":>8} {"seconds":>8} {"replies/s":>10}')
+    with MockOpenAIServer(latency=args.openai_latency, token_delay=0) as openai_server, MockTelegramServer(latency=0) as telegram, tempfile.TemporaryDirectory() as workdir:
+        for n_workers in args.workers:
+            result = asyncio.run(run(n_workers, updates, telegram, openai_server.base_url, workdir))
+            print(f'{n_workers:>8} {result["replies"]:>8} {result["seconds"]:>8.2f} {result["throughput"]:>10.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+'''
+Startup, authorization and config reload benchmark.
+- import: the time to import src/chatbot.py in a fresh interpreter (best of --runs), and the slowest imports
+  of chatbot, as reported by python -X importtime
+- startup: the time from build_application to a started application against a local mock Telegram Bot API server,
+  and the time to the first reply, which also loads the config (allowed IDs, system prompt and settings) on first use
+- authorization: the time of one allowed IDs check, with the IDs in a list (as before) and in the config's set
+- reload: the time from a change of the allowed IDs file until the running bot lets a new user in, with config_poll_interval
+
+Usage:
+python benchmarks/bench_startup.py [--runs 5] [--poll-interval 0.5]
+'''
+
+import argparse, asyncio, os, subprocess, sys, tempfile, time, timeit
+
+src_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'src')
+sys.path.insert(0, src_path)
+
+from telegram import Update
+import chatbot
+from config import BotConfig, ConfigWatcher
+from mock_servers import MockOpenAIServer, MockTelegramServer
+from bench_utils import make_update
+
+
+def measure_import(runs:int) -> tuple:
+    times = []
+    for _ in range(runs):
+        result = subprocess.run([sys.executable, '-c', 'import time; t0 = time.perf_counter(); import chatbot; print(time.perf_counter()-t0)'],
+                                cwd=src_path, capture_output=True, text=True, check=True)
+        times.append(float(result.stdout.strip().splitlines()[-1]))
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import chatbot'], cwd=src_path, capture_output=True, text=True, check=True)
+    direct_imports = []
+    for line in result.stderr.splitlines():
+        # lines are 'import time: self [us] | cumulative | name', with the name indented by two spaces per nesting level
+        fields = line.split('|')
+        if len(fields) == 3 and fields[1].strip().isdigit() and len(fields[2])-len(fields[2].lstrip()) == 3:
+            direct_imports.append((int(fields[1])/1e6, fields[2].strip()))
+    return min(times), sorted(direct_imports, reverse=True)[:6]
+
+async def measure_startup_and_reload(telegram:MockTelegramServer, openai_server:MockOpenAIServer, files_dir:str, poll_interval:float) -> dict:
+    loop = asyncio.get_running_loop()
+    replies = asyncio.Queue()
+    telegram.on_call = lambda call: loop.call_soon_threadsafe(replies.put_nowait, call['params']) if call['method'] == 'sendMessage' else None
+    paths = [os.path.join(files_dir, name) for name in ('system_prompt', 'allowed_ids', 'settings.json')]
+    with open(paths[1], 'w') as file:
+        file.write('1001\n')
+    chatbot.make_config_watcher = lambda: ConfigWatcher(lambda: chatbot.load_config(*paths), paths, poll_interval)
+
+    t0 = time.perf_counter()
+    application = chatbot.build_application('123456:mock', 'mock', telegram_base_url=telegram.address, openai_base_url=openai_server.base_url,
+                                            conversation_store_path=os.path.join(files_dir, 'conversations.sqlite'), batch_store_path=os.path.join(files_dir, 'batch_jobs.sqlite'))
+    await application.initialize()
+    await application.post_init(application)
+    await application.start()
+    started = time.perf_counter()-t0
+    t0 = time.perf_counter()
+    await application.update_queue.put(Update.de_json(make_update(1, 1001, text='hi'), application.bot))
+    await replies.get()
+    first_reply = time.perf_counter()-t0
+
+    # a new user is turned away, then let in once the allowed IDs file lists them
+    await application.update_queue.put(Update.de_json(make_update(2, 1002, text='hi'), application.bot))
+    rejected = (await replies.get())['text'].startswith('You are not authorized')
+    t0 = time.perf_counter()
+    with open(paths[1], 'w') as file:
+        file.write('1001\n1002\n')
+    while not application.bot_data['config_watcher'].config.is_allowed('1002'):
+        await asyncio.sleep(0.01)
+    reload_seconds = time.perf_counter()-t0
+    await application.update_queue.put(Update.de_json(make_update(3, 1002, text='hi'), application.bot))
+    allowed = not (await replies.get())['text'].startswith('You are not authorized')
+    await application.stop()
+    await application.post_stop(application)
+    await application.shutdown()
+    await application.post_shutdown(application)
+    return {'started': started, 'first reply': first_reply, 'reload': reload_seconds, 'rejected then allowed': rejected and allowed}
+
+def measure_authorization(n_ids:int) -> tuple:
+    ids = [str(10**8+i) for i in range(n_ids)]
+    config = BotConfig(frozenset(ids), {'role': 'system', 'content': ''}, 'gpt-4o', 0.5, {})
+    user_id = str(10**8+n_ids-1)  # the worst case of the list, the last ID
+    number = max(1000, 10**7//n_ids)
+    before = timeit.timeit(lambda: not user_id in ids and len(ids) > 0, number=number)/number
+    after = timeit.timeit(lambda: config.is_allowed(user_id), number=number)/number
+    return before, after
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5, help='imports measured, the best is reported')
+    parser.add_argument('--poll-interval', type=float, default=0.5, help='config_poll_interval of the reload measurement')
+    args = parser.parse_args()
+
+    import_seconds, slowest = measure_import(args.runs)
+    print(f'import chatbot: {import_seconds*1000:.0f} ms (best of {args.runs}); its slowest imports:')
+    for seconds, name in slowest:
+        print(f'  {name:<24} {seconds*1000:>6.0f} ms')
+
+    chatbot.openai_requests_per_minute, chatbot.openai_tokens_per_minute = {}, {}
+    chatbot.stream_responses = False
+    chatbot.metrics_port = None
+    with MockOpenAIServer(latency=0.05, token_delay=0) as openai_server, MockTelegramServer(latency=0.005) as telegram, tempfile.TemporaryDirectory() as tmp:
+        result = asyncio.run(measure_startup_and_reload(telegram, openai_server, tmp, args.poll_interval))
+    print(f'startup to a running application: {result["started"]*1000:.0f} ms; first reply, loading the config: {result["first reply"]*1000:.0f} ms')
+    print(f'allowed IDs change applied after {result["reload"]*1000:.0f} ms (poll interval {args.poll_interval*1000:.0f} ms), '
+          f'new user {"rejected before and served after" if result["rejected then allowed"] else "NOT handled as expected"}')
+
+    print(f'\n{"allowed IDs":>12} {"list check us":>14} {"set check us":>13}')
+    for n_ids in (10, 1000, 100000):
+        before, after = measure_authorization(n_ids)
+        print(f'{n_ids:>12} {before*1e6:>14.3f} {after*1e6:>13.3f}')
+
+
+if __name__ == '__main__':
+    main()
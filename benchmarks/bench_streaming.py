@@ -0,0 +1,57 @@
+'''
+Time-to-first-token benchmark for the streaming completion path.
+Sends the same requests through interact_with_gpt_model (the whole reply at once) and through stream_gpt_model
+(the reply in pieces), against a local mock OpenAI server that generates a long reply word by word,
+and reports how long a user waits before seeing any text in each mode.
+
+Usage:
+python benchmarks/bench_streaming.py [--latency 0.3] [--token-delay 0.01] [--words 300] [--requests 10]
+'''
+
+import argparse, asyncio, os, statistics, sys, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'src'))
+
+import openai
+import chatbot
+from mock_servers import MockOpenAIServer
+
+
+async def measure(base_url:str, n_requests:int) -> dict:
+    client = openai.AsyncOpenAI(api_key='mock', base_url=base_url)
+    conversation = [{'role': 'system', 'content': 'mock'}, {'role': 'user', 'content': 'tell me a long story'}]
+    results = {'full response': [], 'first token': [], 'streamed response': []}
+    for _ in range(n_requests):
+        t0 = time.perf_counter()
+        await chatbot.interact_with_gpt_model(client, conversation)
+        results['full response'].append(time.perf_counter()-t0)
+
+        t0 = time.perf_counter()
+        first_token_time = None
+        async for _ in chatbot.stream_gpt_model(client, conversation):
+            if first_token_time is None:
+                first_token_time = time.perf_counter()-t0
+        results['first token'].append(first_token_time)
+        results['streamed response'].append(time.perf_counter()-t0)
+    await client.close()
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--latency', type=float, default=0.3, help='mock latency before the first token, in seconds')
+    parser.add_argument('--token-delay', type=float, default=0.01, help='mock delay between streamed words, in seconds')
+    parser.add_argument('--words', type=int, default=300, help='length of the mock reply in words')
+    parser.add_argument('--requests', type=int, default=10, help='number of requests per mode')
+    args = parser.parse_args()
+
+    reply = ' '.join(f'word{i}' for i in range(args.words))
+    with MockOpenAIServer(latency=args.latency, token_delay=args.token_delay, reply=reply) as server:
+        results = asyncio.run(measure(server.base_url, args.requests))
+    print(f'{"metric":>18} {"mean s":>8} {"max s":>8}')
+    for name, values in results.items():
+        print(f'{name:>18} {statistics.mean(values):>8.3f} {max(values):>8.3f}')
+    print('without streaming the user waits for the full response; with streaming, for the first token')
+
+
+if __name__ == '__main__':
+    main()
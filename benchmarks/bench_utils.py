@@ -0,0 +1,30 @@
+'''
+Helpers shared by the benchmark scripts.
+'''
+
+import time
+
+
+def percentile(values:list, p:float) -> float:
+    '''
+    Returns the p-th percentile of a list of numbers, by linear interpolation between the closest ranks, or 0 for an empty list.
+    '''
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = (len(ordered)-1)*p/100
+    low = int(rank)
+    high = min(low+1, len(ordered)-1)
+    return ordered[low]+(ordered[high]-ordered[low])*(rank-low)
+
+def make_update(update_id:int, user_id:int, **content) -> dict:
+    '''
+    Returns a Telegram update (as JSON, for Update.de_json) with a private message from user_id, whose message ID is update_id.
+    The keyword arguments are the content of the message, e.g. text='hi', or photo=[...] and caption='...'.
+    '''
+    return {'update_id': update_id, 'message': {
+        'message_id': update_id, 'date': int(time.time()),
+        'chat': {'id': user_id, 'type': 'private'},
+        'from': {'id': user_id, 'is_bot': False, 'first_name': f'user{user_id}'},
+        **content,
+    }}
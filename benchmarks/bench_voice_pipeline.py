@@ -0,0 +1,111 @@
+'''
+Latency benchmark for the voice message pipeline.
+Processes the same voice note with the previous pipeline (write the download to disk, convert it with a blocking
+os.system ffmpeg call to 192 kbps stereo mp3, read it back, upload it) and with the in-memory pipeline used by
+voice_message_handle_function (upload the ogg/opus bytes directly), against a local mock transcription endpoint.
+Reports per-stage timings, the latency saved per voice note, and the longest event loop stall seen during each pipeline.
+
+If ffmpeg is installed, the voice note is a real opus recording of a test tone; otherwise it is random bytes of the same
+size, and the conversion stage of the previous pipeline is reported as unavailable.
+
+Usage:
+python benchmarks/bench_voice_pipeline.py [--seconds 30] [--runs 5] [--latency 0.2]
+'''
+
+import argparse, asyncio, os, shutil, statistics, subprocess, sys, tempfile, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'src'))
+
+import openai
+import chatbot
+from mock_servers import MockOpenAIServer
+
+
+def make_voice_note(seconds:int) -> bytes:
+    if shutil.which('ffmpeg'):
+        result = subprocess.run(['ffmpeg', '-hide_banner', '-loglevel', 'error', '-f', 'lavfi', '-i', f'sine=frequency=440:duration={seconds}',
+                                 '-c:a', 'libopus', '-b:a', '16k', '-f', 'ogg', 'pipe:1'], capture_output=True, check=True)
+        return result.stdout
+    return os.urandom(seconds*2000)  # Telegram voice notes are about 16 kbps
+
+async def watch_loop_lag(stop:asyncio.Event, interval:float=0.01) -> float:
+    max_lag = 0
+    while not stop.is_set():
+        t0 = time.perf_counter()
+        await asyncio.sleep(interval)
+        max_lag = max(max_lag, time.perf_counter()-t0-interval)
+    return max_lag
+
+async def disk_pipeline(client, voice_bytes:bytes, workdir:str) -> dict:
+    times = {}
+    t0 = time.perf_counter()
+    opus_path = os.path.join(workdir, 'chatbot_audio_file.opus')
+    mp3_path = os.path.join(workdir, 'chatbot_audio_file.mp3')
+    with open(opus_path, 'wb') as file:
+        file.write(voice_bytes)
+    times['save'] = time.perf_counter()-t0
+    t0 = time.perf_counter()
+    if shutil.which('ffmpeg'):
+        os.system(f'ffmpeg -hide_banner -loglevel error -y -i {opus_path} -ac 2 -b:a 192k {mp3_path}')
+        times['transcode'] = time.perf_counter()-t0
+    else:
+        shutil.copyfile(opus_path, mp3_path)
+    t0 = time.perf_counter()
+    with open(mp3_path, 'rb') as file:
+        await client.audio.transcriptions.create(model='whisper-1', file=file)
+    times['transcribe'] = time.perf_counter()-t0
+    os.remove(opus_path)
+    os.remove(mp3_path)
+    return times
+
+async def memory_pipeline(client, voice_bytes:bytes) -> dict:
+    t0 = time.perf_counter()
+    _, success = await chatbot.transcribe_audio_to_text(voice_bytes, 'voice.ogg', client)
+    assert success
+    return {'transcribe': time.perf_counter()-t0}
+
+async def measure(base_url:str, voice_bytes:bytes, runs:int) -> dict:
+    client = openai.AsyncOpenAI(api_key='mock', base_url=base_url)
+    results = {}
+    with tempfile.TemporaryDirectory() as workdir:
+        for name in ('disk + ffmpeg', 'in-memory'):
+            totals, stages, lags = [], {}, []
+            for _ in range(runs):
+                stop = asyncio.Event()
+                watcher = asyncio.create_task(watch_loop_lag(stop))
+                await asyncio.sleep(0.02)
+                t0 = time.perf_counter()
+                if name == 'disk + ffmpeg':
+                    times = await disk_pipeline(client, voice_bytes, workdir)
+                else:
+                    times = await memory_pipeline(client, voice_bytes)
+                totals.append(time.perf_counter()-t0)
+                stop.set()
+                lags.append(await watcher)
+                for stage, seconds in times.items():
+                    stages.setdefault(stage, []).append(seconds)
+            results[name] = {'total': statistics.mean(totals), 'max loop stall': max(lags), **{stage: statistics.mean(values) for stage, values in stages.items()}}
+    await client.close()
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--seconds', type=int, default=30, help='length of the voice note in seconds')
+    parser.add_argument('--runs', type=int, default=5, help='number of runs per pipeline')
+    parser.add_argument('--latency', type=float, default=0.2, help='mock transcription latency in seconds')
+    args = parser.parse_args()
+
+    voice_bytes = make_voice_note(args.seconds)
+    if not shutil.which('ffmpeg'):
+        print('ffmpeg not found: using random bytes as the voice note, the transcode stage is unavailable')
+    print(f'voice note: {len(voice_bytes)} bytes')
+    with MockOpenAIServer(latency=args.latency) as server:
+        results = asyncio.run(measure(server.base_url, voice_bytes, args.runs))
+    for name, times in results.items():
+        print(f'{name:>14}: '+', '.join(f'{stage} {seconds:.3f}s' for stage, seconds in times.items()))
+    saved = results['disk + ffmpeg']['total']-results['in-memory']['total']
+    print(f'latency saved per voice note: {saved:.3f}s')
+
+
+if __name__ == '__main__':
+    main()
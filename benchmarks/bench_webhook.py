@@ -0,0 +1,138 @@
+'''
+Replay benchmark for the webhook mode.
+Runs the real bot application from src/chatbot.py behind its webhook server, against local mock Telegram Bot API and
+OpenAI servers, and replays Update payloads to the webhook at a target rate over one keep-alive connection pool,
+the way Telegram delivers them. Reports how fast the webhook accepts updates and the end-to-end reply latency.
+
+Recorded updates can be replayed from a JSON lines file with one Telegram Update object per line;
+otherwise text message updates from --users different users are generated.
+
+Usage:
+python benchmarks/bench_webhook.py [--rate 50] [--updates 500] [--users 100] [--recorded updates.jsonl]
+'''
+
+import argparse, asyncio, json, os, sys, tempfile, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'src'))
+
+import aiohttp
+import chatbot
+import webhook_server
+from mock_servers import MockOpenAIServer, MockTelegramServer
+from bench_utils import make_update, percentile
+
+
+def synthetic_updates(n_updates:int, n_users:int) -> list:
+    updates = []
+    for i in range(n_updates):
+        user_id = 1000+i%n_users
+        updates.append(make_update(i+1, user_id, text=f'message number {i}'))
+    return updates
+
+async def replay(updates:list, rate:float, telegram:MockTelegramServer, openai_url:str, store_path:str, secret:str) -> dict:
+    loop = asyncio.get_running_loop()
+    replies = {}  # chat_id -> list of reply times, in order
+    all_replied = asyncio.Event()
+    expected = len(updates)
+    n_replies = 0
+
+    def on_call(call):
+        # called from a mock server thread
+        params = call['params']
+        if call['method'] == 'sendMessage':
+            loop.call_soon_threadsafe(record_reply, params.get('chat_id'), call['time'])
+
+    def record_reply(chat_id, reply_time):
+        nonlocal n_replies
+        replies.setdefault(chat_id, []).append(reply_time)
+        n_replies += 1
+        if n_replies >= expected:
+            all_replied.set()
+
+    telegram.on_call = on_call
+    application = chatbot.build_application('123456:mock', 'mock', telegram_base_url=telegram.address, openai_base_url=openai_url, conversation_store_path=store_path,
+                                            batch_store_path=os.path.join(os.path.dirname(store_path), 'batch_jobs.sqlite'))
+    await application.initialize()
+    await application.post_init(application)
+    await application.start()
+    runner = await webhook_server.start_webhook_server(application, secret, '127.0.0.1', 0, '/telegram')
+    url = 'http://{}:{}/telegram'.format(*runner.addresses[0][:2])
+
+    sent = {}  # chat_id -> list of send times, in order
+    accept_times = []
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=100)) as session:
+        async with session.post(url, json=updates[0], headers={webhook_server.secret_token_header: 'wrong'}) as response:
+            assert response.status == 403, 'webhook accepted an update with a wrong secret token'
+
+        async def post(update):
+            chat_id = update['message']['chat']['id']
+            t0 = time.perf_counter()
+            sent.setdefault(chat_id, []).append(t0)
+            async with session.post(url, json=update, headers={webhook_server.secret_token_header: secret}) as response:
+                await response.read()
+            accept_times.append(time.perf_counter()-t0)
+
+        t_start = time.perf_counter()
+        tasks = []
+        for i, update in enumerate(updates):
+            delay = t_start+i/rate-time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.create_task(post(update)))
+        await asyncio.gather(*tasks)
+        try:
+            await asyncio.wait_for(all_replied.wait(), timeout=60)
+        except asyncio.TimeoutError:
+            print(f'timed out waiting for replies, got {n_replies} of {expected}')
+        elapsed = time.perf_counter()-t_start
+
+    await runner.cleanup()
+    await application.stop()
+    await application.post_stop(application)
+    await application.shutdown()
+    await application.post_shutdown(application)
+
+    reply_latencies = []
+    for chat_id, send_times in sent.items():
+        for send_time, reply_time in zip(send_times, replies.get(chat_id, [])):
+            reply_latencies.append(reply_time-send_time)
+    return {
+        'updates': len(updates),
+        'replies': n_replies,
+        'seconds': elapsed,
+        'throughput': n_replies/elapsed,
+        'accept p50 ms': 1000*percentile(accept_times, 50),
+        'accept p99 ms': 1000*percentile(accept_times, 99),
+        'reply p50 s': percentile(reply_latencies, 50),
+        'reply p95 s': percentile(reply_latencies, 95),
+        'reply p99 s': percentile(reply_latencies, 99),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rate', type=float, default=50, help='target rate of updates per second')
+    parser.add_argument('--updates', type=int, default=500, help='number of synthetic updates')
+    parser.add_argument('--users', type=int, default=100, help='number of synthetic users')
+    parser.add_argument('--recorded', help='JSON lines file of recorded Update payloads to replay instead of synthetic ones')
+    parser.add_argument('--openai-latency', type=float, default=0.3, help='mock OpenAI latency in seconds')
+    parser.add_argument('--telegram-latency', type=float, default=0.02, help='mock Telegram latency in seconds')
+    args = parser.parse_args()
+
+    if args.recorded:
+        with open(args.recorded, encoding='utf-8') as file:
+            updates = [json.loads(line) for line in file if line.strip()]
+        updates = [update for update in updates if 'message' in update]
+    else:
+        updates = synthetic_updates(args.updates, args.users)
+    chatbot.stream_responses = False  # one sendMessage per reply, which marks the end of the reply
+    chatbot.openai_requests_per_minute, chatbot.openai_tokens_per_minute = {}, {}  # the mock server has no rate limits
+    chatbot.coalesce_window, chatbot.cancel_superseded_replies = None, False  # one reply per update, as the updates of a user arrive at once
+
+    with MockOpenAIServer(latency=args.openai_latency, token_delay=0) as openai_server, MockTelegramServer(latency=args.telegram_latency) as telegram, tempfile.TemporaryDirectory() as workdir:
+        result = asyncio.run(replay(updates, args.rate, telegram, openai_server.base_url, os.path.join(workdir, 'conversations.sqlite'), 'benchmark-secret'))
+    for key, value in result.items():
+        print(f'{key:>14}: {value:.3f}' if isinstance(value, float) else f'{key:>14}: {value}')
+
+
+if __name__ == '__main__':
+    main()
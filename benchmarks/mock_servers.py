@@ -0,0 +1,577 @@
+'''
+Local stand-ins for the remote APIs used by the chatbot, for benchmarking without network access or API costs.
+The servers only use the standard library and run in a background thread, so a benchmark can start them
+in-process and point the real clients at them through their base URL.
+'''
+
+import email.parser, email.policy, json, random, threading, time, uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+
+class MockOpenAIServer:
+    '''
+    A minimal OpenAI-compatible HTTP server.
+    Every chat completion request is answered after a fixed artificial latency, which stands in for generation time.
+    Streaming requests get the first chunk after the same latency, then one word per chunk every token_delay seconds;
+    non-streaming requests wait for the whole simulated generation before the response is sent.
+    Audio transcription requests are answered with a fixed transcript after the same latency.
+    With requests_per_minute or tokens_per_minute, completion requests are rate limited like the OpenAI API:
+    the limits refill continuously, up to limit_burst_seconds worth of them, requests over the limit get a 429
+    with a retry-after-ms header, and every response has the x-ratelimit-* headers.
+    Every completion request body is passed to the on_request callback if one is set (called from a server thread).
+    Completion latencies can differ by model, and completion requests to failing_models get a 500 error, like an outage.
+    With error_rate, that fraction of the completion and transcription requests, picked at random, get a 500 error.
+    Requests whose client closed the connection before the response was sent are counted in requests_disconnected.
+    The Batch API is served too: uploaded files are kept in memory, and a batch of chat completion requests ends
+    batch_latency seconds after it was created, with an output file of completions and an error file of the requests
+    failed by error_rate. Batch requests don't count against the rate limits, and are counted in batch_requests_served.
+
+    Args:
+    latency (float): seconds to wait before answering each completion request, defaults to 0.5
+    reply (str): the assistant message content returned by every completion, defaults to a short fixed text
+    transcript (str): the text returned by every audio transcription, defaults to a short fixed text
+    token_delay (float): seconds between streamed chunks, defaults to 0.02
+    host (str): the interface to bind, defaults to '127.0.0.1'
+    port (int): the port to bind, defaults to 0 (any free port)
+    requests_per_minute (int): the completion requests allowed per minute, defaults to None (unlimited)
+    tokens_per_minute (int): the prompt and completion tokens allowed per minute, estimated at 4 characters per token, defaults to None (unlimited)
+    limit_burst_seconds (float): the seconds' worth of the limits that can be used at once, defaults to 10
+    model_latency (dict): completion latency in seconds by model, for models whose latency differs from latency, defaults to None
+    failing_models (set): models whose completion requests fail with a 500 error, defaults to none; can be changed while running
+    error_rate (float): the fraction of requests that fail with a 500 error, defaults to 0
+    seed (int): the seed of the random errors, defaults to 0
+    batch_latency (float): seconds from the creation of a batch until it is completed, defaults to 2
+    '''
+    def __init__(self, latency:float=0.5, reply:str='This is a mock reply.', transcript:str='This is a mock transcript.', token_delay:float=0.02, host:str='127.0.0.1', port:int=0,
+            requests_per_minute:int=None, tokens_per_minute:int=None, limit_burst_seconds:float=10, model_latency:dict=None, failing_models:set=(),
+            error_rate:float=0, seed:int=0, batch_latency:float=2):
+        self.latency = latency
+        self.reply = reply
+        self.transcript = transcript
+        self.token_delay = token_delay
+        self.requests_served = 0
+        self.requests_rate_limited = 0
+        self.on_request = None
+        self.model_latency = dict(model_latency or {})
+        self.failing_models = set(failing_models)
+        self.error_rate = error_rate
+        self.requests_failed = 0
+        self.requests_disconnected = 0
+        self.batch_latency = batch_latency
+        self.batch_requests_served = 0
+        self.files = {}  # file_id -> (filename, purpose, content bytes)
+        self.batches = {}  # batch_id -> batch object
+        self._random = random.Random(seed)
+        self.limits = {'requests': requests_per_minute, 'tokens': tokens_per_minute}
+        self.limit_burst_seconds = limit_burst_seconds
+        self._levels = {kind: (None if limit is None else limit*limit_burst_seconds/60) for kind, limit in self.limits.items()}
+        self._levels_updated = time.monotonic()
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._make_handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}/v1'
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _check_rate_limits(self, request:dict):
+        '''
+        Takes a request from the rate limits. Returns None if it is within the limits, or the seconds to wait otherwise,
+        and the x-ratelimit-* headers either way.
+        '''
+        costs = {'requests': 1, 'tokens': len(json.dumps(request.get('messages', [])))//4+len(self.reply.split(' '))}
+        with self._lock:
+            now = time.monotonic()
+            retry_after = None
+            for kind, limit in self.limits.items():
+                if limit is None:
+                    continue
+                capacity = limit*self.limit_burst_seconds/60
+                self._levels[kind] = min(capacity, self._levels[kind]+(now-self._levels_updated)*limit/60)
+                missing = min(costs[kind], capacity)-self._levels[kind]
+                if missing > 0:
+                    retry_after = max(retry_after or 0, missing*60/limit)
+            self._levels_updated = now
+            if retry_after is None:
+                for kind, limit in self.limits.items():
+                    if limit is not None:
+                        self._levels[kind] -= min(costs[kind], limit*self.limit_burst_seconds/60)
+            else:
+                self.requests_rate_limited += 1
+            headers = {}
+            for kind, limit in self.limits.items():
+                if limit is not None:
+                    headers[f'x-ratelimit-limit-{kind}'] = str(limit)
+                    headers[f'x-ratelimit-remaining-{kind}'] = str(max(0, int(self._levels[kind])))
+                    headers[f'x-ratelimit-reset-{kind}'] = f'{int((limit*self.limit_burst_seconds/60-self._levels[kind])*60000/limit)}ms'
+        return retry_after, headers
+
+    def _count_request(self):
+        with self._lock:
+            self.requests_served += 1
+
+    def _inject_error(self) -> bool:
+        with self._lock:
+            failed = self.error_rate > 0 and self._random.random() < self.error_rate
+            self.requests_failed += failed
+        return failed
+
+    def _add_file(self, filename:str, purpose:str, content:bytes) -> dict:
+        file_id = f'file-{uuid.uuid4().hex}'
+        with self._lock:
+            self.files[file_id] = (filename, purpose, content)
+        return {'id': file_id, 'object': 'file', 'bytes': len(content), 'created_at': int(time.time()), 'filename': filename, 'purpose': purpose, 'status': 'processed'}
+
+    def _create_batch(self, request:dict) -> dict:
+        if request.get('input_file_id') not in self.files:
+            return None
+        now = int(time.time())
+        batch = {'id': f'batch_{uuid.uuid4().hex}', 'object': 'batch', 'endpoint': request.get('endpoint'), 'input_file_id': request['input_file_id'],
+                 'completion_window': request.get('completion_window', '24h'), 'status': 'validating', 'created_at': now, 'expires_at': now+86400,
+                 'output_file_id': None, 'error_file_id': None, 'metadata': request.get('metadata'),
+                 'request_counts': {'total': 0, 'completed': 0, 'failed': 0}, '_due': time.monotonic()+self.batch_latency}
+        with self._lock:
+            self.batches[batch['id']] = batch
+        return batch
+
+    def _update_batch(self, batch:dict) -> None:
+        '''
+        Moves a batch on to in_progress, and runs its requests once it is due, writing its output and error files.
+        '''
+        with self._lock:
+            if batch['status'] in ('finalizing', 'completed'):
+                return
+            if time.monotonic() < batch['_due']:
+                batch['status'] = 'in_progress'
+                return
+            batch['status'] = 'finalizing'  # other threads polling it meanwhile see it unfinished
+            lines = self.files[batch['input_file_id']][2].decode('utf-8').splitlines()
+        outputs, errors = [], []
+        for line in filter(None, lines):
+            request = json.loads(line)
+            record = {'id': f'batch_req_{uuid.uuid4().hex}', 'custom_id': request['custom_id'], 'error': None}
+            if self._inject_error():
+                record['response'] = {'status_code': 500, 'request_id': uuid.uuid4().hex, 'body': {'error': {'message': 'The server had an error while processing your request.', 'type': 'server_error'}}}
+                errors.append(record)
+            else:
+                record['response'] = {'status_code': 200, 'request_id': uuid.uuid4().hex, 'body': self.completion_payload(request['body'])}
+                outputs.append(record)
+        to_jsonl = lambda records: '\n'.join(json.dumps(record) for record in records).encode('utf-8')
+        output_file_id = self._add_file('batch_output.jsonl', 'batch_output', to_jsonl(outputs))['id'] if outputs else None
+        error_file_id = self._add_file('batch_errors.jsonl', 'batch_output', to_jsonl(errors))['id'] if errors else None
+        with self._lock:
+            self.batch_requests_served += len(outputs)
+            batch.update({'status': 'completed', 'completed_at': int(time.time()), 'output_file_id': output_file_id, 'error_file_id': error_file_id,
+                          'request_counts': {'total': len(outputs)+len(errors), 'completed': len(outputs), 'failed': len(errors)}})
+
+    def _make_handler(self):
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                pass  # keep benchmark output clean
+
+            def handle(self):
+                try:
+                    super().handle()
+                except (BrokenPipeError, ConnectionResetError):
+                    # the client closed the connection, e.g. it cancelled a reply being generated
+                    with mock._lock:
+                        mock.requests_disconnected += 1
+
+            def _read_json(self) -> dict:
+                length = int(self.headers.get('Content-Length', 0))
+                body = self.rfile.read(length) if length else b''
+                try:
+                    return json.loads(body or b'{}')
+                except ValueError:
+                    return {}
+
+            def _send_json(self, status:int, payload:dict, headers:dict=None):
+                data = json.dumps(payload).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _send_bytes(self, data:bytes, content_type:str='application/octet-stream'):
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _read_form(self) -> dict:
+                # the multipart/form-data fields, by name, as (filename, bytes)
+                length = int(self.headers.get('Content-Length', 0))
+                body = self.rfile.read(length)
+                message = email.parser.BytesParser(policy=email.policy.default).parsebytes(
+                    b'Content-Type: '+self.headers.get('Content-Type', '').encode('latin-1')+b'\r\n\r\n'+body)
+                return {part.get_param('name', header='content-disposition'): (part.get_filename(), part.get_payload(decode=True))
+                        for part in message.iter_parts()}
+
+            def _send_event_stream(self, events, headers:dict=None):
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/event-stream')
+                self.send_header('Transfer-Encoding', 'chunked')
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                self.end_headers()
+                for event in events:
+                    data = f'data: {event}\n\n'.encode('utf-8')
+                    self.wfile.write(f'{len(data):x}\r\n'.encode('ascii') + data + b'\r\n')
+                    self.wfile.flush()
+                self.wfile.write(b'0\r\n\r\n')
+
+            def do_POST(self):
+                if self.path.rstrip('/').endswith('/chat/completions'):
+                    request = self._read_json()
+                    if mock.on_request is not None:
+                        mock.on_request(request)
+                    retry_after, headers = mock._check_rate_limits(request)
+                    if retry_after is not None:
+                        headers['retry-after-ms'] = str(int(retry_after*1000)+1)
+                        error = {'message': 'Rate limit reached. Please try again later.', 'type': 'requests', 'code': 'rate_limit_exceeded'}
+                        self._send_json(429, {'error': error}, headers)
+                        return
+                    if request.get('model') in mock.failing_models or mock._inject_error():
+                        self._send_json(500, {'error': {'message': 'The server had an error while processing your request.', 'type': 'server_error'}}, headers)
+                        return
+                    time.sleep(mock.model_latency.get(request.get('model'), mock.latency))
+                    mock._count_request()
+                    if request.get('stream'):
+                        self._send_event_stream(mock.completion_chunks(request), headers)
+                    else:
+                        time.sleep(mock.token_delay*(len(mock.reply.split(' '))-1))
+                        self._send_json(200, mock.completion_payload(request), headers)
+                elif self.path.rstrip('/').endswith('/audio/transcriptions'):
+                    length = int(self.headers.get('Content-Length', 0))
+                    self.rfile.read(length)
+                    time.sleep(mock.latency)
+                    if mock._inject_error():
+                        self._send_json(500, {'error': {'message': 'The server had an error while processing your request.', 'type': 'server_error'}})
+                        return
+                    mock._count_request()
+                    self._send_json(200, {'text': mock.transcript})
+                elif self.path.rstrip('/').endswith('/files'):
+                    form = self._read_form()
+                    filename, content = form.get('file', (None, None))
+                    if content is None:
+                        self._send_json(400, {'error': {'message': 'missing file', 'type': 'invalid_request_error'}})
+                        return
+                    self._send_json(200, mock._add_file(filename or 'file', form.get('purpose', (None, b''))[1].decode(), content))
+                elif self.path.rstrip('/').endswith('/batches'):
+                    batch = mock._create_batch(self._read_json())
+                    if batch is None:
+                        self._send_json(400, {'error': {'message': 'unknown input_file_id', 'type': 'invalid_request_error'}})
+                        return
+                    self._send_json(200, {key: value for key, value in batch.items() if not key.startswith('_')})
+                else:
+                    self._send_json(404, {'error': {'message': f'unknown path {self.path}', 'type': 'invalid_request_error'}})
+
+            def do_GET(self):
+                parts = self.path.split('?')[0].rstrip('/').split('/')
+                if len(parts) >= 2 and parts[-2] == 'batches' and parts[-1] in mock.batches:
+                    batch = mock.batches[parts[-1]]
+                    mock._update_batch(batch)
+                    self._send_json(200, {key: value for key, value in batch.items() if not key.startswith('_')})
+                elif len(parts) >= 3 and parts[-3] == 'files' and parts[-1] == 'content' and parts[-2] in mock.files:
+                    self._send_bytes(mock.files[parts[-2]][2])
+                else:
+                    self._send_json(404, {'error': {'message': f'unknown path {self.path}', 'type': 'invalid_request_error'}})
+
+        return Handler
+
+    def completion_payload(self, request:dict) -> dict:
+        '''
+        Builds a chat completion response body in the OpenAI format.
+        '''
+        return {
+            'id': f'chatcmpl-{uuid.uuid4().hex}',
+            'object': 'chat.completion',
+            'created': int(time.time()),
+            'model': request.get('model', 'mock'),
+            'choices': [{
+                'index': 0,
+                'message': {'role': 'assistant', 'content': self.reply},
+                'finish_reason': 'stop',
+            }],
+            'usage': {'prompt_tokens': 10, 'completion_tokens': 5, 'total_tokens': 15},
+        }
+
+    def completion_chunks(self, request:dict):
+        '''
+        Yields the server-sent events of a streamed chat completion in the OpenAI format, one word per chunk.
+        '''
+        completion_id = f'chatcmpl-{uuid.uuid4().hex}'
+        words = self.reply.split(' ')
+        for i, word in enumerate(words):
+            if i > 0:
+                time.sleep(self.token_delay)
+            chunk = {
+                'id': completion_id,
+                'object': 'chat.completion.chunk',
+                'created': int(time.time()),
+                'model': request.get('model', 'mock'),
+                'choices': [{
+                    'index': 0,
+                    'delta': {'role': 'assistant', 'content': word if i == 0 else ' '+word},
+                    'finish_reason': None,
+                }],
+            }
+            yield json.dumps(chunk)
+        chunk['choices'] = [{'index': 0, 'delta': {}, 'finish_reason': 'stop'}]
+        yield json.dumps(chunk)
+        if (request.get('stream_options') or {}).get('include_usage'):
+            chunk['choices'] = []
+            chunk['usage'] = {'prompt_tokens': 10, 'completion_tokens': len(words), 'total_tokens': 10+len(words)}
+            yield json.dumps(chunk)
+        yield '[DONE]'
+
+
+def markdown_error(text:str) -> str:
+    '''
+    Returns why Telegram's (legacy) Markdown parse mode would reject a text, or None if it would parse it:
+    an entity (*bold*, _italic_, `code`, ```pre```, [text](url)) that is not closed. Backslash escapes are allowed outside entities.
+    '''
+    i = 0
+    while i < len(text):
+        char = text[i]
+        if char == '\\' and i+1 < len(text) and text[i+1] in '_*`[':
+            i += 2
+            continue
+        if text.startswith('```', i):
+            end = text.find('```', i+3)
+            if end < 0:
+                return f"can't parse entities: can't find end of pre entity at byte offset {i}"
+            i = end+3
+        elif char in '*_`':
+            end = text.find(char, i+1)
+            if end < 0:
+                return f"can't parse entities: can't find end of the entity starting at byte offset {i}"
+            i = end+1
+        elif char == '[':
+            close = text.find('](', i+1)
+            if close < 0 or text.find(')', close) < 0:
+                return f"can't parse entities: can't find end of the entity starting at byte offset {i}"
+            i = text.find(')', close)+1
+        else:
+            i += 1
+    return None
+
+
+class MockTelegramServer:
+    '''
+    A minimal Telegram Bot API server, answering the methods the chatbot uses (getMe, sendMessage, editMessageText,
+    getFile and file downloads, setWebhook, deleteWebhook, sendChatAction) after a fixed artificial latency.
+    Updates added with push_update are served to getUpdates, with long polling, so the bot can run in polling mode.
+    Every accepted call is recorded in the calls list as a dict with the time, method name and parameters,
+    and passed to the on_call callback if one is set (called from a server thread).
+    Like Telegram, messages longer than 4096 characters and Markdown that doesn't parse are rejected with a 400,
+    and with chat_messages_per_second, messages to a chat above that rate are rejected with a 429 and a retry_after.
+    With error_rate, that fraction of the messages, picked at random, are rejected with a 429 as well.
+    The rejections are counted in n_rejected and n_flood_rejected.
+    Pass address as the chatbot's telegram_base_url.
+
+    Args:
+    latency (float): seconds to wait before answering each call, defaults to 0.02
+    host (str): the interface to bind, defaults to '127.0.0.1'
+    port (int): the port to bind, defaults to 0 (any free port)
+    chat_messages_per_second (float): max messages sent or edited per chat and second, defaults to None (unlimited)
+    error_rate (float): the fraction of messages rejected with a 429, defaults to 0
+    seed (int): the seed of the random errors, defaults to 0
+    '''
+    def __init__(self, latency:float=0.02, host:str='127.0.0.1', port:int=0, chat_messages_per_second:float=None, error_rate:float=0, seed:int=0):
+        self.latency = latency
+        self.chat_messages_per_second = chat_messages_per_second
+        self.error_rate = error_rate
+        self._random = random.Random(seed)
+        self._updates = []  # updates not yet confirmed by a getUpdates offset
+        self._updates_changed = threading.Condition()
+        self.n_rejected = 0
+        self.n_flood_rejected = 0
+        self._chat_sends = {}  # chat_id -> times of the messages of the last second
+        self.calls = []
+        self.files = {}  # file_id -> bytes served for downloads
+        self.on_call = None
+        self._lock = threading.Lock()
+        self._message_id = 0
+        self._server = ThreadingHTTPServer((host, port), self._make_handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def address(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _record(self, method:str, params:dict):
+        call = {'time': time.perf_counter(), 'method': method, 'params': params}
+        with self._lock:
+            self.calls.append(call)
+            self._message_id += 1
+            message_id = self._message_id
+        if self.on_call is not None:
+            self.on_call(call)
+        return message_id
+
+    def push_update(self, update:dict) -> None:
+        '''
+        Adds an update (a Telegram Update object as a dict, with an increasing update_id) for getUpdates to serve.
+        '''
+        with self._updates_changed:
+            self._updates.append(update)
+            self._updates_changed.notify_all()
+
+    def _get_updates(self, params:dict) -> list:
+        # like Telegram: an offset confirms the updates before it, and an empty result is held for up to timeout seconds
+        offset = int(params.get('offset') or 0)
+        limit = int(params.get('limit') or 100)
+        deadline = time.monotonic()+float(params.get('timeout') or 0)
+        with self._updates_changed:
+            self._updates = [update for update in self._updates if update['update_id'] >= offset]
+            while not self._updates and time.monotonic() < deadline:
+                self._updates_changed.wait(deadline-time.monotonic())
+            return self._updates[:limit]
+
+    def _check_message(self, method:str, params:dict):
+        # returns (status, description, retry_after) of a rejected sendMessage or editMessageText, or None
+        if self.error_rate > 0:
+            with self._lock:
+                if self._random.random() < self.error_rate:
+                    return 429, 'Too Many Requests: retry after 1', 1
+        text = str(params.get('text', ''))
+        if len(text) > 4096:
+            return 400, 'Bad Request: message is too long', None
+        if params.get('parse_mode') == 'Markdown':
+            error = markdown_error(text)
+            if error is not None:
+                return 400, f'Bad Request: {error}', None
+        if self.chat_messages_per_second is not None:
+            now = time.monotonic()
+            with self._lock:
+                sends = [t for t in self._chat_sends.get(params.get('chat_id'), []) if now-t < 1]
+                if len(sends) >= self.chat_messages_per_second:
+                    return 429, 'Too Many Requests: retry after 1', 1
+                sends.append(now)
+                self._chat_sends[params.get('chat_id')] = sends
+        return None
+
+    def _make_handler(self):
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                pass
+
+            def _read_params(self) -> dict:
+                length = int(self.headers.get('Content-Length', 0))
+                body = self.rfile.read(length) if length else b''
+                content_type = self.headers.get('Content-Type', '')
+                if content_type.startswith('application/json'):
+                    return json.loads(body or b'{}')
+                if content_type.startswith('application/x-www-form-urlencoded'):
+                    params = {}
+                    for key, values in parse_qs(body.decode('utf-8')).items():
+                        try:
+                            params[key] = json.loads(values[0])
+                        except ValueError:
+                            params[key] = values[0]
+                    return params
+                return {}  # multipart uploads are accepted but not parsed
+
+            def _send(self, status:int, data:bytes, content_type:str='application/json'):
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _reply(self, result, status:int=200):
+                self._send(status, json.dumps({'ok': True, 'result': result}).encode('utf-8'))
+
+            def do_GET(self):
+                if self.path.startswith('/file/bot'):
+                    file_id = self.path.rsplit('/', 1)[-1]
+                    time.sleep(mock.latency)
+                    self._send(200, mock.files.get(file_id, b'\0'*4096), 'application/octet-stream')
+                else:
+                    self.do_POST()
+
+            def do_POST(self):
+                method = self.path.rstrip('/').rsplit('/', 1)[-1]
+                params = self._read_params()
+                time.sleep(mock.latency)
+                if method == 'getUpdates':
+                    self._reply(mock._get_updates(params))
+                    return
+                if method in ('sendMessage', 'editMessageText'):
+                    rejection = mock._check_message(method, params)
+                    if rejection is not None:
+                        status, description, retry_after = rejection
+                        with mock._lock:
+                            mock.n_rejected += 1
+                            mock.n_flood_rejected += status == 429
+                        error = {'ok': False, 'error_code': status, 'description': description}
+                        if retry_after is not None:
+                            error['parameters'] = {'retry_after': retry_after}
+                        self._send(status, json.dumps(error).encode('utf-8'))
+                        return
+                message_id = mock._record(method, params)
+                if method == 'getMe':
+                    self._reply({'id': 1, 'is_bot': True, 'first_name': 'mock', 'username': 'mock_bot',
+                                 'can_join_groups': True, 'can_read_all_group_messages': False, 'supports_inline_queries': False})
+                elif method in ('sendMessage', 'editMessageText'):
+                    chat_id = params.get('chat_id', 0)
+                    self._reply({'message_id': params.get('message_id', message_id), 'date': int(time.time()),
+                                 'chat': {'id': chat_id, 'type': 'private'}, 'text': params.get('text', '')})
+                elif method == 'getFile':
+                    file_id = params.get('file_id', 'unknown')
+                    self._reply({'file_id': file_id, 'file_unique_id': file_id, 'file_size': len(mock.files.get(file_id, b'\0'*4096)),
+                                 'file_path': f'files/{file_id}'})
+                elif method in ('setWebhook', 'deleteWebhook', 'sendChatAction', 'setMyCommands'):
+                    self._reply(True)
+                else:
+                    self._send(404, json.dumps({'ok': False, 'error_code': 404, 'description': f'Not Found: method {method}'}).encode('utf-8'))
+
+        return Handler
@@ -0,0 +1,267 @@
+'''
+Offline processing of bulk jobs through the OpenAI Batch API, e.g. summaries of many forwarded documents.
+Jobs are queued in an SQLite file, and submitted together as one batch request file once the oldest of them has waited
+submit_delay seconds (or max_jobs are queued). Submitted batches are polled in the background, and once a batch has ended,
+the result of each of its jobs is delivered to the job's chat and the job is removed.
+Batches are answered within their completion window at a discount, and don't take from the rate limits of the
+interactive requests. Jobs survive restarts: queued jobs are submitted, and the batches of submitted ones polled again.
+'''
+
+import asyncio, json, logging, sqlite3, time, uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Awaitable, Callable, List, Optional, Tuple
+
+import openai
+from openai.types.chat import ChatCompletion
+
+import metrics
+from metrics import log_event
+
+
+batch_endpoint = '/v1/chat/completions'
+ended_statuses = ('completed', 'failed', 'expired', 'cancelled')
+
+
+class SQLiteBatchStore:
+    '''
+    Stores batch jobs in an SQLite database file, one row per job, with the ID of its batch once it was submitted.
+    A job is a dict with the keys 'job_id', 'chat_id', 'user_id', 'title' and 'body' (the chat completion request body).
+    The methods are blocking; BatchProcessor calls them from a single background thread.
+
+    Args:
+    filename (str): the path of the database file, created if it doesn't exist
+    '''
+    def __init__(self, filename:str):
+        self.filename = filename
+        # the connection is used from the store thread of BatchProcessor only, not from the thread that creates it
+        self.connection = sqlite3.connect(filename, timeout=30, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS batch_jobs (job_id TEXT PRIMARY KEY, chat_id INTEGER NOT NULL, user_id TEXT NOT NULL, '
+                                'title TEXT NOT NULL, body TEXT NOT NULL, batch_id TEXT, created REAL NOT NULL)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS batch_jobs_batch_id ON batch_jobs (batch_id)')
+        self.connection.commit()
+
+    @staticmethod
+    def _to_job(row:tuple) -> dict:
+        return {'job_id': row[0], 'chat_id': row[1], 'user_id': row[2], 'title': row[3], 'body': json.loads(row[4])}
+
+    def add(self, job:dict) -> None:
+        with self.connection:
+            self.connection.execute('INSERT INTO batch_jobs (job_id, chat_id, user_id, title, body, batch_id, created) VALUES (?, ?, ?, ?, ?, NULL, ?)',
+                                    (job['job_id'], job['chat_id'], job['user_id'], job['title'], json.dumps(job['body'], ensure_ascii=False), time.time()))
+
+    def pending(self, limit:int) -> List[dict]:
+        '''
+        Returns the oldest jobs not submitted yet, at most limit of them.
+        '''
+        rows = self.connection.execute('SELECT job_id, chat_id, user_id, title, body FROM batch_jobs WHERE batch_id IS NULL ORDER BY created LIMIT ?', (limit,))
+        return [self._to_job(row) for row in rows]
+
+    def pending_stats(self) -> Tuple[int, Optional[float]]:
+        '''
+        Returns the number of jobs not submitted yet, and the time the oldest of them was queued (None if there are none).
+        '''
+        return self.connection.execute('SELECT COUNT(*), MIN(created) FROM batch_jobs WHERE batch_id IS NULL').fetchone()
+
+    def count_for(self, user_id:str) -> int:
+        '''
+        Returns the number of jobs of a user whose results were not delivered yet.
+        '''
+        return self.connection.execute('SELECT COUNT(*) FROM batch_jobs WHERE user_id = ?', (user_id,)).fetchone()[0]
+
+    def assign(self, job_ids:List[str], batch_id:str) -> None:
+        with self.connection:
+            self.connection.executemany('UPDATE batch_jobs SET batch_id = ? WHERE job_id = ?', [(batch_id, job_id) for job_id in job_ids])
+
+    def batch_ids(self) -> List[str]:
+        '''
+        Returns the IDs of the submitted batches with jobs whose results were not delivered yet.
+        '''
+        return [row[0] for row in self.connection.execute('SELECT DISTINCT batch_id FROM batch_jobs WHERE batch_id IS NOT NULL')]
+
+    def jobs_of(self, batch_id:str) -> List[dict]:
+        rows = self.connection.execute('SELECT job_id, chat_id, user_id, title, body FROM batch_jobs WHERE batch_id = ? ORDER BY created', (batch_id,))
+        return [self._to_job(row) for row in rows]
+
+    def delete(self, job_ids:List[str]) -> None:
+        with self.connection:
+            self.connection.executemany('DELETE FROM batch_jobs WHERE job_id = ?', [(job_id,) for job_id in job_ids])
+
+    def close(self) -> None:
+        self.connection.close()
+
+
+def read_batch_results(text:str) -> dict:
+    '''
+    Reads a batch output or error file (JSON lines) into a dict of the results by custom ID:
+    (completion, None) for a completed request, and (None, error message) for a failed one.
+    '''
+    results = {}
+    for line in text.splitlines():
+        if not line.strip():
+            continue
+        record = json.loads(line)
+        response = record.get('response') or {}
+        if response.get('status_code') == 200:
+            results[record['custom_id']] = (ChatCompletion.model_validate(response['body']), None)
+        else:
+            error = record.get('error') or (response.get('body') or {}).get('error') or {}
+            results[record['custom_id']] = (None, error.get('message') or f'status {response.get("status_code")}')
+    return results
+
+
+class BatchProcessor:
+    '''
+    Queues chat completion jobs, submits them as OpenAI batches and delivers their results, in a background task
+    that checks every poll_interval seconds. A batch that fails to be submitted is retried at the next check,
+    and a result that fails to be delivered (deliver raises) is delivered again at the next check.
+
+    Args:
+    client (openai.AsyncOpenAI): the OpenAI client
+    store (SQLiteBatchStore): the persistence of the jobs
+    deliver (Callable[[dict, str, str], Awaitable]): sends the result of a job to its chat, called with the job
+        and either the response text or an error message (the other being None)
+    submit_delay (float): seconds the oldest queued job waits for more jobs before they are submitted, defaults to 60
+    max_jobs (int): max number of jobs per batch; as many jobs are submitted without waiting, defaults to 1000
+    poll_interval (float): seconds between checks of the queued jobs and the submitted batches, defaults to 30
+    completion_window (str): the time the batches are to be completed in, defaults to '24h'
+    on_usage (Callable[[str, object], None]): called with the model and the token usage of each completed job, defaults to None
+    '''
+    def __init__(self, client:openai.AsyncOpenAI, store:SQLiteBatchStore, deliver:Callable[[dict, str, str], Awaitable],
+                 submit_delay:float=60, max_jobs:int=1000, poll_interval:float=30, completion_window:str='24h', on_usage:Callable[[str, object], None]=None):
+        self.client = client
+        self.store = store
+        self.deliver = deliver
+        self.submit_delay = submit_delay
+        self.max_jobs = max_jobs
+        self.poll_interval = poll_interval
+        self.completion_window = completion_window
+        self.on_usage = on_usage
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='batch_store')
+        self._runner = None
+
+    async def _run_in_store_thread(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    async def add(self, chat_id:int, user_id:str, title:str, body:dict) -> int:
+        '''
+        Queues a job, to be submitted with the next batch.
+
+        Args:
+        chat_id (int): the chat the result is sent to
+        user_id (str): the user the job belongs to
+        title (str): a short description of the job, e.g. the file name, sent with its result
+        body (dict): the chat completion request, with the keys 'model' and 'messages' and optional parameters
+
+        Returns:
+        n_jobs (int): the number of jobs of the user waiting for their results, including this one
+        '''
+        job = {'job_id': f'job-{uuid.uuid4().hex}', 'chat_id': chat_id, 'user_id': user_id, 'title': title, 'body': body}
+        await self._run_in_store_thread(self.store.add, job)
+        metrics.batch_jobs_total.inc(result='queued')
+        log_event('batch job queued', job_id=job['job_id'], user_id=user_id, model=body.get('model'))
+        return await self.count_for(user_id)
+
+    async def count_for(self, user_id:str) -> int:
+        '''
+        Returns the number of jobs of a user waiting for their results.
+        '''
+        return await self._run_in_store_thread(self.store.count_for, user_id)
+
+    async def submit_pending(self) -> Optional[str]:
+        '''
+        Uploads the oldest queued jobs, at most max_jobs of them, as a batch request file and creates a batch for it.
+
+        Returns:
+        batch_id (str): the ID of the new batch, or None if no jobs are queued or the submission failed
+        '''
+        jobs = await self._run_in_store_thread(self.store.pending, self.max_jobs)
+        if not jobs:
+            return None
+        lines = [json.dumps({'custom_id': job['job_id'], 'method': 'POST', 'url': batch_endpoint, 'body': job['body']}, ensure_ascii=False) for job in jobs]
+        try:
+            batch_file = await self.client.files.create(file=('batch_jobs.jsonl', '\n'.join(lines).encode('utf-8')), purpose='batch')
+            batch = await self.client.batches.create(input_file_id=batch_file.id, endpoint=batch_endpoint, completion_window=self.completion_window)
+        except openai.OpenAIError as e:
+            metrics.batches_total.inc(status='submit_error')
+            log_event('error submitting batch, will retry', level=logging.WARNING, n_jobs=len(jobs), error_type=type(e).__name__, error=str(e))
+            return None
+        await self._run_in_store_thread(self.store.assign, [job['job_id'] for job in jobs], batch.id)
+        metrics.batches_total.inc(status='submitted')
+        log_event('batch submitted', batch_id=batch.id, n_jobs=len(jobs))
+        return batch.id
+
+    async def check_batch(self, batch_id:str) -> bool:
+        '''
+        Checks a submitted batch, and once it has ended, delivers the results of its jobs and removes them.
+        Jobs without a result, e.g. of a batch that expired or failed, are delivered as failed.
+
+        Returns:
+        ended (bool): True if the batch has ended
+        '''
+        batch = await self.client.batches.retrieve(batch_id)
+        if batch.status not in ended_statuses:
+            return False
+        results = {}
+        for file_id in (batch.output_file_id, batch.error_file_id):
+            if file_id:
+                content = await self.client.files.content(file_id)
+                results.update(read_batch_results(content.text))
+        jobs = await self._run_in_store_thread(self.store.jobs_of, batch_id)
+        delivered, n_failed = [], 0
+        for job in jobs:
+            completion, error = results.get(job['job_id'], (None, f'the batch {batch.status}'))
+            text = completion.choices[0].message.content if completion is not None else None
+            try:
+                await self.deliver(job, text, error)
+            except Exception as e:
+                log_event('error delivering batch result, will retry', level=logging.WARNING, job_id=job['job_id'], error=str(e))
+                continue
+            delivered.append(job['job_id'])
+            n_failed += completion is None
+            metrics.batch_jobs_total.inc(result='failed' if completion is None else 'completed')
+            if completion is not None and self.on_usage is not None:
+                self.on_usage(job['body']['model'], completion.usage)
+        await self._run_in_store_thread(self.store.delete, delivered)
+        log_event('batch ended', batch_id=batch_id, status=batch.status, n_delivered=len(delivered), n_failed=n_failed, n_undelivered=len(jobs)-len(delivered))
+        if len(delivered) == len(jobs):
+            metrics.batches_total.inc(status=batch.status)
+        return True
+
+    async def run_once(self) -> None:
+        '''
+        Submits the queued jobs if they are due, and checks the submitted batches.
+        '''
+        n_pending, oldest = await self._run_in_store_thread(self.store.pending_stats)
+        if n_pending and (n_pending >= self.max_jobs or time.time()-oldest >= self.submit_delay):
+            await self.submit_pending()
+        for batch_id in await self._run_in_store_thread(self.store.batch_ids):
+            try:
+                await self.check_batch(batch_id)
+            except openai.OpenAIError as e:
+                log_event('error checking batch, will retry', level=logging.WARNING, batch_id=batch_id, error_type=type(e).__name__, error=str(e))
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await self.run_once()
+            except Exception as e:
+                log_event('error processing batches', level=logging.ERROR, exc_info=e, error_type=type(e).__name__, error=str(e))
+            await asyncio.sleep(self.poll_interval)
+
+    def start(self) -> None:
+        '''
+        Starts the background task that submits the jobs and checks the batches every poll_interval seconds.
+        '''
+        if self._runner is None:
+            self._runner = asyncio.create_task(self._run())
+
+    async def close(self) -> None:
+        '''
+        Stops the background task and closes the store. Queued and submitted jobs are kept for the next start.
+        '''
+        if self._runner is not None:
+            self._runner.cancel()
+            self._runner = None
+        await self._run_in_store_thread(self.store.close)
+        self._executor.shutdown(wait=True)
@@ -12,86 +12,288 @@ See the README.md file for more information on how to set up the API keys and to
 default_gpt_model = 'gpt-4o'  # as of May 2024, the most capable LLM in the world + vision capabilities
 temperature = 0.5  # set to higher for more creative responses or lower for more deterministic output
 api_retry_time = 60 # max time to retry the OpenAI API in case of timeout
+max_concurrent_api_requests = 16  # max number of OpenAI requests in flight at once, shared by all chats
+openai_requests_per_minute = {'gpt-4o': 500, 'gpt-4o-mini': 500, 'whisper-1': 50}  # your OpenAI tier's request limits per model; corrected from the API's rate limit headers
+openai_tokens_per_minute = {'gpt-4o': 30000, 'gpt-4o-mini': 200000}  # your OpenAI tier's token limits per model; corrected from the API's rate limit headers
+rate_limit_burst_seconds = 5  # seconds' worth of the per-minute limits that may be sent at once after idle time
+expected_completion_tokens = 500  # tokens reserved for each response when pacing requests, until its actual usage is known
+routing_policy = 'heuristic'  # 'heuristic' sends each chat request to the model of its route in model_routes; 'fixed' sends all of them to default_gpt_model
+model_routes = {'light': 'gpt-4o-mini', 'standard': 'gpt-4o', 'documents': 'gpt-4o', 'vision': 'gpt-4o'}  # model per route; 'light' is acknowledgements and short, simple messages
+fallback_models = {'gpt-4o': 'gpt-4o-mini', 'gpt-4o-mini': 'gpt-4o'}  # model a request switches to when its model fails with a retryable error or is held back by its rate limits
+fallback_wait_seconds = 5  # a request goes to the fallback model if its model's rate limits would hold it longer than this
+light_max_message_tokens = 40  # max tokens of a message on the light route
+light_max_prompt_tokens = 4000  # max prompt tokens of a request on the light route
+light_max_depth = 20  # max number of messages in the conversation (besides the system message and summary) for the light route
+model_prices = {'gpt-4o': (5.0, 15.0), 'gpt-4o-mini': (0.15, 0.6), 'gpt-4-turbo': (10.0, 30.0), 'gpt-3.5-turbo': (0.5, 1.5)}  # USD per million prompt and completion tokens (mid 2024), for the cost metrics
+max_concurrent_updates = 64  # max number of Telegram updates processed concurrently
+stream_responses = True  # show the response while it is being generated, by editing the reply message in place
+stream_edit_interval = 1.5  # min seconds between edits of a streamed reply, keeps well below Telegram's flood limits
+conversation_token_budgets = {'gpt-4o': 16000, 'gpt-4o-mini': 16000, 'gpt-4-turbo': 16000, 'gpt-3.5-turbo': 12000}  # max prompt tokens per model; older turns are dropped to fit
+default_conversation_token_budget = 8000  # max prompt tokens for models not listed above
+summary_gpt_model = 'gpt-4o-mini'  # cheaper model used to compact old turns into a summary, in the background
+summarize_at_budget_fraction = 0.6  # start compacting old turns when the prompt exceeds this fraction of the token budget
+summary_keep_recent_fraction = 0.3  # fraction of the token budget kept as recent verbatim turns when compacting
+summary_cache_size = 1000  # max number of cached segment summaries
+inline_document_tokens = 2000  # attached files up to this many tokens are added to the conversation whole; larger ones are indexed
+document_chunk_tokens = 400  # size of the chunks larger attached files are split into
+document_context_tokens = 3000  # max tokens of document chunks sent with each message, the chunks most relevant to it
+max_document_chunks = 15000  # max chunks indexed per chat (enough for a file at Telegram's 20 MB download limit), the oldest documents are dropped first
+max_cached_document_chunks = 30000  # max chunks indexed for all chats together (about 10 kB of memory each), the least recently used chats' indexes are dropped first
+default_image_detail = 'low'  # vision detail of photos, 'low' (85 tokens) or 'high' (up to 765 tokens); captions asking to read text or fine detail always get 'high'
+image_cache_bytes = 64*1024*1024  # max size of the photos kept in memory, to attach them again when a later message refers to them
+max_pending_jobs_per_user = 5  # max number of a user's messages waiting or being processed, further messages get a busy reply
+max_pending_jobs = 1000  # max number of messages waiting or being processed for all users together
+media_workers = 4  # size of the worker pool for blocking media work (e.g. decoding files)
+media_worker_processes = False  # use worker processes instead of threads for media work
+busy_message = 'I am still busy with your previous messages. Please wait for my reply and send this message again.'
+conversation_store_file = './files/conversations.sqlite'  # SQLite file where conversations are persisted across restarts
+conversation_flush_interval = 5  # seconds between batched writes of changed conversations to the store
+max_cached_conversations = 1000  # max number of conversations kept in memory, the least recently active users are evicted first
+run_mode = 'polling'  # 'polling' to poll Telegram for updates, or 'webhook' to receive them on an HTTP server
+webhook_url = ''  # the public HTTPS URL Telegram sends updates to in webhook mode, e.g. 'https://example.com/telegram'
+webhook_listen = '0.0.0.0'  # the interface the webhook server listens on
+webhook_port = 8080  # the port the webhook server listens on, behind your HTTPS reverse proxy or load balancer
+webhook_path = '/telegram'  # the URL path the webhook server receives updates on
+register_webhook = True  # set the webhook with Telegram on startup; disable it on the nodes listed in another node's shard_node_urls
+shard_workers = 1  # in webhook mode, number of worker processes to shard chats across by user ID; 1 runs everything in one process
+shard_node_urls = []  # in webhook mode, webhook URLs of other bot nodes to shard chats across instead of local worker processes
+shared_state_file = './files/shared_state.sqlite'  # SQLite file with the counters shared by the worker processes
+telegram_connection_pool_size = 64  # keep-alive connections kept open for outgoing Bot API calls
+telegram_pool_timeout = 10  # seconds to wait for a free connection from the pool
+telegram_messages_per_second = 30  # max messages sent per second over all chats, Telegram's limit for bots
+enable_response_cache = False  # reuse responses to identical requests (same history, new message, model and temperature), e.g. FAQ-style questions
+response_cache_size = 1000  # max number of cached responses
+response_cache_ttl = 3600  # seconds a cached response stays valid
+response_cache_max_temperature = 0.7  # requests with a higher temperature are never answered from the cache
+voice_transcode_format = None  # None uploads Telegram's ogg/opus voice notes as is (Whisper accepts them); set to e.g. 'mp3' to transcode with ffmpeg first
+metrics_port = 9090  # port of the Prometheus /metrics endpoint in polling mode (in webhook mode it's served by the webhook server); None disables it
+metrics_listen = '127.0.0.1'  # the interface the /metrics endpoint listens on in polling mode
+coalesce_window = 1.0  # seconds to wait for more messages of a user before answering, so a burst of quick messages gets one reply; 0 doesn't wait, None answers each message on its own
+cancel_superseded_replies = True  # stop generating a reply when the user sends another message, and answer both messages together; ignored when coalesce_window is None
+batch_store_file = './files/batch_jobs.sqlite'  # SQLite file where /batch jobs are kept until their results are sent, across restarts
+batch_gpt_model = None  # model of /batch jobs; None uses the model of the 'documents' route
+batch_instructions = {'document': 'Summarize this document.', 'voice': 'Summarize this voice note.'}  # the request of a /batch job whose message has no caption
+batch_document_tokens = 50000  # max tokens of a document sent with a /batch job, longer documents are cut
+batch_submit_delay = 60  # seconds queued /batch jobs wait for more jobs before they are submitted together as one batch
+batch_max_jobs = 1000  # max number of jobs per batch; as many queued jobs are submitted without waiting
+batch_poll_interval = 30  # seconds between checks of the submitted batches
+batch_completion_window = '24h'  # the time the Batch API has to complete a batch, the only window it offers as of mid 2024
+batch_price_discount = 0.5  # the Batch API's discount on model_prices, for the cost metrics
+settings_file = './files/settings.json'  # optional JSON file overriding default_gpt_model ('model'), temperature and model_routes, reloaded when changed
+config_poll_interval = 2  # seconds between checks of the allowed IDs, system prompt and settings files; changes apply without a restart
 
 
 ### Imports ###
 ###############
-import os, time
-from typing import Tuple
-from telegram import Update
-from telegram.ext import ApplicationBuilder, CommandHandler, MessageHandler, ContextTypes, filters
+import os, time, asyncio, contextlib, hashlib, itertools, json, logging, re, secrets
+from collections import OrderedDict
+from typing import Tuple, AsyncIterator
+from telegram import Update, error as telegram_error
+from telegram.ext import Application, ApplicationBuilder, ApplicationHandlerStop, CommandHandler, MessageHandler, TypeHandler, ContextTypes, filters
 import openai
+from conversation import Conversation, get_token_counter, count_message_tokens
+from scheduler import ChatJobScheduler
+from conversation_store import SQLiteConversationStore, ConversationCache
+from webhook_server import run_webhook_server
+from shared_state import SharedState, InMemorySharedState
+from sharding import ShardRouter, run_sharded_webhook_server
+from response_cache import ResponseCache
+from delivery import MessageDelivery
+from batch_jobs import SQLiteBatchStore, BatchProcessor
+from config import BotConfig, ConfigWatcher, read_settings
+from documents import DocumentIndexCache, read_document, format_excerpts
+from model_router import classify_request, choose_model, get_model_price
+from images import ImageCache, choose_image_detail, choose_photo_size, make_data_url, get_image_id, format_description, find_described_images, refers_to_image
+from rate_limiter import RateLimitGovernor, RateLimitTicket, interactive_priority, background_priority, is_retryable_error, retry_after_seconds, backoff_delay
+import metrics
+from metrics import log_event, span
 
 
 ### Main ###
 ############
 def main():
-    ### Prepare the Telegram API token, OpenAI API key, and system prompt from auxiliary files
+    ### Log runtime events as JSON lines
+    metrics.setup_json_logging()
 
+    ### Prepare the Telegram API token and OpenAI API key from auxiliary files
     API_TOKEN = get_telegram_api_token()
     OPENAI_KEY = get_openai_key()
-    system_message_dict = get_system_message_dict()
-    allowed_ids = get_allowed_ids()
+
+    ### Receive updates from Telegram, by polling or through a webhook
+    if run_mode == 'webhook' and (shard_workers > 1 or shard_node_urls):
+        # the worker processes build their own applications
+        dir_path = os.path.dirname(os.path.realpath(__file__))
+        router = ShardRouter(shard_workers, shard_node_urls)
+        asyncio.run(run_sharded_webhook_server(router, API_TOKEN, OPENAI_KEY, os.path.join(dir_path, shared_state_file), webhook_url, get_webhook_secret_token(), webhook_listen, webhook_port, webhook_path, register_webhook))
+        return
+    application = build_application(API_TOKEN, OPENAI_KEY, metrics_port=None if run_mode == 'webhook' else metrics_port)
+    if run_mode == 'webhook':
+        asyncio.run(run_webhook_server(application, webhook_url, get_webhook_secret_token(), webhook_listen, webhook_port, webhook_path, register_webhook))
+    else:
+        application.run_polling()
+
+def build_application(telegram_token: str, openai_key: str, telegram_base_url: str=None, openai_base_url: str=None, conversation_store_path: str=None, shared_state: SharedState=None, metrics_port: int=None, batch_store_path: str=None) -> Application:
+    '''
+    Builds the Telegram bot application with its handlers, clients and shared state.
+    The system prompt, allowed IDs and settings are read from auxiliary files on first use, and reloaded when they change.
+    The base URL arguments allow running the bot against local stand-ins of the APIs, e.g. for benchmarking.
+
+    Args:
+    telegram_token (str): the Telegram API token
+    openai_key (str): the OpenAI API key
+    telegram_base_url (str): the Telegram Bot API base URL, defaults to None (the official API)
+    openai_base_url (str): the OpenAI API base URL, defaults to None (the official API)
+    conversation_store_path (str): the path of the conversation store file, defaults to None (conversation_store_file next to the script)
+    shared_state (SharedState): the counters shared with other worker processes, defaults to None (counters local to this process)
+    metrics_port (int): port of a standalone /metrics endpoint started with the application, defaults to None (none started)
+    batch_store_path (str): the path of the /batch job store file, defaults to None (batch_store_file next to the script)
+
+    Returns:
+    application (Application): the Telegram bot application, not started yet
+    '''
+    get_token_counter(default_gpt_model)  # load the tokenizer once at startup rather than on the first message
 
     ### Initialize OpenAI client
-    # client = openai.OpenAI(api_key=OPENAI_KEY)
-    client = openai.OpenAI(api_key=OPENAI_KEY)
+    # the async client lets the handlers await API calls without blocking the event loop for other chats
+    # retries are left to the rate limit governor rather than the client's own retry loop
+    client = openai.AsyncOpenAI(api_key=openai_key, base_url=openai_base_url, max_retries=0)
+    shared_state = shared_state or InMemorySharedState()
+    api_governor = RateLimitGovernor(openai_requests_per_minute, openai_tokens_per_minute, max_concurrent_api_requests, rate_limit_burst_seconds, shared_state)
 
+    ### Initialize the job scheduler: messages of one user are processed in order, different users in parallel
+    scheduler = ChatJobScheduler(max_pending_jobs_per_user, max_pending_jobs, media_workers, media_worker_processes)
 
-    ### Initialize the Telegram bot
-    application = ApplicationBuilder().token(API_TOKEN).build()
-    application.bot_data.update({'client': client, 'system_message_dict': system_message_dict})
-    application.bot_data.update({'allowed_ids': allowed_ids})
+    ### Initialize the conversation store: histories are loaded lazily, on each user's first message
+    if conversation_store_path is None:
+        dir_path = os.path.dirname(os.path.realpath(__file__))
+        conversation_store_path = os.path.join(dir_path, conversation_store_file)
+    conversations = ConversationCache(SQLiteConversationStore(conversation_store_path), max_cached_conversations, conversation_flush_interval)
+    if batch_store_path is None:
+        batch_store_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), batch_store_file)
 
-    start_handler = CommandHandler('start', start_restart_command_handle_function)
-    restart_handler = CommandHandler('restart', start_restart_command_handle_function)
-    text_handler = MessageHandler(filters.TEXT & (~filters.COMMAND), text_message_handle_function)
-    voice_handler = MessageHandler(filters.VOICE, voice_message_handle_function)
-    file_handler = MessageHandler(filters.ATTACHMENT & (~filters.PHOTO), text_file_handle_function)
-    image_handler = MessageHandler(filters.PHOTO, image_file_handle_function)
 
+    ### Initialize the Telegram bot
+    # outgoing Bot API calls reuse a pool of keep-alive connections
+    builder = ApplicationBuilder().token(telegram_token).concurrent_updates(max_concurrent_updates)
+    builder = builder.connection_pool_size(telegram_connection_pool_size).pool_timeout(telegram_pool_timeout)
+    if telegram_base_url is not None:
+        builder = builder.base_url(telegram_base_url+'/bot').base_file_url(telegram_base_url+'/file/bot')
+    application = builder.post_init(post_init).post_stop(post_stop).post_shutdown(post_shutdown).build()
+    application.bot_data.update({'client': client, 'config_watcher': make_config_watcher(), 'config_task': None})
+    application.bot_data.update({'api_governor': api_governor, 'summary_cache': OrderedDict()})
+    application.bot_data.update({'scheduler': scheduler, 'conversations': conversations})
+    application.bot_data.update({'shared_state': shared_state})
+    image_cache = ImageCache(image_cache_bytes)
+    # cached photos are keyed on their file_unique_id, so the response cache neither hashes nor keeps their data URLs
+    response_cache = ResponseCache(response_cache_size, response_cache_ttl, response_cache_max_temperature, image_cache.id_for_url) if enable_response_cache else None
+    application.bot_data.update({'response_cache': response_cache, 'image_cache': image_cache})
+    application.bot_data.update({'document_indexes': DocumentIndexCache(max_cached_document_chunks, max_document_chunks)})
+    application.bot_data.update({'metrics_port': metrics_port, 'metrics_runner': None})
+    application.bot_data.update({'delivery': MessageDelivery(application.bot, telegram_messages_per_second)})
+    # /batch jobs are submitted to the Batch API and their results delivered in the background
+    # the Batch API calls don't go through the governor, so the SDK retries them
+    batch_processor = BatchProcessor(client.with_options(max_retries=2), SQLiteBatchStore(batch_store_path), lambda job, result, error: deliver_batch_result(application.bot_data['delivery'], job, result, error),
+                                     batch_submit_delay, batch_max_jobs, batch_poll_interval, batch_completion_window,
+                                     on_usage=lambda model, usage: count_tokens_used(model, usage, route='batch', price_factor=1-batch_price_discount))
+    application.bot_data.update({'batch_processor': batch_processor})
+
+    start_handler = CommandHandler('start', queued_per_user(start_restart_command_handle_function))
+    restart_handler = CommandHandler('restart', queued_per_user(start_restart_command_handle_function))
+    model_handler = CommandHandler('model', queued_per_user(model_command_handle_function))
+    batch_handler = CommandHandler('batch', queued_per_user(batch_command_handle_function))
+    text_handler = MessageHandler(filters.TEXT & (~filters.COMMAND), queued_per_user(text_message_handle_function, coalesce=True))
+    voice_handler = MessageHandler(filters.VOICE, queued_per_user(voice_message_handle_function, coalesce=True))
+    file_handler = MessageHandler(filters.ATTACHMENT & (~filters.PHOTO), queued_per_user(text_file_handle_function, coalesce=True))
+    image_handler = MessageHandler(filters.PHOTO, queued_per_user(image_file_handle_function, coalesce=True))
+
+    # authorization runs before the other handlers (group -1), and stops the updates of users who are not allowed
+    application.add_handler(TypeHandler(Update, authorize_update), group=-1)
     application.add_handler(start_handler)
     application.add_handler(restart_handler)
+    application.add_handler(model_handler)
+    application.add_handler(batch_handler)
     application.add_handler(text_handler)
     application.add_handler(voice_handler)
     application.add_handler(file_handler)
     application.add_handler(image_handler)
 
-    application.run_polling()
+    return application
 
 
 ### Functions ###
 #################
-def transcribe_mp3_to_text(mp3_filename: str, client: openai.OpenAI) -> Tuple[str, bool]:
+gpt_error_response = 'Problem getting response from GPT model. Please try again later.'
+gpt_interrupted_notice = '\n\n(The response was interrupted. Please try again.)'
+gpt_superseded_notice = '\n\n(Stopped here, to answer this together with your newer message.)'
+document_note_suffix = 'Relevant parts are provided with each message.'
+document_unavailable_note = 'Its contents are no longer available, it has to be attached again.'
+document_note = re.compile(r'(\[Attached document "([^"]*)": [^\]]*?)'+re.escape(document_note_suffix))
+request_priorities = {'summary': background_priority, 'image_description': background_priority}  # rate limit priority by request kind; other kinds are interactive
+
+async def transcribe_audio_to_text(audio_bytes: bytes, filename: str, client: openai.AsyncOpenAI, governor: RateLimitGovernor=None) -> Tuple[str, bool]:
     '''
-    Transcribes an mp3 file to text using the whisper-1 model from OpenAI.
+    Transcribes an in-memory audio file to text using the whisper-1 model from OpenAI.
     The function returns a tuple with the transcript text and a boolean indicating success.
-    
+
+    Args:
+    audio_bytes (bytes): the contents of the audio file
+    filename (str): a file name whose extension tells the API the audio format, e.g. 'voice.ogg'
+    client (openai.AsyncOpenAI): the async OpenAI client object
+    governor (RateLimitGovernor): optional governor pacing the requests, defaults to None (unlimited)
+
+    Returns:
+    (transcript_text, success) (Tuple[str, bool]): the transcript text and a boolean indicating success
     '''
     transcript_text = ''
     success = False
-    # make sure that file exists
-    if not os.path.exists(mp3_filename):
-        print(f"File {mp3_filename} not found. Make sure that ffmpeg is installed and in the system path.")
-        return '', False
     # check file size to make sure it fits within the OpenAI API limit of 25MB
-    file_stats = os.stat(mp3_filename)
-    if file_stats.st_size >= 25*1024*1024:
+    if len(audio_bytes) >= 25*1024*1024:
         # file size too big, return a coherent error message and False for success
-        print(f'File size is {file_stats.st_size} bytes. File is too big for OpenAI API. Returning an error message as output.')
+        log_event('audio file too big for the OpenAI API', size=len(audio_bytes))
         return 'This is an error message replacing a speech-to-text output: File size too big. Try using a shorter audio sample.', False
-    # try to transcribe the audio file
+    # try to transcribe the audio file, retried like the completions, since the client doesn't retry
+    governor = governor or RateLimitGovernor(max_in_flight=None)
+
+    async def send(model: str, ticket: RateLimitTicket):
+        with span('transcribe', size=len(audio_bytes)):
+            raw_response = await client.audio.transcriptions.with_raw_response.create(model=model, file=(filename, audio_bytes))
+        return raw_response.headers, raw_response.parse()
+
     try:
-        with open(mp3_filename, "rb") as audio_file:
-            transcript = client.audio.transcriptions.create(model="whisper-1", file=audio_file)
-            transcript_text = str(transcript.text)
-            success = True
+        _, ticket, transcript = await send_with_retries(governor, 'whisper-1', send, kind='transcription')
     except Exception as e:
-        print(f"Error in transcribing audio file: {e}")
-        return '', False
+        log_event('error transcribing audio file', level=logging.ERROR, error_type=type(e).__name__, error=str(e))
+        return 'This is an error message replacing a speech-to-text output: The transcription failed. Please try again later.', False
+    governor.release(ticket)
+    transcript_text = str(transcript.text)
+    success = True
     
     return transcript_text, success
 
+async def transcode_audio(audio_bytes: bytes, output_format:str='mp3') -> bytes:
+    '''
+    Transcodes in-memory audio to mono audio of the given format, by piping it through an ffmpeg subprocess.
+    The subprocess is awaited, so the event loop keeps serving other chats while ffmpeg runs.
+
+    Args:
+    audio_bytes (bytes): the contents of the input audio file, in any format ffmpeg can detect
+    output_format (str): the ffmpeg output format name, defaults to 'mp3'
+
+    Returns:
+    output_bytes (bytes): the contents of the transcoded audio file
+
+    Raises:
+    RuntimeError: if ffmpeg fails
+    FileNotFoundError: if ffmpeg is not installed or not in the system path
+    '''
+    process = await asyncio.create_subprocess_exec(
+        'ffmpeg', '-hide_banner', '-loglevel', 'error', '-i', 'pipe:0', '-ac', '1', '-f', output_format, 'pipe:1',
+        stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+    output_bytes, error_output = await process.communicate(audio_bytes)
+    if process.returncode != 0:
+        raise RuntimeError(f'ffmpeg exited with code {process.returncode}: {error_output.decode(errors="replace").strip()}')
+    return output_bytes
+
 def get_system_message_dict(system_prompt_file:str='./files/system_prompt', temperature:float=0.5) -> dict:
     '''
     Reads the system prompt from a file and returns it as a dict.
@@ -171,25 +373,25 @@ def get_telegram_api_token(telegram_api_token_file:str='./files/telegram_api_tok
     print(f'got API token, length: {len(API_TOKEN)}')
     return API_TOKEN
 
-def get_allowed_ids(allowed_ids_file:str='./files/allowed_ids') -> list:
+def get_allowed_ids(allowed_ids_file:str='./files/allowed_ids') -> frozenset:
     '''
-    Reads the allowed chat user IDs from a file and returns them as a list of strings.
+    Reads the allowed chat user IDs from a file and returns them as a set of strings, for constant time lookups.
     The allowed IDs file should be a text file with the allowed chat user IDs, one per line.
 
     Args:
     allowed_ids_file (str): the path to the allowed IDs file, defaults to './files/allowed_ids'
 
     Returns:
-    allowed_ids (list): a list of allowed chat user IDs as strings
+    allowed_ids (frozenset): the allowed chat user IDs as strings
     '''
     # get path to directory of current script and join with file name.
     dir_path = os.path.dirname(os.path.realpath(__file__))
     allowed_ids_file = os.path.join(dir_path, allowed_ids_file)
     print(f'looking for allowed IDs file at {allowed_ids_file}')
-    # check if the file exists. If not, return an empty list
+    # check if the file exists. If not, return an empty set
     if not os.path.exists(allowed_ids_file):
         print(f'Allowed IDs file not found at {allowed_ids_file}.')
-        return []
+        return frozenset()
     # read the allowed IDs from the file
     try:
         with open(allowed_ids_file) as file:
@@ -203,305 +405,1195 @@ def get_allowed_ids(allowed_ids_file:str='./files/allowed_ids') -> list:
         allowed_ids = [x for x in allowed_ids if x.isnumeric()]
         # verify that the IDs are all positive
         allowed_ids = [x for x in allowed_ids if int(x) > 0]
+        allowed_ids = frozenset(allowed_ids)
         print(f'got allowed IDs, length: {len(allowed_ids)}')
         return allowed_ids
     except Exception as e:
         print(f'Error reading allowed IDs file: {e}')
-        return []
+        return frozenset()
 
 
-def interact_with_gpt_model(client: openai.OpenAI, conversation: list, model:str=default_gpt_model, temperature:float=0.5) -> str:
+def load_config(system_prompt_file:str='./files/system_prompt', allowed_ids_file:str='./files/allowed_ids', settings_file:str=settings_file) -> BotConfig:
+    '''
+    Reads the reloadable settings from their files: the allowed IDs, the system prompt, and the settings file,
+    whose values override default_gpt_model, temperature and model_routes.
+    The routes whose model in model_routes is default_gpt_model follow the 'model' setting, unless the settings file sets them itself.
+
+    Raises:
+    ValueError: if the settings file is invalid
+    '''
+    dir_path = os.path.dirname(os.path.realpath(__file__))
+    settings = read_settings(os.path.join(dir_path, settings_file))
+    config_temperature = settings.get('temperature', temperature)
+    config_model = settings.get('model', default_gpt_model)
+    config_routes = {route: config_model if model == default_gpt_model else model for route, model in model_routes.items()}
+    return BotConfig(
+        allowed_ids=get_allowed_ids(allowed_ids_file),
+        system_message_dict=get_system_message_dict(system_prompt_file, config_temperature),
+        model=config_model,
+        temperature=config_temperature,
+        model_routes={**config_routes, **settings.get('model_routes', {})},
+    )
+
+def make_config_watcher() -> ConfigWatcher:
+    '''
+    Returns a watcher of the files load_config reads, which loads the config on first use.
+    '''
+    dir_path = os.path.dirname(os.path.realpath(__file__))
+    paths = [os.path.join(dir_path, path) for path in ('./files/system_prompt', './files/allowed_ids', settings_file)]
+    return ConfigWatcher(load_config, paths, config_poll_interval)
+
+def get_config(context: ContextTypes.DEFAULT_TYPE) -> BotConfig:
+    '''
+    Returns the current config. A request should read it once, since it may be replaced by a reload at any await.
+    '''
+    return context.bot_data['config_watcher'].config
+
+def get_webhook_secret_token(webhook_secret_token_file:str='./files/webhook_secret_token') -> str:
+    '''
+    Reads the webhook secret token from a file and returns it as a string.
+    Telegram sends the token with every webhook request, so the webhook server can reject requests that don't come from Telegram.
+    If the file does not exist, a random token is generated and written to it, so that all instances sharing the files directory use the same token.
+
+    Args:
+    webhook_secret_token_file (str): the path to the webhook secret token file, defaults to './files/webhook_secret_token'
+
+    Returns:
+    WEBHOOK_SECRET_TOKEN (str): the webhook secret token as a string
+    '''
+    # get path to directory of current script and join with file name
+    dir_path = os.path.dirname(os.path.realpath(__file__))
+    webhook_secret_token_file = os.path.join(dir_path, webhook_secret_token_file)
+    print(f'looking for webhook secret token file at {webhook_secret_token_file}')
+    if not os.path.exists(webhook_secret_token_file):
+        # Telegram allows 1-256 characters A-Z, a-z, 0-9, _ and -
+        with open(webhook_secret_token_file, 'w') as file:
+            file.write(secrets.token_urlsafe(32))
+        print('generated a new webhook secret token')
+    # read the token from the file
+    with open(webhook_secret_token_file) as file:
+        WEBHOOK_SECRET_TOKEN = file.readline().strip()
+    print(f'got webhook secret token, length: {len(WEBHOOK_SECRET_TOKEN)}')
+    return WEBHOOK_SECRET_TOKEN
+
+def count_tokens_used(model: str, usage, route: str='chat', price_factor: float=1) -> None:
+    '''
+    Adds the prompt and completion tokens of an OpenAI response's usage, if it has one, to the token metrics,
+    and their estimated cost from model_prices, times price_factor (e.g. for discounted batch requests), to the cost of the route.
+    '''
+    if usage is None:
+        return
+    metrics.tokens_total.inc(usage.prompt_tokens or 0, model=model, direction='in')
+    metrics.tokens_total.inc(usage.completion_tokens or 0, model=model, direction='out')
+    price = get_model_price(model, model_prices)
+    if price is not None:
+        metrics.cost_usd_total.inc(((usage.prompt_tokens or 0)*price[0]+(usage.completion_tokens or 0)*price[1])*price_factor/1e6, route=route, model=model)
+
+def log_api_error(model: str, error: Exception, event: str) -> None:
+    '''
+    Counts an OpenAI API error by its type, e.g. RateLimitError, and logs it.
+    '''
+    metrics.openai_errors_total.inc(model=model, error=type(error).__name__)
+    log_event(event, level=logging.WARNING, model=model, error_type=type(error).__name__, error=str(error))
+
+def get_retry_delay(governor: RateLimitGovernor, model: str, error: Exception, attempt: int, t0: float) -> float:
+    '''
+    Decides whether a failed OpenAI request is retried, and returns the seconds to wait before retrying, or None to give up.
+    Only retryable errors are retried, with a jittered exponential backoff, and only within api_retry_time of t0.
+    A 429 pauses the model in the governor for the time the API asks, so all the waiting requests resume paced instead of together.
+    '''
+    response = getattr(error, 'response', None)
+    if response is not None:
+        governor.update_from_headers(model, response.headers)
+    if not is_retryable_error(error):
+        return None
+    delay = backoff_delay(attempt)
+    if isinstance(error, openai.RateLimitError):
+        retry_after = retry_after_seconds(error)
+        governor.pause(model, delay if retry_after is None else retry_after)
+        delay = 0 if retry_after is not None else delay  # the governor holds the retry until the pause is over
+    if time.time()-t0+delay >= api_retry_time:
+        return None
+    return delay
+
+def log_fallback(model: str, fallback_model: str) -> None:
+    '''
+    Counts and logs a request switching to its fallback model.
+    '''
+    metrics.model_fallbacks_total.inc(model=model, fallback_model=fallback_model)
+    log_event('switching to the fallback model', level=logging.WARNING, model=model, fallback_model=fallback_model)
+
+def estimate_request_tokens(conversation: list, model: str, prompt_tokens: int=None) -> int:
+    '''
+    Estimates the tokens a completion request counts against the tokens per minute: its prompt plus the expected completion.
+    The prompt is only counted if prompt_tokens isn't given, e.g. from the running count of a Conversation.
+    '''
+    if prompt_tokens is None:
+        prompt_tokens = sum(count_message_tokens(message, model) for message in conversation)
+    return prompt_tokens+expected_completion_tokens
+
+async def send_with_retries(governor: RateLimitGovernor, model: str, send, request_tokens: int=0, kind: str='chat', fallback_model: str=None, event: str='API error') -> Tuple[str, RateLimitTicket, object]:
+    '''
+    Sends an OpenAI request with the retry policy of all the bot's requests: each attempt waits for its turn in the rate limit governor,
+    retryable errors are retried after a jittered backoff (see get_retry_delay), and other errors fail at once.
+    With a fallback model, the first retryable error switches the request to it, retried at once.
+    The rate limit headers of the responses are passed to the governor. The waits are awaited, so other chats keep being served.
+
+    Args:
+    governor (RateLimitGovernor): the governor pacing the requests
+    model (str): the name of the model to send the request to
+    send (Callable): called with (model, ticket) for each attempt, returns an awaitable of the (response headers, result)
+    request_tokens (int): the tokens the request counts against the tokens per minute, defaults to 0
+    kind (str): what the request is for, a label of the request metrics that also sets its priority, defaults to 'chat'
+    fallback_model (str): the model to switch to after a retryable error, defaults to None (retry the same model)
+    event (str): the log event of a failed attempt, defaults to 'API error'
+
+    Returns:
+    (model, ticket, result) (Tuple[str, RateLimitTicket, object]): the model that answered, the ticket of its request slot and the result of send;
+    the slot is still held, and must be given back with governor.release(ticket) once the response has been read
+
+    Raises:
+    Exception: the error of the last attempt, once it isn't retried
+    '''
+    t0 = time.time()
+    priority = request_priorities.get(kind, interactive_priority)
+    for attempt in itertools.count():
+        ticket = await governor.acquire(model, request_tokens, priority)
+        try:
+            metrics.openai_requests_total.inc(model=model, kind=kind)
+            headers, result = await send(model, ticket)
+            governor.update_from_headers(model, headers)
+            return model, ticket, result
+        except BaseException as e:
+            governor.release(ticket)
+            if not isinstance(e, Exception):
+                raise
+            delay = get_retry_delay(governor, model, e, attempt, t0)
+            log_api_error(model, e, f'{event}, trying again...' if delay is not None else f'{event}, giving up')
+            if delay is None:
+                raise
+            if fallback_model is not None:
+                # the failure was the other model's, so the fallback model is tried at once
+                log_fallback(model, fallback_model)
+                model, fallback_model = fallback_model, None
+                continue
+        # back off before the next attempt, without holding a request slot
+        metrics.openai_retries_total.inc(model=model)
+        with span('retry_backoff', model=model):
+            await asyncio.sleep(delay)
+
+async def interact_with_gpt_model(client: openai.AsyncOpenAI, conversation: list, model:str=default_gpt_model, temperature:float=0.5, governor:RateLimitGovernor=None, kind:str='chat', fallback_model:str=None, route:str=None, prompt_tokens:int=None) -> str:
     '''
     Interacts with the GPT model using the OpenAI API.
     The function returns the response from the GPT model as a string.
+    The request is paced by the rate limit governor and retried, or switched to the fallback model, as in send_with_retries.
 
     Args:
-    client (openai.OpenAI): the OpenAI client object
+    client (openai.AsyncOpenAI): the async OpenAI client object
     conversation (list): a list of dictionaries with the conversation history
     model (str): the name of the GPT model to use, defaults to default_gpt_model
     temperature (float): the temperature parameter used in the GPT model, defaults to 0.5
+    governor (RateLimitGovernor): optional governor pacing the requests, defaults to None (unlimited)
+    kind (str): what the request is for, a label of the request metrics that also sets its priority, defaults to 'chat'
+    fallback_model (str): the model to switch to after a retryable error, defaults to None (retry the same model)
+    route (str): the route of a chat request, the label of its cost metrics, defaults to None (the kind)
+    prompt_tokens (int): the token count of the messages, if known, for the rate limits, defaults to None (counted once here, also for the fallback model)
 
     Returns:
     gpt_response (str): the response from the GPT model as a string
     '''
-    gpt_response = ''
-    time_to_wait = 1  # exponential backoff: timeout retry wait time starts at 1 second and doubles on each retry
-    t0 = time.time()
-    success = False
-    error_message = ''
-    while True and time.time()-t0 < api_retry_time:
-        try:
-            gpt_response = client.chat.completions.create(
+    governor = governor or RateLimitGovernor(max_in_flight=None)
+    route = route or kind
+
+    async def send(model: str, ticket: RateLimitTicket):
+        with span('completion', model=model, kind=kind):
+            raw_response = await client.chat.completions.with_raw_response.create(
                 model=model,
                 messages=conversation,
                 n=1,
                 temperature = temperature,
                 stream = False
             )
-            gpt_response = gpt_response.choices[0].message.content
-            success = True
-            break
-        except openai.RateLimitError as e:
-            error_message =+ f'rate limit error: {e}; '
-            print('rate limit error, trying again...')
-        except openai.APIError as e:
-            error_message =+ f'API error: {e}; '
-            print(f'API error: {e}, trying again...')
-        except Exception as e:
-            error_message =+ f'unknown error: {e}; '
-            print(f'unknown error: {e}, trying again...')
-        finally:
-            time.sleep(time_to_wait)
-            time_to_wait = time_to_wait*2
-    if not success:
-        gpt_response = 'Problem getting response from GPT model. Please try again later.'
-        print(f'Errors in getting response from GPT model: {error_message}')
-    return gpt_response
+        return raw_response.headers, raw_response.parse()
 
-def init_conversation_and_system_message(context: ContextTypes.DEFAULT_TYPE,):
-    system_message_dict = context.bot_data['system_message_dict']
-    if not 'conversation' in context.user_data:
-        # initialize the conversation list in the user_data
-        context.user_data.update({'conversation': []})
-    if len(context.user_data['conversation']) == 0:
-        # add the system message to the conversation
-        context.user_data['conversation'].append(system_message_dict)
+    try:
+        model, ticket, response = await send_with_retries(governor, model, send, estimate_request_tokens(conversation, model, prompt_tokens), kind, fallback_model)
+    except Exception as e:
+        log_event('errors in getting response from GPT model', level=logging.ERROR, model=model, error_type=type(e).__name__, error=str(e))
+        return gpt_error_response
+    if response.usage is not None:
+        ticket.used_tokens = response.usage.total_tokens
+    governor.release(ticket)
+    count_tokens_used(model, response.usage, route)
+    return response.choices[0].message.content
+
+async def stream_gpt_model(client: openai.AsyncOpenAI, conversation: list, model:str=default_gpt_model, temperature:float=0.5, governor:RateLimitGovernor=None, kind:str='chat', fallback_model:str=None, route:str=None, prompt_tokens:int=None) -> AsyncIterator[str]:
+    '''
+    Streams a response from the GPT model using the OpenAI API.
+    The function is an async generator that yields the response text in pieces as they are generated.
+    Failures are retried, or switched to the fallback model, as in send_with_retries, but only until the first piece has been received;
+    a stream that breaks after that ends early with the text received so far, followed by gpt_interrupted_notice.
+    If no piece could be received, the generic error response is yielded instead.
 
+    Args:
+    client (openai.AsyncOpenAI): the async OpenAI client object
+    conversation (list): a list of dictionaries with the conversation history
+    model (str): the name of the GPT model to use, defaults to default_gpt_model
+    temperature (float): the temperature parameter used in the GPT model, defaults to 0.5
+    governor (RateLimitGovernor): optional governor pacing the requests, defaults to None (unlimited)
+    kind (str): what the request is for, a label of the request metrics that also sets its priority, defaults to 'chat'
+    fallback_model (str): the model to switch to after a retryable error, defaults to None (retry the same model)
+    route (str): the route of a chat request, the label of its cost metrics, defaults to None (the kind)
+    prompt_tokens (int): the token count of the messages, if known, for the rate limits, defaults to None (counted once here, also for the fallback model)
+
+    Yields:
+    text (str): the next piece of the response from the GPT model
+    '''
+    governor = governor or RateLimitGovernor(max_in_flight=None)
+    route = route or kind
+
+    async def read_texts(stream, model: str, ticket: RateLimitTicket) -> AsyncIterator[str]:
+        async for chunk in stream:
+            count_tokens_used(model, chunk.usage, route)
+            if chunk.usage is not None:
+                ticket.used_tokens = chunk.usage.total_tokens
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+
+    async def send(model: str, ticket: RateLimitTicket):
+        with span('completion', model=model, kind=kind, stream=True):
+            t_request = time.perf_counter()
+            raw_response = await client.chat.completions.with_raw_response.create(
+                model=model,
+                messages=conversation,
+                n=1,
+                temperature = temperature,
+                stream = True,
+                stream_options = {'include_usage': True}  # the last chunk has the token usage
+            )
+            stream = raw_response.parse()
+            texts = read_texts(stream, model, ticket)
+            try:
+                # the first piece is awaited here, so a stream that breaks before it is retried like a failed request
+                first_text = await anext(texts, None)
+            except BaseException:
+                await stream.close()
+                raise
+        if first_text is not None:
+            metrics.stage_seconds.observe(time.perf_counter()-t_request, stage='first_token')
+        return raw_response.headers, (stream, texts, first_text)
 
-### Async handler functions ###
-###############################
-async def text_message_handle_function(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    message_dict_to_append = {
-        'role': 'user',
-        'content': update.message.text
+    try:
+        model, ticket, (stream, texts, first_text) = await send_with_retries(governor, model, send, estimate_request_tokens(conversation, model, prompt_tokens),
+                                                                             kind, fallback_model, event='error starting stream')
+    except Exception:
+        yield gpt_error_response
+        return
+    try:
+        # the stream is closed when it ends early, e.g. when its reply was superseded, which stops the generation
+        async with stream:
+            if first_text is None:
+                return
+            yield first_text
+            try:
+                with span('stream', model=model, kind=kind):
+                    async for text in texts:
+                        yield text
+            except Exception as e:
+                log_api_error(model, e, 'stream interrupted')
+                yield gpt_interrupted_notice
+    finally:
+        await texts.aclose()
+        governor.release(ticket)
+
+async def get_conversation(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Conversation:
+    '''
+    Returns the user's conversation, loading it from the conversation store on the user's first message after startup.
+    A new conversation is started, with the system message pinned at its start, if the user has none.
+    '''
+    user_id = str(update.effective_user.id)
+    config = get_config(context)
+    system_message_dict = config.system_message_dict
+    conversations = context.bot_data['conversations']
+    conversation = await conversations.get(user_id)
+    if conversation is None:
+        conversation = Conversation(system_message_dict, config.model)
+        conversations.add(user_id, conversation)
+    elif conversation.messages[0] != system_message_dict:
+        # the system prompt changed since the conversation was stored
+        conversation.set_system_message(system_message_dict)
+    return conversation
+
+def trim_conversation_to_budget(conversation: Conversation, model:str=default_gpt_model, reserved_tokens:int=0) -> None:
+    '''
+    Drops the oldest turns of the conversation so that the prompt fits the token budget of the model,
+    less reserved_tokens for other content sent with it (e.g. document excerpts).
+    The token counts are kept up to date as messages are appended, so this does not re-encode the history.
+    '''
+    token_budget = conversation_token_budgets.get(model, default_conversation_token_budget)-reserved_tokens
+    n_dropped = conversation.trim(token_budget)
+    if n_dropped > 0:
+        log_event('dropped old messages to fit the token budget', n_dropped=n_dropped, token_budget=token_budget, prompt_tokens=conversation.total_tokens)
+
+
+def get_summary_cache_key(previous_summary: str, segment: list) -> str:
+    '''
+    Returns a key identifying a summarization input: the previous summary and the messages being compacted.
+    '''
+    data = json.dumps([previous_summary, segment], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+async def summarize_conversation_segment(client: openai.AsyncOpenAI, previous_summary: str, segment: list, governor:RateLimitGovernor=None) -> str:
+    '''
+    Summarizes a segment of old conversation turns, together with the summary of the turns before them, using summary_gpt_model.
+    Images in the segment are represented by their text parts only.
+
+    Args:
+    client (openai.AsyncOpenAI): the async OpenAI client object
+    previous_summary (str): the current summary of the conversation, may be empty
+    segment (list): the messages to summarize, oldest first
+    governor (RateLimitGovernor): optional governor pacing the requests, defaults to None (unlimited)
+
+    Returns:
+    summary (str): the summary text, or an empty string if it couldn't be generated
+    '''
+    lines = []
+    if previous_summary:
+        lines.append(f'Summary of the conversation so far: {previous_summary}')
+    for message in segment:
+        content = get_message_text(message)
+        if not isinstance(message.get('content') or '', str) and any(part.get('type') == 'image_url' for part in message['content']):
+            content += ' [image]'
+        lines.append(f"{message.get('role')}: {content}")
+    summary_request = [
+        {'role': 'system', 'content': 'Summarize the following chat between a user and an assistant in a compact paragraph. '
+            'Keep the facts, names, numbers, decisions and open questions that later turns may refer to. Reply with the summary only.'},
+        {'role': 'user', 'content': '\n'.join(lines)}
+    ]
+    summary = await interact_with_gpt_model(client, summary_request, model=summary_gpt_model, temperature=0, governor=governor, kind='summary')
+    if summary == gpt_error_response:
+        return ''
+    return summary
+
+async def compact_conversation(context: ContextTypes.DEFAULT_TYPE, user_id: str, conversation: Conversation) -> None:
+    '''
+    Replaces the oldest turns of the conversation with a rolling summary, if the prompt has grown past summarize_at_budget_fraction of the token budget.
+    Meant to run as a background task after the reply was sent. Summaries are cached by their input, so a segment is only summarized once.
+    '''
+    token_budget = conversation_token_budgets.get(conversation.model, default_conversation_token_budget)
+    if conversation.total_tokens < token_budget*summarize_at_budget_fraction:
+        return
+    segment = conversation.summarizable_segment(int(token_budget*summary_keep_recent_fraction))
+    if len(segment) == 0:
+        return
+    summary_cache = context.bot_data['summary_cache']
+    cache_key = get_summary_cache_key(conversation.summary, segment)
+    summary = summary_cache.get(cache_key)
+    if summary is None:
+        t0 = time.time()
+        summary = await summarize_conversation_segment(context.bot_data['client'], conversation.summary, segment, context.bot_data['api_governor'])
+        if not summary:
+            return
+        summary_cache[cache_key] = summary
+        while len(summary_cache) > summary_cache_size:
+            summary_cache.popitem(last=False)
+        log_event('summarized old messages', n_messages=len(segment), seconds=round(time.time()-t0, 3))
+    else:
+        summary_cache.move_to_end(cache_key)
+    tokens_before = conversation.total_tokens
+    if conversation.apply_summary(segment, summary):
+        context.bot_data['conversations'].mark_dirty(user_id, conversation)
+        log_event('compacted conversation', tokens_before=tokens_before, tokens_after=conversation.total_tokens)
+
+def schedule_conversation_compaction(context: ContextTypes.DEFAULT_TYPE, user_id: str, conversation: Conversation) -> None:
+    '''
+    Starts compact_conversation as a background task for the user's conversation, unless one is already running.
+    '''
+    task = context.user_data.get('compaction_task')
+    if task is not None and not task.done():
+        return
+    context.user_data['compaction_task'] = context.application.create_task(compact_conversation(context, user_id, conversation))
+
+
+def get_message_text(message: dict) -> str:
+    '''
+    Returns the text of an openai-compatible message dict, joining the text parts of multi-part content.
+    '''
+    content = message.get('content') or ''
+    if isinstance(content, str):
+        return content
+    return ' '.join(part.get('text') or '' for part in content if part.get('type') == 'text')
+
+def forget_unindexed_documents(conversation: Conversation, document_names: set) -> None:
+    '''
+    Rewrites the notes of attached documents that are no longer indexed (dropped for newer ones, evicted, or lost with a restart),
+    so the conversation no longer says their relevant parts are provided.
+    '''
+    for index, message in enumerate(conversation.messages):
+        if message.get('role') != 'user' or document_note_suffix not in get_message_text(message):
+            continue
+        replace = lambda match: match.group(0) if match.group(2) in document_names else match.group(1)+document_unavailable_note
+        if isinstance(message['content'], str):
+            content = document_note.sub(replace, message['content'])
+        else:
+            content = [dict(part, text=document_note.sub(replace, part['text'])) if part.get('type') == 'text' else part for part in message['content']]
+        if content != message['content']:
+            conversation.replace(index, {'role': 'user', 'content': content})
+            log_event('document no longer indexed', tokens_after=conversation.total_tokens)
+
+def get_document_excerpts(context: ContextTypes.DEFAULT_TYPE, user_id: str, conversation: Conversation) -> dict:
+    '''
+    Returns a system message with the chunks of the user's indexed documents most relevant to their latest message,
+    within document_context_tokens, or None if the user has no indexed documents or none of their chunks is relevant.
+    The previous user message is part of the query too, so follow-up questions find the same chunks.
+    On the turn a document is attached, a message matching none of its chunks (e.g. 'summarize this') gets its first chunks.
+    '''
+    document_index = context.bot_data['document_indexes'].get(user_id)
+    forget_unindexed_documents(conversation, set() if document_index is None else {name for name, _ in document_index.documents})
+    if not document_index:
+        return None
+    user_messages = [message for message in conversation.messages[conversation.n_pinned:] if message.get('role') == 'user']
+    # the notes of attached documents are left out of the query, their words would match any chunk
+    query = re.sub(r'\[Attached document [^\]]*\]', ' ', ' '.join(get_message_text(message) for message in user_messages[-2:]))
+    attached_now = len(user_messages) > 0 and document_note_suffix in get_message_text(user_messages[-1])
+    with span('document_search', n_chunks=len(document_index)):
+        excerpts = format_excerpts(document_index.search(query, document_context_tokens, fallback_to_latest=attached_now))
+    if excerpts is None:
+        return None
+    return {'role': 'system', 'content': excerpts}
+
+
+async def describe_image(client: openai.AsyncOpenAI, image_url: str, detail: str, governor:RateLimitGovernor=None) -> str:
+    '''
+    Describes a photo in a few sentences using summary_gpt_model, so the description can stand in for the photo in later turns.
+
+    Returns:
+    description (str): the description, or an empty string if it couldn't be generated
+    '''
+    description_request = [
+        {'role': 'user', 'content': [
+            {'type': 'text', 'text': 'Describe this image in at most 80 words for someone who cannot see it: the main subjects, '
+                'the setting, and any visible text verbatim. Reply with the description only.'},
+            {'type': 'image_url', 'image_url': {'url': image_url, 'detail': detail}},
+        ]}
+    ]
+    description = await interact_with_gpt_model(client, description_request, model=summary_gpt_model, temperature=0, governor=governor, kind='image_description')
+    if description == gpt_error_response:
+        return ''
+    return description
+
+async def describe_answered_images(context: ContextTypes.DEFAULT_TYPE, user_id: str, conversation: Conversation, messages: list) -> None:
+    '''
+    Replaces the photos in the given messages of the conversation, which have been answered, with text descriptions,
+    so later turns don't re-send them. Descriptions are cached by image ID, so a photo sent again is only described once.
+    Meant to run as a background task after the reply was sent; a message that left the conversation meanwhile is skipped.
+    '''
+    image_cache = context.bot_data['image_cache']
+    for message in messages:
+        if isinstance(message.get('content') or '', str):
+            continue
+        content = []
+        for part in message['content']:
+            if part.get('type') != 'image_url':
+                content.append(part)
+                continue
+            url = part['image_url'].get('url', '')
+            image_id = image_cache.id_for_url(url) or get_image_id(url)
+            description = image_cache.get_description(image_id)
+            if description is None:
+                with span('describe_image', detail=part['image_url'].get('detail', 'auto')):
+                    description = await describe_image(context.bot_data['client'], url, part['image_url'].get('detail', 'auto'), context.bot_data['api_governor'])
+                if not description:
+                    if url.startswith('data:'):
+                        return  # tried again after the next reply
+                    description = 'the photo is no longer available'  # an expired Telegram URL stored before photos were cached
+                image_cache.put_description(image_id, description)
+            if url.startswith('data:') and image_cache.get(image_id) is None:
+                # e.g. a photo in a conversation stored before a restart, so it can still be attached again
+                image_cache.put(image_id, url, part['image_url'].get('detail', 'auto'))
+            content.append({'type': 'text', 'text': format_description(image_id, description)})
+        index = next((i for i, current in enumerate(conversation.messages) if current is message), None)
+        if index is None:
+            continue
+        conversation.replace(index, {'role': message['role'], 'content': content})
+        context.bot_data['conversations'].mark_dirty(user_id, conversation)
+        log_event('replaced photo with its description', tokens_after=conversation.total_tokens)
+
+def schedule_image_descriptions(context: ContextTypes.DEFAULT_TYPE, user_id: str, conversation: Conversation) -> None:
+    '''
+    Starts describe_answered_images as a background task for the messages of the conversation with photos, unless one is already running.
+    '''
+    task = context.user_data.get('image_description_task')
+    if task is not None and not task.done():
+        return
+    messages = [message for message in conversation.messages if not isinstance(message.get('content') or '', str)
+                and any(part.get('type') == 'image_url' for part in message['content'])]
+    if len(messages) == 0:
+        return
+    context.user_data['image_description_task'] = context.application.create_task(describe_answered_images(context, user_id, conversation, messages))
+
+def attach_referenced_image(context: ContextTypes.DEFAULT_TYPE, conversation: Conversation) -> dict:
+    '''
+    Returns the user's latest message with the latest described photo attached again, if the message refers to a photo
+    and the photo is still cached, else None. The photo is only sent with this request, the conversation keeps its description.
+    '''
+    message = conversation.messages[-1]
+    if message.get('role') != 'user' or not isinstance(message.get('content') or '', str) or not refers_to_image(message['content']):
+        return None
+    image_cache = context.bot_data['image_cache']
+    for image_id in reversed(find_described_images(conversation.messages[:-1])):
+        entry = image_cache.get(image_id)
+        if entry is not None:
+            data_url, detail = entry
+            log_event('attached photo again', image_id=image_id, detail=detail)
+            return {'role': 'user', 'content': [
+                {'type': 'text', 'text': message['content']},
+                {'type': 'image_url', 'image_url': {'url': data_url, 'detail': detail}},
+            ]}
+    return None
+
+def get_selectable_models(config: BotConfig) -> list:
+    '''
+    Returns the models a user can pin with the /model command: the models of the routes, their fallbacks and the config's model.
+    '''
+    return sorted(set(config.model_routes.values()) | set(fallback_models) | set(fallback_models.values()) | {config.model})
+
+def route_request(context: ContextTypes.DEFAULT_TYPE, config: BotConfig, conversation: Conversation, request_messages: list, has_documents: bool, prompt_tokens: int) -> Tuple[str, str, str]:
+    '''
+    Picks the route of a chat request, following routing_policy, and the model to send it to and its fallback model.
+    Requests of a user who pinned a model with the /model command are on the 'pinned' route.
+
+    Returns:
+    (route, model, fallback_model) (Tuple[str, str, str]): the route, the model and the fallback model, or None if there is none
+    '''
+    override = context.user_data.get('model_override')
+    if override is not None:
+        route = 'pinned'
+    elif routing_policy == 'fixed':
+        route = 'fixed'
+    else:
+        route = classify_request(request_messages, conversation.n_pinned, has_documents, get_token_counter(config.model), prompt_tokens,
+                                 light_max_message_tokens, light_max_prompt_tokens, light_max_depth)
+    governor = context.bot_data['api_governor']
+    wait_time = lambda model: governor.wait_time(model, prompt_tokens+expected_completion_tokens)
+    routes = config.model_routes if routing_policy != 'fixed' else {}
+    model, fallback_model = choose_model(route, routes, config.model, fallback_models, override, wait_time, fallback_wait_seconds)
+    log_event('routed request', route=route, model=model, fallback_model=fallback_model, prompt_tokens=prompt_tokens)
+    return route, model, fallback_model
+
+def is_batch_job(update: Update) -> bool:
+    '''
+    Returns True for the messages that become /batch jobs in batch mode: documents and voice notes.
+    '''
+    return update.message is not None and (update.message.document is not None or update.message.voice is not None)
+
+def join_chunks(chunks: list, max_tokens: int) -> Tuple[str, int]:
+    '''
+    Joins the (text, token count) chunks of a document, up to max_tokens.
+
+    Returns:
+    text (str): the text of the chunks that fit
+    n_kept (int): the number of chunks that fit
+    '''
+    n_tokens = 0
+    for n_kept, (_, chunk_tokens) in enumerate(chunks):
+        n_tokens += chunk_tokens
+        if n_tokens > max_tokens:
+            break
+    else:
+        n_kept = len(chunks)
+    return ''.join(text for text, _ in chunks[:n_kept]), n_kept
+
+async def queue_batch_job(update: Update, context: ContextTypes.DEFAULT_TYPE, kind: str, title: str, text: str) -> None:
+    '''
+    Queues a /batch job for a document or voice note: a request with the message's caption, or the default instruction
+    of its kind in batch_instructions, and its text, sent with the system prompt to batch_gpt_model.
+    The job doesn't enter the user's conversation, and its result is sent to the chat when the batch is done.
+
+    Args:
+    update (Update): the Telegram update of the document or voice note
+    context (ContextTypes.DEFAULT_TYPE): the handler context
+    kind (str): 'document' or 'voice'
+    title (str): a short description of the job, sent with its result
+    text (str): the text of the document or the transcript of the voice note
+    '''
+    config = get_config(context)
+    instruction = update.message.caption or batch_instructions[kind]
+    body = {
+        'model': batch_gpt_model or config.model_routes.get('documents', config.model),
+        'messages': [config.system_message_dict, {'role': 'user', 'content': f'{instruction}\n\n{text}'}],
+        'temperature': config.temperature
     }
-    # get the user ID
+    n_jobs = await context.bot_data['batch_processor'].add(update.effective_chat.id, str(update.effective_user.id), title, body)
+    await context.bot_data['delivery'].send(update.effective_chat.id, f'Queued {title} for batch processing ({n_jobs} of your jobs waiting). '
+                                            f'The result is sent here when it is ready, within {batch_completion_window}.', markdown=False)
+
+async def deliver_batch_result(delivery: MessageDelivery, job: dict, result: str, error: str) -> None:
+    '''
+    Sends the result of a /batch job to its chat, or the reason it failed.
+    Results for chats the bot can no longer send to (e.g. the user blocked it) are dropped;
+    other Telegram errors are raised, so the result is sent again with the next check of the batch.
+    '''
+    try:
+        if error is not None:
+            await delivery.send(job['chat_id'], f'{job["title"]}: the batch job failed ({error}). Please send it again.', markdown=False)
+        else:
+            await delivery.send(job['chat_id'], f'{job["title"]}:\n\n{result}')
+    except (telegram_error.Forbidden, telegram_error.BadRequest) as e:
+        log_event('batch result not delivered', level=logging.WARNING, job_id=job['job_id'], chat_id=job['chat_id'], error=str(e))
+
+async def authorize_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    '''
+    Checks every update against the allowed IDs before any other handler runs.
+    A user who is not allowed gets a reply with their user ID, and the update is not handled any further.
+    '''
+    if update.effective_user is None:
+        return
     user_id = str(update.effective_user.id)
-    # if the user is not in the allowed IDs list, print an error and return
-    if not user_id in context.bot_data['allowed_ids'] and len(context.bot_data['allowed_ids']) > 0:
-        text = f'You are not authorized to use this chatbot. Your user ID is {user_id}.'
-        await context.bot.send_message(chat_id=update.effective_chat.id, text=text)
+    if get_config(context).is_allowed(user_id):
         return
-    # make sure the conversation is initialized and the system message is added
-    init_conversation_and_system_message(context)
+    metrics.unauthorized_updates_total.inc()
+    log_event('unauthorized user', level=logging.WARNING, user_id=user_id)
+    if update.effective_chat is not None:
+        text = f'You are not authorized to use this chatbot. Your user ID is {user_id}.'
+        await context.bot_data['delivery'].send(update.effective_chat.id, text, markdown=False)
+    raise ApplicationHandlerStop
 
-    # append the user message to the conversation
-    context.user_data['conversation'].append(message_dict_to_append)
+def queued_per_user(handle_function, coalesce:bool=False):
+    '''
+    Wraps a handler function so that it runs as a job in the user's queue of the scheduler, instead of inline.
+    The messages of a user are then processed one at a time in the order they arrived, and messages of different users in parallel.
+    If the queue is full, the user gets a busy reply and the message is dropped.
+    Each update gets a request ID, which tags the logs and spans of all its stages, and the whole job is timed as the 'handler' span.
+    With coalesce, the user's queued messages are counted in user_data['queued_messages'], so a message is answered
+    only once no newer one is queued (see respond_after_burst), and a newer message cancels the reply being generated.
+    If the last queued message fails before it joins the turn left for it, the turn is answered without it (see answer_unanswered_turn).
 
-    ### interact with the GPT model
-    gpt_response = interact_with_gpt_model(context.bot_data['client'], context.user_data['conversation'], model=default_gpt_model, temperature=temperature)
+    Args:
+    handle_function (Callable): the async handler function to wrap
+    coalesce (bool): True for messages that are answered by the model, defaults to False
+
+    Returns:
+    queue_handle_function (Callable): an async handler function that queues handle_function
+    '''
+    handler_name = handle_function.__name__.removesuffix('_handle_function')
 
-    # send the response to the user
-    await context.bot.send_message(chat_id=update.effective_chat.id, text=gpt_response, parse_mode='Markdown')
+    async def run_job(update: Update, context: ContextTypes.DEFAULT_TYPE, request_id: str, coalesced: bool):
+        # the job runs in the user's queue task, so the request ID is set again there
+        metrics.set_request_id(request_id)
+        try:
+            with span('handler', handler=handler_name):
+                try:
+                    await handle_function(update, context)
+                finally:
+                    if coalesced and context.user_data['queued_messages'] == 1:
+                        await answer_unanswered_turn(update, context)
+        finally:
+            if coalesced:
+                context.user_data['queued_messages'] -= 1
+
+    async def queue_handle_function(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        user_id = str(update.effective_user.id)
+        request_id = metrics.new_request_id(update.update_id)
+        metrics.set_request_id(request_id)
+        metrics.updates_total.inc(handler=handler_name)
+        log_event('update received', handler=handler_name, user_id=user_id)
+        scheduler = context.bot_data['scheduler']
+        # documents and voice notes in batch mode become /batch jobs rather than turns, so they don't take part in bursts
+        coalesced = coalesce and not (context.user_data.get('batch_mode') and is_batch_job(update))
+        if not scheduler.submit(user_id, lambda: run_job(update, context, request_id, coalesced)):
+            log_event('queue full', level=logging.WARNING, user_id=user_id, n_pending=scheduler.n_pending)
+            await context.bot_data['delivery'].send(update.effective_chat.id, busy_message, markdown=False)
+            return
+        if coalesced:
+            context.user_data['queued_messages'] = context.user_data.get('queued_messages', 0)+1
+            generation = context.user_data.get('generation_task')
+            # without coalescing every message gets its own reply, so the reply being generated is left to finish
+            if cancel_superseded_replies and coalesce_window is not None and generation is not None and not generation.done():
+                # the reply being generated doesn't answer this message, which is merged into its turn instead
+                generation.cancel()
+                metrics.superseded_generations_total.inc()
+                log_event('cancelling the reply being generated', user_id=user_id)
+    return queue_handle_function
+
+async def post_init(application) -> None:
+    application.bot_data['conversations'].start()
+    application.bot_data['batch_processor'].start()
+    application.bot_data['config_task'] = asyncio.create_task(application.bot_data['config_watcher'].run())
+    if application.bot_data['metrics_port'] is not None:
+        application.bot_data['metrics_runner'] = await metrics.start_metrics_server(metrics_listen, application.bot_data['metrics_port'])
+
+async def post_stop(application) -> None:
+    # let the queued jobs finish while the bot can still send their replies
+    await application.bot_data['scheduler'].shutdown()
+    await application.bot_data['batch_processor'].close()
+
+async def post_shutdown(application) -> None:
+    if application.bot_data['config_task'] is not None:
+        application.bot_data['config_task'].cancel()
+    await application.bot_data['conversations'].close()
+    await application.bot_data['shared_state'].close()
+    if application.bot_data['metrics_runner'] is not None:
+        await application.bot_data['metrics_runner'].cleanup()
+
+
+### Async handler functions ###
+###############################
+async def generate_reply(context: ContextTypes.DEFAULT_TYPE, chat_id: int, request_messages: list, model: str, temperature: float, fallback_model: str, route: str, prompt_tokens: int, streamed: dict) -> str:
+    '''
+    Gets a response from the GPT model for a chat request and sends it to the chat.
+    With stream_responses enabled, the reply message is sent as soon as the first text arrives and then edited in place,
+    at most once every stream_edit_interval seconds, as more text is generated.
+    Streamed edits are sent as plain text, and the Markdown formatting is applied once, with the final edit.
+    The streamed dict is kept up to date with the reply message and its text so far, for when the generation is cancelled.
+    Once the response is complete, it is no longer cancelled by newer messages.
 
+    Args:
+    context (ContextTypes.DEFAULT_TYPE): the handler context
+    chat_id (int): the chat to send the reply to
+    request_messages (list): the openai-compatible messages of the request
+    model, temperature, fallback_model, route, prompt_tokens: the request parameters, as in interact_with_gpt_model
+    streamed (dict): updated with the 'reply' message sent so far and its 'text'
+
+    Returns:
+    gpt_response (str): the response from the GPT model as a string
+    '''
+    delivery = context.bot_data['delivery']
+    if not stream_responses:
+        gpt_response = await interact_with_gpt_model(context.bot_data['client'], request_messages, model=model, temperature=temperature, governor=context.bot_data['api_governor'], fallback_model=fallback_model, route=route, prompt_tokens=prompt_tokens)
+        context.user_data.pop('generation_task', None)
+        with span('telegram_send'):
+            await delivery.send(chat_id, gpt_response)
+        return gpt_response
+    t0 = time.time()
+    gpt_response = ''
+    reply = None
+    shown_text = ''
+    last_edit_time = 0
+    async with contextlib.aclosing(stream_gpt_model(context.bot_data['client'], request_messages, model=model, temperature=temperature, governor=context.bot_data['api_governor'], fallback_model=fallback_model, route=route, prompt_tokens=prompt_tokens)) as stream:
+        async for text in stream:
+            gpt_response += text
+            streamed['text'] = gpt_response
+            if reply is None:
+                log_event('first token received', seconds=round(time.time()-t0, 3))
+                with span('telegram_send', streamed=True):
+                    reply = streamed['reply'] = (await delivery.send(chat_id, gpt_response, markdown=False))[0]
+                shown_text = gpt_response
+                last_edit_time = time.time()
+            elif time.time()-last_edit_time >= stream_edit_interval and gpt_response.strip() != shown_text.strip():
+                # the preview shows the beginning of the response, and is skipped while the chat is under flood control
+                if await delivery.edit_preview(reply, gpt_response):
+                    shown_text = gpt_response
+                last_edit_time = time.time()
+    log_event('streamed response', seconds=round(time.time()-t0, 3))
+    context.user_data.pop('generation_task', None)
+    with span('telegram_send', final=True):
+        if reply is None:
+            await delivery.send(chat_id, gpt_response)
+        else:
+            # finalize with Markdown, split into more messages if the response is too long for one
+            await delivery.edit(reply, gpt_response)
+    return gpt_response
+
+async def respond_with_gpt_model(update: Update, context: ContextTypes.DEFAULT_TYPE, conversation: Conversation) -> str:
+    '''
+    Gets a response from the GPT model for the user's conversation, sends it to the chat and appends it to the conversation.
+    The oldest turns are dropped first if the conversation doesn't fit the model's token budget,
+    and after the reply was sent, older turns are compacted into a summary in the background.
+    If the user attached large documents, their chunks most relevant to the latest message are sent with it,
+    but not added to the conversation, so later turns don't carry them.
+    Photos are replaced with text descriptions in the background once answered, and the latest one is sent again
+    only with a message that refers to a photo.
+    Each request is sent to the model of its route (see route_request), and its answer time is recorded per route and model.
+    With enable_response_cache, identical requests are answered from the response cache without calling the API.
+    Otherwise the reply is generated and sent by generate_reply, in a task that a newer message of the user cancels
+    while the reply is being generated (see cancel_superseded_replies): the turn is then left unanswered,
+    and answered together with the newer message.
+    Replies are delivered by the MessageDelivery in bot_data, which splits long ones into several messages,
+    repairs their Markdown with a plain text fallback, and handles Telegram's flood control.
+
+    Args:
+    update (Update): the Telegram update being answered
+    context (ContextTypes.DEFAULT_TYPE): the handler context
+    conversation (Conversation): the user's conversation, ending with the message to respond to
+
+    Returns:
+    gpt_response (str): the response from the GPT model as a string
+    '''
+    chat_id = update.effective_chat.id
+    delivery = context.bot_data['delivery']
+    config = get_config(context)
+    temperature = config.temperature
+    document_excerpts = get_document_excerpts(context, str(update.effective_user.id), conversation)
+    reserved_tokens = count_message_tokens(document_excerpts, config.model) if document_excerpts is not None else 0
+    referenced_image_message = attach_referenced_image(context, conversation)
+    if referenced_image_message is not None:
+        reserved_tokens += count_message_tokens(referenced_image_message, config.model)-conversation.token_counts[-1]
+    trim_conversation_to_budget(conversation, config.model, reserved_tokens)
+    request_messages = conversation.messages
+    if referenced_image_message is not None:
+        request_messages = request_messages[:-1]+[referenced_image_message]
+    if document_excerpts is not None:
+        request_messages = request_messages[:-1]+[document_excerpts]+request_messages[-1:]
+    # the running token count of the conversation, so the request isn't encoded again for the rate limits
+    prompt_tokens = conversation.total_tokens+reserved_tokens
+    route, model, fallback_model = route_request(context, config, conversation, request_messages, document_excerpts is not None, prompt_tokens)
+    response_cache = context.bot_data['response_cache']
+    cache_key = response_cache.make_key(request_messages, model, temperature) if response_cache is not None else None
+    cached_response = response_cache.get(cache_key) if response_cache is not None else None
+    if response_cache is not None:
+        metrics.response_cache_total.inc(result='bypass' if cache_key is None else 'miss' if cached_response is None else 'hit')
+    t_route = time.perf_counter()
+    if cached_response is not None:
+        gpt_response = cached_response
+        log_event('response cache hit', **response_cache.stats())
+        with span('telegram_send'):
+            await delivery.send(chat_id, gpt_response)
+    else:
+        # the generation runs as a task, which a newer message of the user cancels (see queued_per_user)
+        streamed = {'reply': None, 'text': ''}
+        generation = asyncio.ensure_future(generate_reply(context, chat_id, request_messages, model, temperature, fallback_model, route, prompt_tokens, streamed))
+        context.user_data['generation_task'] = generation
+        try:
+            await asyncio.wait([generation])
+        finally:
+            generation.cancel()
+            context.user_data.pop('generation_task', None)
+        if generation.cancelled():
+            # the user turn stays unanswered, so the newer message is merged into it and both are answered together
+            log_event('reply superseded by a newer message', route=route, model=model, streamed_chars=len(streamed['text']))
+            context.user_data['unanswered_turn'] = True
+            if streamed['reply'] is not None:
+                await delivery.edit(streamed['reply'], streamed['text']+gpt_superseded_notice, markdown=False)
+            return None
+        gpt_response = generation.result()
+    if cached_response is None:
+        metrics.route_requests_total.inc(route=route, model=model)
+        metrics.route_seconds.observe(time.perf_counter()-t_route, route=route, model=model)
+    if cache_key is not None and cached_response is None and gpt_response != gpt_error_response and not gpt_response.endswith(gpt_interrupted_notice):
+        response_cache.put(cache_key, gpt_response)
+    
     # append the response to the chat
     message_dict_to_append = {
         'role': 'assistant',
         'content': gpt_response
     }
-    context.user_data['conversation'].append(message_dict_to_append)
+    conversation.append(message_dict_to_append)
+    context.user_data.pop('unanswered_turn', None)
+    user_id = str(update.effective_user.id)
+    context.bot_data['conversations'].mark_dirty(user_id, conversation)
+
+    # replace answered photos with descriptions and compact old turns into a summary in the background, now that the user has the reply
+    schedule_image_descriptions(context, user_id, conversation)
+    schedule_conversation_compaction(context, user_id, conversation)
+    return gpt_response
+
+async def respond_after_burst(update: Update, context: ContextTypes.DEFAULT_TYPE, conversation: Conversation) -> str:
+    '''
+    Responds to the user's latest message once their burst of messages is over: it waits coalesce_window seconds
+    for more messages, and leaves the message unanswered if a newer one is queued, since that one is merged into
+    the same turn (see Conversation.add_user_message) and answered together with it. A burst thus gets one reply.
+    With coalesce_window set to None, every message is answered on its own.
+
+    Args:
+    update (Update): the Telegram update being answered
+    context (ContextTypes.DEFAULT_TYPE): the handler context
+    conversation (Conversation): the user's conversation, ending with the message to respond to
+
+    Returns:
+    gpt_response (str): the response from the GPT model, None if the message is answered with a newer one
+    '''
+    if coalesce_window is None:
+        return await respond_with_gpt_model(update, context, conversation)
+    if context.user_data.get('queued_messages', 0) <= 1 and coalesce_window > 0:
+        await asyncio.sleep(coalesce_window)
+    if context.user_data.get('queued_messages', 0) > 1:
+        metrics.coalesced_messages_total.inc()
+        log_event('message coalesced with a newer one', n_queued=context.user_data['queued_messages']-1)
+        context.user_data['unanswered_turn'] = True
+        context.bot_data['conversations'].mark_dirty(str(update.effective_user.id), conversation)
+        return None
+    return await respond_with_gpt_model(update, context, conversation)
+
+async def answer_unanswered_turn(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    '''
+    Answers the user's turn if it was left unanswered for a newer message (see respond_after_burst and cancel_superseded_replies)
+    that then failed before joining it, e.g. a voice note that couldn't be transcribed. Called after the last queued message;
+    does nothing once the turn was answered.
+    '''
+    if not context.user_data.pop('unanswered_turn', False):
+        return
+    conversation = await context.bot_data['conversations'].get(str(update.effective_user.id))
+    if conversation is None or conversation.messages[-1].get('role') != 'user':
+        return
+    log_event('answering the turn left for a message that failed')
+    await respond_with_gpt_model(update, context, conversation)
+
+async def text_message_handle_function(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    message_dict_to_append = {
+        'role': 'user',
+        'content': update.message.text
+    }
+    # get the user's conversation, initialized with the system message if it's new
+    conversation = await get_conversation(update, context)
+
+    # append the user message to the conversation
+    conversation.add_user_message(message_dict_to_append)
+
+    ### interact with the GPT model, send the response to the user and append it to the chat
+    await respond_after_burst(update, context, conversation)
 
 async def start_restart_command_handle_function(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    # check if the user is in the allowed IDs list. If not, print an error and return
     user_id = str(update.effective_user.id)
-    if not user_id in context.bot_data['allowed_ids'] and len(context.bot_data['allowed_ids']) > 0:
-        text = f'You are not authorized to use this chatbot. Your user ID is {user_id}.'
-        await context.bot.send_message(chat_id=update.effective_chat.id, text=text)
+    # background work on the old conversation must not write it back after it's deleted
+    for task_key in ('compaction_task', 'image_description_task'):
+        task = context.user_data.pop(task_key, None)
+        if task is not None:
+            task.cancel()
+    context.bot_data['conversations'].delete(user_id)
+    context.bot_data['document_indexes'].delete(user_id)
+    context.user_data.pop('unanswered_turn', None)
+
+async def model_command_handle_function(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    '''
+    Handles the /model command: '/model' shows which model the user's messages go to, '/model <name>' pins one of the
+    selectable models (see get_selectable_models) for the user, and '/model auto' goes back to routing each message.
+    '''
+    config = get_config(context)
+    selectable_models = get_selectable_models(config)
+    choice = context.args[0].lower() if context.args else None
+    if choice == 'auto':
+        context.user_data.pop('model_override', None)
+    elif choice in selectable_models:
+        context.user_data['model_override'] = choice
+    elif choice is not None:
+        await context.bot_data['delivery'].send(update.effective_chat.id, f'Unknown model {choice}. Choose one of: auto, {", ".join(selectable_models)}.', markdown=False)
         return
-    context.user_data['conversation'] = []
+    override = context.user_data.get('model_override')
+    if override is not None:
+        text = f'Your messages go to {override}. Send /model auto to have each message go to the model suited to it.'
+    elif routing_policy == 'fixed':
+        text = f'Your messages go to {config.model}.'
+    else:
+        text = f'Each of your messages goes to the model suited to it. Send /model <name> to always use one of: {", ".join(selectable_models)}.'
+    await context.bot_data['delivery'].send(update.effective_chat.id, text, markdown=False)
 
-async def voice_message_handle_function(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = str(update.effective_user.id)
+async def batch_command_handle_function(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    '''
+    Handles the /batch command: '/batch' or '/batch on' switches the user to batch mode, where documents and voice notes
+    are summarized by jobs sent to the OpenAI Batch API, at a lower cost, instead of being answered at once;
+    '/batch off' switches back, and '/batch status' shows the mode and the user's jobs waiting for their results.
+    Text messages and photos are answered at once in either mode, and queued jobs are completed in either mode.
+    '''
+    choice = context.args[0].lower() if context.args else 'on'
+    if choice == 'on':
+        context.user_data['batch_mode'] = True
+    elif choice == 'off':
+        context.user_data.pop('batch_mode', None)
+    elif choice != 'status':
+        await context.bot_data['delivery'].send(update.effective_chat.id, f'Unknown option {choice}. Send /batch on, /batch off or /batch status.', markdown=False)
+        return
+    n_jobs = await context.bot_data['batch_processor'].count_for(str(update.effective_user.id))
+    if context.user_data.get('batch_mode'):
+        text = (f'Batch mode is on: documents and voice notes you send are summarized in the background, at a lower cost, '
+                f'and the results are sent here within {batch_completion_window}. Add a caption to ask for something else. Send /batch off to get answers at once.')
+    else:
+        text = 'Batch mode is off: documents and voice notes are answered at once. Send /batch on to summarize many of them in the background, at a lower cost.'
+    if n_jobs:
+        text += f' {n_jobs} of your jobs are waiting for their results.'
+    await context.bot_data['delivery'].send(update.effective_chat.id, text, markdown=False)
 
-    # make sure the conversation is initialized and the system message is added
-    init_conversation_and_system_message(context)
+async def transcribe_voice_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> str:
+    '''
+    Downloads the voice message of an update, optionally converts it, and transcribes it.
+    If a step fails, the user is informed.
 
-    # make sure previous audio files are deleted
-    try:
-        os.remove(user_id+'_chatbot_audio_file.mp3')
-    except Exception as e:
-        pass
+    Returns:
+    transcript (str): the text of the voice message, or None if it could not be transcribed
+    '''
+    ### download the voice message into memory
     try:
-        os.remove(user_id+'_chatbot_audio_file.opus')
+        with span('telegram_download', media='voice'):
+            fid = update.message.voice.file_id
+            voice_file = await context.bot.get_file(fid)
+            audio_bytes = bytes(await voice_file.download_as_bytearray())
+        filename = 'voice.ogg'  # Telegram voice messages are ogg/opus
     except Exception as e:
-        pass
+        log_event('error downloading voice file', level=logging.ERROR, error=str(e))
+        await context.bot_data['delivery'].send(update.effective_chat.id, f'Error transcripting voice message, encountered an error while downloading the voice file: {e}', markdown=False)
+        return None
 
-    ### download the voice message
-    try:
-        fid = update.message.voice.file_id
-        voice_file = await context.bot.get_file(fid)
-        path = user_id+'_chatbot_audio_file.opus'
-        await voice_file.download_to_drive(custom_path=path)
-    except Exception as e:
-        print('error downloading voice file: ',e)
-        await context.bot.send_message(chat_id=update.effective_chat.id, text=f'Error transcripting voice message, encountered an error while downloading the voice file: {e}')
-        return
+    ### optionally convert the voice message to another format
+    if voice_transcode_format:
+        try:
+            with span('transcode', output_format=voice_transcode_format):
+                audio_bytes = await transcode_audio(audio_bytes, voice_transcode_format)
+            filename = 'voice.'+voice_transcode_format
+        except Exception as e:
+            log_event('error converting voice file', level=logging.ERROR, error=str(e))
+            await context.bot_data['delivery'].send(update.effective_chat.id, f'Error transcripting voice message, encountered an error while converting the audio file: {e}', markdown=False)
+            return None
 
-    ### convert the voice message to mp3
-    try:
-        os.system('ffmpeg -i '+path+' -ac 2 -b:a 192k '+user_id+'_chatbot_audio_file.mp3')
-    except Exception as e:
-        print('error converting voice file: ',e)
-        await context.bot.send_message(chat_id=update.effective_chat.id, text=f'Error transcripting voice message, encountered an error while converting the audio file: {e}')
-        return
-    
-    ### transcribe the mp3 file to text
-    s, success = transcribe_mp3_to_text(user_id+'_chatbot_audio_file.mp3', context.bot_data['client'])
+    ### transcribe the audio to text
+    s, success = await transcribe_audio_to_text(audio_bytes, filename, context.bot_data['client'], context.bot_data['api_governor'])
     if not success:
-        await context.bot.send_message(chat_id=update.effective_chat.id, text=s)
-        return
+        await context.bot_data['delivery'].send(update.effective_chat.id, s, markdown=False)
+        return None
     # if success, continue
-    await context.bot.send_message(chat_id=update.effective_chat.id, text='transcripted voice message:\n'+s, parse_mode='Markdown')
-    try:
-        os.remove(user_id+'_chatbot_audio_file.mp3')
-        os.remove(user_id+'_chatbot_audio_file.opus')
-    except Exception as e:
-        pass
-    
+    await context.bot_data['delivery'].send(update.effective_chat.id, 'transcripted voice message:\n'+s)
+    return s
+
+async def voice_message_handle_function(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    s = await transcribe_voice_message(update, context)
+    if s is None:
+        return
+
+    # in batch mode, the transcript is summarized by a /batch job instead of being answered
+    if context.user_data.get('batch_mode'):
+        await queue_batch_job(update, context, 'voice', f'Voice note of {update.message.date:%Y-%m-%d %H:%M} UTC', s)
+        return
+
+    # get the user's conversation, initialized with the system message if it's new
+    conversation = await get_conversation(update, context)
+
     # append the user message to the conversation
     message_to_append = {
         'role': 'user',
         'content': s
     }
-    context.user_data['conversation'].append(message_to_append)
-
-    ### interact with the GPT model
-    gpt_response = interact_with_gpt_model(context.bot_data['client'], context.user_data['conversation'], model=default_gpt_model, temperature=temperature)
+    conversation.add_user_message(message_to_append)
 
-    # send the response to the user
-    await context.bot.send_message(chat_id=update.effective_chat.id, text=gpt_response, parse_mode='Markdown')
+    ### interact with the GPT model, send the response to the user and append it to the chat
+    await respond_after_burst(update, context, conversation)
 
-    # append the response to the chat
-    message_dict_to_append = {
-        'role': 'assistant',
-        'content': gpt_response
-    }
-    context.user_data['conversation'].append(message_dict_to_append)
-
-async def text_file_handle_function(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = str(update.effective_user.id)
-
-    # make sure there are no previous attachment files
-    try:
-        os.remove(user_id+'_chatbot_text_file')
-    except Exception:
-        pass
-
-    # make sure the conversation is initialized and the system message is added
-    init_conversation_and_system_message(context)
+async def read_attached_document(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Tuple[list, int]:
+    '''
+    Downloads the document of an update and reads it into chunks, in the media worker pool.
+    If a step fails, the user is informed.
 
-    # download the file
+    Returns:
+    chunks (list): the (text, token count) chunks of the document, or None if it could not be read
+    n_tokens (int): the token count of the whole document
+    '''
+    # download the file into memory
     try:
-        fid = update.message.document.file_id
-        doc_file = await context.bot.get_file(fid)
-        path = user_id+'_chatbot_text_file'
-        await doc_file.download_to_drive(custom_path=path)
+        with span('telegram_download', media='document'):
+            fid = update.message.document.file_id
+            doc_file = await context.bot.get_file(fid)
+            file_bytes = await doc_file.download_as_bytearray()
     except Exception as e:
-        print('error downloading file: ',e)
-        await context.bot.send_message(chat_id=update.effective_chat.id, text=f'Error processing file, encountered an error while downloading the file: {e}')
-        return
+        log_event('error downloading file', level=logging.ERROR, error=str(e))
+        await context.bot_data['delivery'].send(update.effective_chat.id, f'Error processing file, encountered an error while downloading the file: {e}', markdown=False)
+        return None, 0
     
-    # try to read the file into a string
+    # decode the file and split it into chunks, in the media worker pool
     try:
-        with open(path, 'r') as file:
-            s = file.read()
+        with span('read_document', size=len(file_bytes)):
+            chunks, n_tokens, encoding = await context.bot_data['scheduler'].run_in_executor(read_document, file_bytes, get_config(context).model, document_chunk_tokens)
     except Exception as e:
-        print('error reading file: ',e)
-        await context.bot.send_message(chat_id=update.effective_chat.id, text=f'Error processing file, encountered an error while reading the file: {e}')
+        log_event('error reading file', level=logging.ERROR, error=str(e))
+        await context.bot_data['delivery'].send(update.effective_chat.id, f'Error processing file, encountered an error while reading the file: {e}', markdown=False)
+        return None, 0
+    log_event('read document', file_name=update.message.document.file_name, size=len(file_bytes), encoding=encoding, n_tokens=n_tokens, n_chunks=len(chunks))
+    return chunks, n_tokens
+
+async def text_file_handle_function(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chunks, n_tokens = await read_attached_document(update, context)
+    if chunks is None:
         return
-    
-    # append the attachment caption to the conversation, if it exists, and append the entire text to the conversation
+    file_name = update.message.document.file_name or 'document'
+
+    # in batch mode, the document is summarized by a /batch job instead of being added to the conversation
+    if context.user_data.get('batch_mode'):
+        text, n_kept = join_chunks(chunks, batch_document_tokens)
+        if n_kept < len(chunks):
+            text += f'\n[The rest of the document, {len(chunks)-n_kept} of {len(chunks)} parts, was cut.]'
+        await queue_batch_job(update, context, 'document', file_name, text)
+        return
+
+    # get the user's conversation, initialized with the system message if it's new
+    conversation = await get_conversation(update, context)
+
+    if n_tokens <= inline_document_tokens:
+        # a small file is added to the conversation whole
+        s = ''.join(text for text, _ in chunks)
+    else:
+        # a large file is indexed, and only its chunks relevant to each message are sent with it
+        document_indexes = context.bot_data['document_indexes']
+        document_index = document_indexes.get_or_add(str(update.effective_user.id))
+        document_name = file_name.replace('"', "'")  # the name is quoted in the note, see forget_unindexed_documents
+        with span('index_document', n_chunks=len(chunks)):
+            # the index lives in this process, so it is built in a thread rather than in the media worker pool
+            await asyncio.to_thread(document_index.add_document, document_name, chunks)
+        n_evicted = document_indexes.evict()
+        if n_evicted > 0:
+            log_event('evicted document indexes', n_evicted=n_evicted, n_cached=len(document_indexes))
+        s = f'[Attached document "{document_name}": {n_tokens} tokens in {len(chunks)} parts. {document_note_suffix}]'
+        if len(chunks) > max_document_chunks:
+            s = s[:-1]+f' Only the first {max_document_chunks} parts could be kept.]'
+
+    # append the attachment caption to the conversation, if it exists
     if update.message.caption:
         s =  update.message.caption + '\n' + s
     message_to_append = {
         'role': 'user',
         'content': s
     }
-    context.user_data['conversation'].append(message_to_append)
-
-    ### interact with the GPT model
-    gpt_response = interact_with_gpt_model(context.bot_data['client'], context.user_data['conversation'], model=default_gpt_model, temperature=temperature)
+    conversation.add_user_message(message_to_append)
 
-    # send the response to the user
-    await context.bot.send_message(chat_id=update.effective_chat.id, text=gpt_response, parse_mode='Markdown')
-
-    # append the response to the chat
-    message_dict_to_append = {
-        'role': 'assistant',
-        'content': gpt_response
-    }
-    context.user_data['conversation'].append(message_dict_to_append)
-
-    # remove the file
-    try:
-        os.remove(user_id+'_chatbot_text_file')
-    except Exception:
-        pass
+    ### interact with the GPT model, send the response to the user and append it to the chat
+    await respond_after_burst(update, context, conversation)
 
 async def image_file_handle_function(update: Update, context: ContextTypes.DEFAULT_TYPE):
     '''
-    Handles image messages by using the openai vision API to generate a description of the image.
-    from openai import OpenAI.
-    API snippet from openai.com:
-
-    response = client.chat.completions.create(
-    model="gpt-4-turbo",
-    messages=[
-        {
-        "role": "user",
-        "content": [
-            {"type": "text", "text": "What’s in this image?"},
-            {
-            "type": "image_url",
-            "image_url": {
-                "url": "https://upload.wikimedia.org/wikipedia/commons/thumb/d/dd/Gfp-wisconsin-madison-the-nature-boardwalk.jpg/2560px-Gfp-wisconsin-madison-the-nature-boardwalk.jpg",
-            },
-            },
-        ],
-        }
-    ],
-    max_tokens=300,
-    )
+    Handles photo messages with the openai vision API.
+    The detail level is chosen from the caption, and the smallest size of the photo adequate for it is downloaded
+    and cached as a data URL by its file_unique_id, since Telegram file URLs expire.
+    After the reply, the photo is replaced in the conversation with its description (see describe_answered_images).
     '''
-    # make sure the conversation is initialized and the system message is added
-    init_conversation_and_system_message(context)
-
-    # get the image file's url
-    fid = update.message.photo[-1].file_id
-    image_file = await context.bot.get_file(fid)
-    image_url = str(image_file.file_path)
+    # get the user's conversation, initialized with the system message if it's new
+    conversation = await get_conversation(update, context)
+
+    # pick the detail level and the smallest adequate size of the photo
+    caption = update.message.caption or ''
+    detail = choose_image_detail(caption, default_image_detail)
+    photo_size = choose_photo_size(update.message.photo, detail)
+    image_id = photo_size.file_unique_id
+    image_cache = context.bot_data['image_cache']
+    cached_image = image_cache.get(image_id)
+    if cached_image is not None:
+        image_url = cached_image[0]
+    else:
+        # download the photo into memory
+        try:
+            with span('telegram_download', media='photo', width=photo_size.width, height=photo_size.height, detail=detail):
+                image_file = await context.bot.get_file(photo_size.file_id)
+                image_bytes = await image_file.download_as_bytearray()
+        except Exception as e:
+            log_event('error downloading photo', level=logging.ERROR, error=str(e))
+            await context.bot_data['delivery'].send(update.effective_chat.id, f'Error processing photo, encountered an error while downloading the photo: {e}', markdown=False)
+            return
+        image_url = make_data_url(image_bytes)
+        image_cache.put(image_id, image_url, detail)
 
-    # append the image caption to the conversation, if it exists
-    s =  update.message.caption
-    if s is None:
-        s = ''
+    # append the photo, with its caption, to the conversation
     message_to_append={
         "role": "user",
         "content": [
-            {"type": "text", "text": s},
-            # {"type": "text", "text": "What’s in this image?"},
+            {"type": "text", "text": caption},
             {
                 "type": "image_url",
                 "image_url": {
                     "url": image_url,
+                    "detail": detail,
                 },
             },
         ],
     }
-    context.user_data['conversation'].append(message_to_append)
-
-    ### interact with the GPT model
-    gpt_response = interact_with_gpt_model(context.bot_data['client'], context.user_data['conversation'], model=default_gpt_model, temperature=temperature)
-
-    # send the response to the user
-    await context.bot.send_message(chat_id=update.effective_chat.id, text=gpt_response, parse_mode='Markdown')
+    conversation.add_user_message(message_to_append)
 
-    # append the response to the chat
-    message_dict_to_append = {
-        'role': 'assistant',
-        'content': gpt_response
-    }
-    context.user_data['conversation'].append(message_dict_to_append)
+    ### interact with the GPT model, send the response to the user and append it to the chat
+    await respond_after_burst(update, context, conversation)
 
 
 
@@ -0,0 +1,135 @@
+'''
+Settings of the chatbot that can change while it runs: the allowed user IDs, the system prompt, and the chat model,
+temperature and model routes. They are read from their files once, on first use, into a snapshot,
+and a watcher polls the files' modification times and swaps in a new snapshot when one of them changes.
+Each request reads the snapshot once, so it is sent with one consistent configuration, and conversations in flight
+are kept: a changed system prompt is applied to each conversation at its next message.
+'''
+
+import asyncio, json, logging, os
+from typing import Callable, List
+
+import metrics
+from metrics import log_event
+
+
+class BotConfig:
+    '''
+    A snapshot of the reloadable settings. It is not changed once loaded: a reload builds a new one.
+
+    Args:
+    allowed_ids (frozenset): the user IDs (as strings) allowed to use the bot, empty to allow everyone
+    system_message_dict (dict): the openai-compatible system message
+    model (str): the model of requests not routed elsewhere
+    temperature (float): the temperature of chat requests
+    model_routes (dict): the model of each route
+    '''
+    def __init__(self, allowed_ids:frozenset, system_message_dict:dict, model:str, temperature:float, model_routes:dict):
+        self.allowed_ids = frozenset(allowed_ids)
+        self.system_message_dict = system_message_dict
+        self.model = model
+        self.temperature = temperature
+        self.model_routes = dict(model_routes)
+
+    def is_allowed(self, user_id:str) -> bool:
+        '''
+        Returns True if the user may use the bot: everyone may if no allowed IDs are set.
+        '''
+        return not self.allowed_ids or user_id in self.allowed_ids
+
+
+def read_settings(settings_file:str) -> dict:
+    '''
+    Reads the optional settings file, a JSON object with any of the keys 'model' (str), 'temperature' (number between 0 and 2)
+    and 'model_routes' (object mapping routes to models), and returns them as a dict, empty if the file does not exist.
+
+    Raises:
+    ValueError: if the file is not a JSON object or a setting has the wrong type
+    '''
+    if not os.path.exists(settings_file):
+        return {}
+    with open(settings_file, encoding='utf-8') as file:
+        settings = json.load(file)
+    if not isinstance(settings, dict):
+        raise ValueError(f'{settings_file} must contain a JSON object')
+    unknown = set(settings)-{'model', 'temperature', 'model_routes'}
+    if unknown:
+        raise ValueError(f'unknown settings in {settings_file}: {", ".join(sorted(unknown))}')
+    if 'model' in settings and not (isinstance(settings['model'], str) and settings['model']):
+        raise ValueError('model must be a model name')
+    if 'temperature' in settings and not (isinstance(settings['temperature'], (int, float)) and 0 <= settings['temperature'] <= 2):
+        raise ValueError('temperature must be a number between 0 and 2')
+    if 'model_routes' in settings and not (isinstance(settings['model_routes'], dict) and all(isinstance(model, str) for model in settings['model_routes'].values())):
+        raise ValueError('model_routes must map routes to model names')
+    return settings
+
+
+class ConfigWatcher:
+    '''
+    Holds the current BotConfig: loads it on first access, and reloads it when one of the watched files is created,
+    changed or deleted, as checked every poll_interval seconds by run(). A config that fails to load is logged
+    and the previous one is kept. The new config replaces the old one in a single assignment, so readers see
+    either the old or the new one, never a mix.
+
+    Args:
+    load (Callable[[], BotConfig]): reads the files and returns a new config
+    paths (List[str]): the files the config is read from
+    poll_interval (float): seconds between checks of the files, defaults to 2
+    '''
+    def __init__(self, load:Callable[[], BotConfig], paths:List[str], poll_interval:float=2):
+        self.load = load
+        self.paths = list(paths)
+        self.poll_interval = poll_interval
+        self._config = None
+        self._file_states = None
+
+    @property
+    def config(self) -> BotConfig:
+        if self._config is None:
+            self._file_states = self._get_file_states()
+            self._config = self.load()
+        return self._config
+
+    def _get_file_states(self) -> tuple:
+        states = []
+        for path in self.paths:
+            try:
+                stat = os.stat(path)
+                states.append((stat.st_mtime_ns, stat.st_size))
+            except OSError:
+                states.append(None)
+        return tuple(states)
+
+    def reload_if_changed(self) -> bool:
+        '''
+        Reloads the config if one of the files changed since it was loaded.
+
+        Returns:
+        reloaded (bool): True if a new config was loaded
+        '''
+        if self._config is None:
+            self.config
+            return True
+        # the file states are taken before reading, so a change made while reading is picked up by the next check
+        file_states = self._get_file_states()
+        if file_states == self._file_states:
+            return False
+        self._file_states = file_states
+        try:
+            config = self.load()
+        except Exception as e:
+            metrics.config_reloads_total.inc(result='error')
+            log_event('error reloading config, keeping the previous one', level=logging.ERROR, error=str(e))
+            return False
+        self._config = config
+        metrics.config_reloads_total.inc(result='ok')
+        log_event('config reloaded', n_allowed_ids=len(config.allowed_ids), model=config.model, temperature=config.temperature)
+        return True
+
+    async def run(self) -> None:
+        '''
+        Checks the files every poll_interval seconds until cancelled.
+        '''
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            self.reload_if_changed()
@@ -0,0 +1,275 @@
+'''
+Token-budgeted conversation history for the chatbot.
+A Conversation keeps the openai-compatible message list together with the token count of every message,
+so the size of the prompt is known without re-encoding the whole history on every turn,
+and the oldest turns can be dropped, or replaced with a summary, to keep the prompt within a token budget.
+'''
+
+import json
+from typing import Callable
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+
+tokens_per_message = 3  # every message is wrapped in a few formatting tokens by the chat format
+tokens_per_reply = 3  # every reply is primed with a few formatting tokens
+image_tokens = {'low': 85, 'high': 765, 'auto': 765}  # vision tokens are not part of the text, use OpenAI's per-image estimates
+fallback_encodings = ['o200k_base', 'cl100k_base']  # tried in order when tiktoken does not know the model
+
+_token_counters = {}
+
+
+def get_token_counter(model:str) -> Callable[[str], int]:
+    '''
+    Returns a function that counts the tokens of a string for the given model.
+    The tokenizer is loaded once per model and cached. If tiktoken is not installed or the tokenizer can't be loaded
+    (e.g. no network access to download it), an estimate of 4 characters per token is used instead.
+
+    Args:
+    model (str): the name of the GPT model
+
+    Returns:
+    count_tokens (Callable[[str], int]): a function returning the number of tokens in a string
+    '''
+    if model in _token_counters:
+        return _token_counters[model]
+    encoding = None
+    if tiktoken is not None:
+        try:
+            encoding = tiktoken.encoding_for_model(model)
+        except Exception:
+            for encoding_name in fallback_encodings:
+                try:
+                    encoding = tiktoken.get_encoding(encoding_name)
+                    break
+                except Exception:
+                    continue
+    if encoding is not None:
+        count_tokens = lambda text: len(encoding.encode(text, disallowed_special=()))
+    else:
+        print(f'no tokenizer available for model {model}, estimating token counts from text length')
+        count_tokens = lambda text: (len(text)+3)//4
+    _token_counters[model] = count_tokens
+    return count_tokens
+
+def count_message_tokens(message:dict, model:str) -> int:
+    '''
+    Counts the prompt tokens taken by one openai-compatible message dict, including text and image content parts.
+
+    Args:
+    message (dict): the message, with 'role' and 'content' keys
+    model (str): the name of the GPT model
+
+    Returns:
+    n_tokens (int): the number of tokens of the message
+    '''
+    count_tokens = get_token_counter(model)
+    n_tokens = tokens_per_message + count_tokens(message.get('role', ''))
+    content = message.get('content') or ''
+    if isinstance(content, str):
+        return n_tokens + count_tokens(content)
+    for part in content:
+        if part.get('type') == 'text':
+            n_tokens += count_tokens(part.get('text') or '')
+        elif part.get('type') == 'image_url':
+            n_tokens += image_tokens.get(part['image_url'].get('detail', 'auto'), image_tokens['auto'])
+        else:
+            n_tokens += count_tokens(json.dumps(part))
+    return n_tokens
+
+def merge_user_messages(first:dict, second:dict) -> dict:
+    '''
+    Merges two consecutive user messages into one, e.g. a thought typed across several quick messages.
+    Texts are joined by a line break; if either message has content parts (e.g. a photo), the parts are concatenated.
+    '''
+    first_content, second_content = first.get('content') or '', second.get('content') or ''
+    if isinstance(first_content, str) and isinstance(second_content, str):
+        return {'role': 'user', 'content': '\n'.join(text for text in (first_content, second_content) if text)}
+    to_parts = lambda content: [{'type': 'text', 'text': content}] if isinstance(content, str) else list(content)
+    parts = [part for part in to_parts(first_content)+to_parts(second_content) if part.get('type') != 'text' or part.get('text')]
+    return {'role': 'user', 'content': parts}
+
+
+class Conversation:
+    '''
+    The message history of one chat, with a running token count.
+    The first message is the system message, which is pinned: it is never dropped by trim().
+    Once older turns have been compacted with apply_summary(), the summary message is pinned right after it.
+    The object can be used like the message list it wraps (len, indexing, iteration, append),
+    and the list itself, to be sent to the API, is the messages attribute.
+
+    Args:
+    system_message_dict (dict): the openai-compatible system message to pin at the start of the conversation
+    model (str): the name of the GPT model whose tokenizer is used for counting
+    '''
+    def __init__(self, system_message_dict:dict, model:str):
+        self.model = model
+        self.messages = []
+        self.token_counts = []
+        self.total_tokens = tokens_per_reply
+        self.n_pinned = 0
+        self.summary = ''
+        self.append(system_message_dict)
+        self.n_pinned = 1
+
+    def __len__(self) -> int:
+        return len(self.messages)
+
+    def __getitem__(self, index):
+        return self.messages[index]
+
+    def __iter__(self):
+        return iter(self.messages)
+
+    def append(self, message:dict):
+        '''
+        Appends a message to the conversation, counting only the tokens of the new message.
+        '''
+        n_tokens = count_message_tokens(message, self.model)
+        self.messages.append(message)
+        self.token_counts.append(n_tokens)
+        self.total_tokens += n_tokens
+
+    def add_user_message(self, message:dict) -> bool:
+        '''
+        Appends a user message, or merges it into the latest message if that is a user message that was not answered
+        (e.g. its reply was superseded by this message), so consecutive user messages are answered as one turn.
+
+        Returns:
+        merged (bool): True if the message was merged into the previous one
+        '''
+        if len(self.messages) > self.n_pinned and self.messages[-1].get('role') == 'user':
+            self.replace(len(self.messages)-1, merge_user_messages(self.messages[-1], message))
+            return True
+        self.append(message)
+        return False
+
+    def set_system_message(self, system_message_dict:dict):
+        '''
+        Replaces the pinned system message, e.g. after the system prompt was changed.
+        '''
+        n_tokens = count_message_tokens(system_message_dict, self.model)
+        self.total_tokens += n_tokens - self.token_counts[0]
+        self.messages[0] = system_message_dict
+        self.token_counts[0] = n_tokens
+
+    def replace(self, index:int, message:dict):
+        '''
+        Replaces the message at index, e.g. a photo with its text description, updating the token count.
+        '''
+        n_tokens = count_message_tokens(message, self.model)
+        self.total_tokens += n_tokens - self.token_counts[index]
+        self.messages[index] = message
+        self.token_counts[index] = n_tokens
+
+    def _drop(self, index:int):
+        self.total_tokens -= self.token_counts.pop(index)
+        self.messages.pop(index)
+
+    def trim(self, token_budget:int) -> int:
+        '''
+        Drops the oldest unpinned messages until the conversation fits the token budget.
+        The latest message is always kept, even if it doesn't fit the budget on its own,
+        and the kept history never starts with an assistant message whose user message was dropped.
+
+        Args:
+        token_budget (int): the max number of prompt tokens
+
+        Returns:
+        n_dropped (int): the number of messages dropped
+        '''
+        n_dropped = 0
+        while self.total_tokens > token_budget and len(self.messages) > self.n_pinned+1:
+            self._drop(self.n_pinned)
+            n_dropped += 1
+            while len(self.messages) > self.n_pinned+1 and self.messages[self.n_pinned].get('role') == 'assistant':
+                self._drop(self.n_pinned)
+                n_dropped += 1
+        return n_dropped
+
+    def summarizable_segment(self, keep_recent_tokens:int) -> list:
+        '''
+        Returns the oldest unpinned messages that can be compacted into the summary,
+        leaving at least keep_recent_tokens of the most recent turns as they are.
+        The segment ends before a user message, so a user message and its reply are never split.
+
+        Args:
+        keep_recent_tokens (int): the number of tokens of recent messages to leave out of the segment
+
+        Returns:
+        segment (list): the messages to summarize, oldest first, possibly empty
+        '''
+        recent_tokens = 0
+        end = len(self.messages)
+        while end > self.n_pinned and recent_tokens < keep_recent_tokens:
+            end -= 1
+            recent_tokens += self.token_counts[end]
+        while self.n_pinned < end < len(self.messages) and self.messages[end].get('role') != 'user':
+            end -= 1
+        return self.messages[self.n_pinned:end]
+
+    def apply_summary(self, segment:list, summary:str) -> bool:
+        '''
+        Replaces a segment returned by summarizable_segment() with a summary message pinned after the system message.
+        The summary should cover the previous summary too, since it replaces it.
+        Nothing is changed if the segment is no longer at the start of the unpinned history
+        (e.g. the conversation was trimmed or restarted while the summary was being generated).
+
+        Args:
+        segment (list): the summarized messages
+        summary (str): the summary text
+
+        Returns:
+        applied (bool): True if the segment was replaced with the summary
+        '''
+        start = self.n_pinned
+        current = self.messages[start:start+len(segment)]
+        if len(segment) == 0 or len(current) != len(segment) or any(a is not b for a, b in zip(current, segment)):
+            return False
+        for _ in segment:
+            self._drop(start)
+        summary_message_dict = {
+            'role': 'system',
+            'content': 'Summary of the earlier part of this conversation: '+summary
+        }
+        n_tokens = count_message_tokens(summary_message_dict, self.model)
+        if self.n_pinned == 2:
+            self.total_tokens += n_tokens - self.token_counts[1]
+            self.messages[1] = summary_message_dict
+            self.token_counts[1] = n_tokens
+        else:
+            self.messages.insert(1, summary_message_dict)
+            self.token_counts.insert(1, n_tokens)
+            self.total_tokens += n_tokens
+            self.n_pinned = 2
+        self.summary = summary
+        return True
+
+    def to_dict(self) -> dict:
+        '''
+        Returns the conversation as a JSON-serializable dict, including the token counts so they don't have to be recomputed on loading.
+        The message list is copied, so the dict can be serialized while the conversation keeps changing.
+        '''
+        return {
+            'model': self.model,
+            'messages': list(self.messages),
+            'token_counts': list(self.token_counts),
+            'n_pinned': self.n_pinned,
+            'summary': self.summary,
+        }
+
+    @classmethod
+    def from_dict(cls, data:dict) -> 'Conversation':
+        '''
+        Creates a conversation from a dict returned by to_dict().
+        '''
+        conversation = cls.__new__(cls)
+        conversation.model = data['model']
+        conversation.messages = data['messages']
+        conversation.token_counts = data['token_counts']
+        conversation.total_tokens = tokens_per_reply + sum(conversation.token_counts)
+        conversation.n_pinned = data['n_pinned']
+        conversation.summary = data['summary']
+        return conversation
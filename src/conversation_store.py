@@ -0,0 +1,197 @@
+'''
+Persistence for the chatbot's conversations.
+A ConversationStore backend keeps the conversations of all users on disk, and a ConversationCache keeps the conversations
+of recently active users in memory in front of it: a user's history is loaded on their first message after startup,
+changes are written back in batches in the background, and idle users' histories are evicted from memory.
+'''
+
+import asyncio, json, logging, sqlite3, time, weakref, zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+from conversation import Conversation
+from metrics import log_event
+
+
+class ConversationStore:
+    '''
+    Interface of a conversation persistence backend.
+    Conversations are stored as the dicts returned by Conversation.to_dict(), keyed by user ID.
+    The methods are blocking; ConversationCache calls them from a single background thread.
+    '''
+    def load(self, user_id:str) -> Optional[dict]:
+        raise NotImplementedError
+
+    def save_many(self, conversations:dict) -> None:
+        '''
+        Saves several conversations at once. A None value deletes the user's conversation.
+        '''
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+
+class SQLiteConversationStore(ConversationStore):
+    '''
+    Stores conversations in an SQLite database file, one row per user, as zlib-compressed JSON.
+
+    Args:
+    filename (str): the path of the database file, created if it doesn't exist
+    '''
+    def __init__(self, filename:str):
+        self.filename = filename
+        # the connection is used from the store thread of ConversationCache only, not from the thread that creates it
+        self.connection = sqlite3.connect(filename, timeout=30, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS conversations (user_id TEXT PRIMARY KEY, data BLOB NOT NULL, updated REAL NOT NULL)')
+        self.connection.commit()
+
+    def load(self, user_id:str) -> Optional[dict]:
+        row = self.connection.execute('SELECT data FROM conversations WHERE user_id = ?', (user_id,)).fetchone()
+        if row is None:
+            return None
+        return json.loads(zlib.decompress(row[0]))
+
+    def save_many(self, conversations:dict) -> None:
+        now = time.time()
+        upserts = []
+        deletes = []
+        for user_id, data in conversations.items():
+            if data is None:
+                deletes.append((user_id,))
+            else:
+                blob = zlib.compress(json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode('utf-8'))
+                upserts.append((user_id, blob, now))
+        with self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO conversations (user_id, data, updated) VALUES (?, ?, ?)', upserts)
+            self.connection.executemany('DELETE FROM conversations WHERE user_id = ?', deletes)
+
+    def close(self) -> None:
+        self.connection.close()
+
+
+class ConversationCache:
+    '''
+    An in-memory LRU cache of conversations in front of a ConversationStore, with write-behind.
+    Changed conversations are only marked dirty by the handlers, and written to the store in one batch every flush_interval seconds.
+    When more than max_cached conversations are in memory, the least recently used ones are evicted;
+    an evicted conversation with unsaved changes stays in memory until the next flush.
+    A conversation that was deleted or replaced is retired: background tasks still holding it can't mark it dirty again.
+
+    Args:
+    store (ConversationStore): the persistence backend
+    max_cached (int): max number of conversations kept in memory
+    flush_interval (float): seconds between batched writes to the store
+    '''
+    def __init__(self, store:ConversationStore, max_cached:int=1000, flush_interval:float=5):
+        self.store = store
+        self.max_cached = max_cached
+        self.flush_interval = flush_interval
+        self._cache = OrderedDict()
+        self._dirty = {}
+        self._retired = weakref.WeakSet()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='store')
+        self._flusher = None
+
+    async def _run_in_store_thread(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    async def get(self, user_id:str) -> Optional[Conversation]:
+        '''
+        Returns the conversation of a user, loading it from the store if it isn't in memory, or None if the user has none.
+        '''
+        conversation = self._cache.get(user_id)
+        if conversation is not None:
+            self._cache.move_to_end(user_id)
+            return conversation
+        if user_id in self._dirty:
+            conversation = self._dirty[user_id]
+        else:
+            data = await self._run_in_store_thread(self.store.load, user_id)
+            conversation = None if data is None else Conversation.from_dict(data)
+        if conversation is not None:
+            self._put(user_id, conversation)
+        return conversation
+
+    def _put(self, user_id:str, conversation:Conversation) -> None:
+        self._cache[user_id] = conversation
+        self._cache.move_to_end(user_id)
+        while len(self._cache) > self.max_cached:
+            self._cache.popitem(last=False)
+
+    def add(self, user_id:str, conversation:Conversation) -> None:
+        '''
+        Adds a new conversation of a user, replacing any previous one.
+        '''
+        self._retire(user_id)
+        self._put(user_id, conversation)
+        self.mark_dirty(user_id, conversation)
+
+    def mark_dirty(self, user_id:str, conversation:Conversation) -> None:
+        '''
+        Marks a user's conversation as changed, to be written to the store with the next flush.
+        A conversation that is no longer the user's current one, e.g. changed by a background task after /restart, is ignored.
+        '''
+        current = self._cache.get(user_id)
+        if conversation in self._retired or (current is not None and current is not conversation):
+            return
+        self._dirty[user_id] = conversation
+
+    def delete(self, user_id:str) -> None:
+        '''
+        Deletes a user's conversation from memory, and from the store with the next flush.
+        '''
+        self._retire(user_id)
+        self._cache.pop(user_id, None)
+        self._dirty[user_id] = None
+
+    def _retire(self, user_id:str) -> None:
+        for conversation in (self._cache.get(user_id), self._dirty.get(user_id)):
+            if conversation is not None:
+                self._retired.add(conversation)
+
+    async def flush(self) -> int:
+        '''
+        Writes all changed conversations to the store in one batch.
+
+        Returns:
+        n_written (int): the number of conversations written or deleted
+        '''
+        if not self._dirty:
+            return 0
+        dirty, self._dirty = self._dirty, {}
+        snapshot = {user_id: None if conversation is None else conversation.to_dict() for user_id, conversation in dirty.items()}
+        try:
+            await self._run_in_store_thread(self.store.save_many, snapshot)
+        except Exception as e:
+            log_event('error saving conversations, will retry with the next flush', level=logging.ERROR, exc_info=e, n_conversations=len(snapshot), error_type=type(e).__name__, error=str(e))
+            for user_id, conversation in dirty.items():
+                self._dirty.setdefault(user_id, conversation)
+            return 0
+        return len(snapshot)
+
+    async def _run_flusher(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    def start(self) -> None:
+        '''
+        Starts the background task that flushes changes every flush_interval seconds.
+        '''
+        if self._flusher is None:
+            self._flusher = asyncio.create_task(self._run_flusher())
+
+    async def close(self) -> None:
+        '''
+        Stops the background flushing, writes the remaining changes and closes the store.
+        '''
+        if self._flusher is not None:
+            self._flusher.cancel()
+            self._flusher = None
+        await self.flush()
+        await self._run_in_store_thread(self.store.close)
+        self._executor.shutdown(wait=True)
@@ -0,0 +1,315 @@
+'''
+Delivery of the chatbot's messages to Telegram.
+Long replies are split into messages within Telegram's length limit on safe boundaries (between paragraphs and code blocks,
+with code blocks split on lines and their fences closed and reopened), and the Markdown of each part is repaired for
+Telegram's Markdown parse mode, with a fallback to plain text if Telegram still can't parse it, so a reply is never lost.
+The parts of a reply are sent in order, sends are paced under Telegram's global message rate, and a 429 (RetryAfter)
+only holds back the sends to the chat it was for, while the other chats keep being served.
+'''
+
+import asyncio, logging, re, time
+from typing import List, Optional
+
+from telegram import Bot, Message, error as telegram_error
+
+import metrics
+from metrics import log_event
+from rate_limiter import TokenBucket
+
+
+message_limit = 4096  # max characters of a Telegram message
+max_flood_retries = 5  # times a send is retried after a RetryAfter
+
+# a code block may open mid-line (e.g. 'Run ```python'); it is closed by a line of its own, or on the same line for a one-line block
+_fence = re.compile(r'```(?:[^`\n]+```|.*?(?:^```[ \t]*$|\Z))', re.MULTILINE | re.DOTALL)
+_inline_code = re.compile(r'`[^`\n]+`')
+_heading = re.compile(r'^#{1,6}[ \t]+(.+?)[ \t#]*$', re.MULTILINE)
+_bullet = re.compile(r'^([ \t]*)[*+][ \t]+', re.MULTILINE)
+_link = re.compile(r'\[[^\[\]\n]*\]\([^()\s]*\)')
+
+
+### Splitting ###
+#################
+def _split_blocks(text:str) -> List[str]:
+    # code blocks and paragraphs, each with the whitespace after it, so joining them gives back the text
+    blocks = []
+    position = 0
+    for match in _fence.finditer(text):
+        blocks.extend(re.split(r'(?<=\n\n)', text[position:match.start()]))
+        blocks.append(match.group())
+        position = match.end()
+    blocks.extend(re.split(r'(?<=\n\n)', text[position:]))
+    return [block for block in blocks if block]
+
+def _split_long_block(block:str, limit:int) -> List[str]:
+    # a block longer than the limit: a code block is split on lines, with its fences repeated in every piece,
+    # other text on lines, then on sentences and words, then anywhere
+    if block.startswith('```'):
+        lines = block.rstrip().split('\n')
+        opening = lines[0]
+        body = lines[1:-1] if len(lines) > 1 and lines[-1].strip() == '```' else lines[1:]
+        width = limit-len(opening)-len('\n\n```')
+        pieces = []
+        for piece in _pack([line+'\n' for line in body], width):
+            pieces.append(f'{opening}\n{piece.rstrip(chr(10))}\n```')
+        return pieces
+    for separator in (r'(?<=\n)', r'(?<=[.!?])\s', r'(?<=\s)'):
+        units = [unit for unit in re.split(separator, block) if unit]
+        if all(len(unit) <= limit for unit in units):
+            return _pack(units, limit)
+    return [block[i:i+limit] for i in range(0, len(block), limit)]
+
+def _pack(units:List[str], limit:int) -> List[str]:
+    parts = []
+    current = ''
+    for unit in units:
+        if len(current)+len(unit) <= limit:
+            current += unit
+            continue
+        if current:
+            parts.append(current)
+            current = ''
+        if len(unit) <= limit:
+            current = unit
+        else:
+            pieces = _split_long_block(unit, limit)
+            parts.extend(pieces[:-1])
+            current = pieces[-1]
+    if current:
+        parts.append(current)
+    return parts
+
+def split_message(text:str, limit:int=message_limit) -> List[str]:
+    '''
+    Splits a text into parts of at most limit characters, between paragraphs and code blocks where possible.
+    A code block longer than the limit is split on lines, each piece in its own fences; a text that is short enough is returned whole.
+    '''
+    if len(text) <= limit:
+        return [text]
+    parts = [part.strip() for part in _pack(_split_blocks(text), limit)]
+    return [part for part in parts if part]
+
+
+### Markdown repair ###
+#######################
+def _is_intra_word(text:str, i:int) -> bool:
+    return 0 < i < len(text)-1 and text[i-1].isalnum() and text[i+1].isalnum()
+
+def _repair_prose(text:str) -> str:
+    text = _heading.sub(lambda match: '*'+match.group(1).replace('*', '')+'*', text)
+    text = _bullet.sub(lambda match: match.group(1)+'• ', text)
+    text = re.sub(r'\*\*(.+?)\*\*', r'*\1*', text, flags=re.DOTALL)
+    # an entity is kept as it is up to its closing marker, since Telegram allows no escapes (or nesting) inside it;
+    # markers inside words (e.g. snake_case or 2*3), markers that don't pair up, and brackets that are not links are escaped
+    pieces = []
+    i = 0
+    while i < len(text):
+        char = text[i]
+        if text.startswith('__', i):
+            # double underscores (e.g. dunder names like __init__) are kept as text, not paired up as italics
+            run = len(text)-i-len(text[i:].lstrip('_'))
+            pieces.append('\\_'*run)
+            i += run
+            continue
+        if char in '*_' and not _is_intra_word(text, i):
+            end = text.find(char, i+1)
+            if end > i+1:
+                pieces.append(text[i:end+1])
+                i = end+1
+                continue
+            pieces.append('\\'+char)
+        elif char in '*_`':
+            pieces.append('\\'+char)
+        elif char == '[':
+            link = _link.match(text, i)
+            if link is not None:
+                pieces.append(link.group())
+                i = link.end()
+                continue
+            pieces.append('\\[')
+        else:
+            pieces.append(char)
+        i += 1
+    return ''.join(pieces)
+
+def repair_markdown(text:str) -> str:
+    '''
+    Rewrites the Markdown the model writes (e.g. **bold**, # headings, * bullets, snake_case words) into Telegram's
+    Markdown parse mode, escaping the markers that would not pair up and double underscores (e.g. __init__).
+    Code blocks, also those opened mid-line, and inline code are kept as they are, and an unclosed code block is closed.
+    Telegram may still reject the result (e.g. nested formatting), in which case the text is sent as plain text.
+    '''
+    pieces = []
+    position = 0
+    for match in _fence.finditer(text):
+        pieces.append(_repair_inline(text[position:match.start()]))
+        block = match.group()
+        if not re.search(r'.```[ \t]*$', block, re.DOTALL):
+            block = block.rstrip('\n')+'\n```'
+        pieces.append(block)
+        position = match.end()
+    pieces.append(_repair_inline(text[position:]))
+    return ''.join(pieces)
+
+def _repair_inline(text:str) -> str:
+    pieces = []
+    position = 0
+    for match in _inline_code.finditer(text):
+        pieces.append(_repair_prose(text[position:match.start()]))
+        pieces.append(match.group())
+        position = match.end()
+    pieces.append(_repair_prose(text[position:]))
+    return ''.join(pieces)
+
+def is_parse_error(error:Exception) -> bool:
+    return isinstance(error, telegram_error.BadRequest) and "can't parse" in str(error).lower()
+
+def is_not_modified_error(error:Exception) -> bool:
+    return isinstance(error, telegram_error.BadRequest) and 'not modified' in str(error).lower()
+
+def get_retry_after(error:telegram_error.RetryAfter) -> float:
+    retry_after = error.retry_after
+    return retry_after.total_seconds() if hasattr(retry_after, 'total_seconds') else float(retry_after)
+
+
+### Delivery ###
+################
+class MessageDelivery:
+    '''
+    Sends and edits the bot's messages: splits long texts, repairs their Markdown with a plain text fallback,
+    keeps the sends to each chat in order, paces all sends under max_messages_per_second, and waits out a RetryAfter
+    for the chat it was for only. Sends go through the bot's pool of keep-alive connections.
+
+    Args:
+    bot (Bot): the Telegram bot
+    max_messages_per_second (float): max messages sent per second over all chats, defaults to 30 (Telegram's limit)
+    '''
+    def __init__(self, bot:Bot, max_messages_per_second:float=30):
+        self.bot = bot
+        self._bucket = TokenBucket(max_messages_per_second*60, 1)
+        self._chats = {}  # chat ID -> [lock, number of users of the lock]
+        self._paused_until = {}  # chat ID -> time.monotonic() until which the chat is under flood control
+
+    def paused(self, chat_id:int) -> float:
+        '''
+        Returns the seconds the chat is still under flood control, 0 if it isn't.
+        '''
+        seconds = self._paused_until.get(chat_id, 0)-time.monotonic()
+        if seconds <= 0:
+            self._paused_until.pop(chat_id, None)
+            return 0.0
+        return seconds
+
+    async def _in_chat_order(self, chat_id:int, send):
+        entry = self._chats.setdefault(chat_id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                return await send()
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._chats[chat_id]
+
+    async def _call(self, chat_id:int, request):
+        # waits for the chat's flood control and the global pace, retrying after a RetryAfter
+        for attempt in range(max_flood_retries+1):
+            while self.paused(chat_id) > 0:
+                await asyncio.sleep(self.paused(chat_id))
+            await self._bucket_wait()
+            try:
+                return await request()
+            except telegram_error.RetryAfter as e:
+                retry_after = get_retry_after(e)
+                self._paused_until[chat_id] = time.monotonic()+retry_after
+                metrics.telegram_flood_waits_total.inc()
+                log_event('telegram flood control, waiting', level=logging.WARNING, chat_id=chat_id, retry_after=retry_after, attempt=attempt)
+                if attempt == max_flood_retries:
+                    raise
+
+    async def _send_part(self, chat_id:int, text:str, markdown:bool, edit_message:Optional[Message]=None) -> Message:
+        # sends (or edits a message into) one part, in Markdown if asked and Telegram can parse it, else as plain text;
+        # also as plain text if the escapes make it too long for one message
+        formatted = repair_markdown(text) if markdown else text
+        def request(parse_mode):
+            if edit_message is not None:
+                return lambda: edit_message.edit_text(text if parse_mode is None else formatted, parse_mode=parse_mode)
+            return lambda: self.bot.send_message(chat_id=chat_id, text=text if parse_mode is None else formatted, parse_mode=parse_mode)
+        if markdown and len(formatted) <= message_limit:
+            try:
+                return await self._call(chat_id, request('Markdown'))
+            except telegram_error.BadRequest as e:
+                if is_not_modified_error(e):
+                    return edit_message
+                if not is_parse_error(e):
+                    raise
+                metrics.telegram_markdown_fallbacks_total.inc()
+                log_event('Markdown not accepted, sending as plain text', level=logging.WARNING, error=str(e))
+        try:
+            return await self._call(chat_id, request(None))
+        except telegram_error.BadRequest as e:
+            if is_not_modified_error(e):
+                return edit_message
+            raise
+
+    async def send(self, chat_id:int, text:str, markdown:bool=True) -> List[Message]:
+        '''
+        Sends a text to a chat, split into as many messages as needed, in order.
+
+        Args:
+        chat_id (int): the chat to send to
+        text (str): the text, may be longer than a Telegram message
+        markdown (bool): format the text as Markdown, defaults to True
+
+        Returns:
+        messages (List[Message]): the sent messages
+        '''
+        async def send_parts():
+            return [await self._send_part(chat_id, part, markdown) for part in split_message(text or '...')]
+        return await self._in_chat_order(chat_id, send_parts)
+
+    async def edit(self, message:Message, text:str, markdown:bool=True) -> List[Message]:
+        '''
+        Replaces the text of a sent message, e.g. the final edit of a streamed reply: the first part of the text
+        goes into the message, and the rest, if it is too long for one message, is sent as new messages after it.
+
+        Returns:
+        messages (List[Message]): the edited message and the new messages
+        '''
+        chat_id = message.chat_id
+        async def edit_parts():
+            parts = split_message(text or '...')
+            messages = [await self._send_part(chat_id, parts[0], markdown, edit_message=message)]
+            for part in parts[1:]:
+                messages.append(await self._send_part(chat_id, part, markdown))
+            return messages
+        return await self._in_chat_order(chat_id, edit_parts)
+
+    async def edit_preview(self, message:Message, text:str) -> bool:
+        '''
+        Edits a message with a plain text preview, e.g. of a reply being streamed, cut to one message.
+        A preview is skipped rather than waited for if the chat is under flood control, since the next one replaces it.
+
+        Returns:
+        edited (bool): True if the message was edited
+        '''
+        chat_id = message.chat_id
+        if self.paused(chat_id) > 0:
+            return False
+        try:
+            await self._bucket_wait()
+            await message.edit_text(text[:message_limit])
+            return True
+        except telegram_error.RetryAfter as e:
+            self._paused_until[chat_id] = time.monotonic()+get_retry_after(e)
+            metrics.telegram_flood_waits_total.inc()
+            log_event('telegram flood control while streaming, skipping edits', level=logging.WARNING, chat_id=chat_id, retry_after=get_retry_after(e))
+        except telegram_error.BadRequest as e:
+            if not is_not_modified_error(e):
+                log_event('error editing streamed reply', level=logging.WARNING, error=str(e))
+        return False
+
+    async def _bucket_wait(self) -> None:
+        while (delay := self._bucket.wait_time(1, time.monotonic())) > 0:
+            await asyncio.sleep(delay)
+        self._bucket.take(1, time.monotonic())
@@ -0,0 +1,288 @@
+'''
+Large-document handling for the chatbot.
+An attached text file is decoded in blocks, with its encoding detected, and split into chunks of a bounded number of tokens.
+Small documents are added to the conversation whole; the chunks of larger ones go into a per-chat BM25 index,
+and only the chunks relevant to each new message are sent with it, so the prompt size stays bounded however large the file.
+'''
+
+import codecs, math, re
+from collections import Counter, OrderedDict
+from typing import Callable, Iterator, List, Optional, Tuple
+try:
+    from charset_normalizer import from_bytes as detect_charset
+except ImportError:
+    detect_charset = None
+
+from conversation import get_token_counter
+
+
+read_block_size = 64*1024  # bytes decoded at a time
+detection_sample_size = 64*1024  # bytes looked at to detect the encoding
+fallback_encoding = 'cp1252'  # used when the bytes are not UTF-8 and charset_normalizer is not installed or unsure
+chars_per_token = 4  # rough size of a token, for cutting lines that are longer than a chunk
+
+_boms = [
+    (codecs.BOM_UTF32_LE, 'utf-32'), (codecs.BOM_UTF32_BE, 'utf-32'),  # before UTF-16, whose BOMs are their prefixes
+    (codecs.BOM_UTF8, 'utf-8-sig'), (codecs.BOM_UTF16_LE, 'utf-16'), (codecs.BOM_UTF16_BE, 'utf-16'),
+]
+_word = re.compile(r'\w+')
+
+
+def detect_encoding(sample:bytes) -> str:
+    '''
+    Detects the text encoding of a file from its first bytes: a byte order mark, else UTF-8 if the bytes are valid UTF-8,
+    else the guess of charset_normalizer if it is installed, else fallback_encoding.
+
+    Raises:
+    ValueError: if the bytes look binary rather than text
+    '''
+    for bom, encoding in _boms:
+        if sample.startswith(bom):
+            return encoding
+    if b'\0' in sample:
+        raise ValueError('the file is not a text file')
+    try:
+        # the sample may end in the middle of a character, which the incremental decoder leaves pending
+        codecs.getincrementaldecoder('utf-8')().decode(sample, final=False)
+        return 'utf-8'
+    except UnicodeDecodeError:
+        pass
+    if detect_charset is not None:
+        best = detect_charset(sample).best()
+        if best is not None:
+            return best.encoding
+    return fallback_encoding
+
+def iter_decoded_blocks(file_bytes:bytes, encoding:str) -> Iterator[str]:
+    '''
+    Decodes a file block by block, replacing undecodable bytes, so no more than one block is decoded at a time.
+    '''
+    decoder = codecs.getincrementaldecoder(encoding)(errors='replace')
+    view = memoryview(file_bytes)
+    for start in range(0, len(view), read_block_size):
+        text = decoder.decode(view[start:start+read_block_size])
+        if text:
+            yield text
+    text = decoder.decode(b'', final=True)
+    if text:
+        yield text
+
+def iter_lines(blocks:Iterator[str]) -> Iterator[str]:
+    '''
+    Yields the lines of decoded text blocks, each with its line ending.
+    '''
+    pending = ''
+    for block in blocks:
+        lines = (pending+block).splitlines(keepends=True)
+        pending = lines.pop() if lines and not lines[-1].endswith(('\n', '\r')) else ''
+        yield from lines
+    if pending:
+        yield pending
+
+def split_into_chunks(lines:Iterator[str], count_tokens:Callable[[str], int], chunk_tokens:int) -> Iterator[Tuple[str, int]]:
+    '''
+    Groups lines into chunks of at most chunk_tokens tokens (about, for lines cut to fit), keeping lines whole where possible.
+
+    Yields:
+    (text, n_tokens) (Tuple[str, int]): a chunk and its number of tokens
+    '''
+    parts = []
+    n_tokens = 0
+    for line in lines:
+        line_tokens = count_tokens(line)
+        pieces = [(line, line_tokens)]
+        if line_tokens > chunk_tokens:
+            width = chunk_tokens*chars_per_token
+            pieces = [(line[i:i+width], count_tokens(line[i:i+width])) for i in range(0, len(line), width)]
+        for piece, piece_tokens in pieces:
+            if parts and n_tokens+piece_tokens > chunk_tokens:
+                yield ''.join(parts), n_tokens
+                parts = []
+                n_tokens = 0
+            parts.append(piece)
+            n_tokens += piece_tokens
+    if parts:
+        yield ''.join(parts), n_tokens
+
+def read_document(file_bytes:bytes, model:str, chunk_tokens:int) -> Tuple[List[Tuple[str, int]], int, str]:
+    '''
+    Decodes an attached text file and splits it into chunks. Runs in the media worker pool, so it must stay a module-level function.
+
+    Args:
+    file_bytes (bytes): the contents of the file
+    model (str): the name of the GPT model, whose tokenizer counts the tokens
+    chunk_tokens (int): the max number of tokens per chunk
+
+    Returns:
+    (chunks, n_tokens, encoding) (Tuple[list, int, str]): the (text, n_tokens) chunks, the total number of tokens and the detected encoding
+
+    Raises:
+    ValueError: if the file is not a text file
+    '''
+    file_bytes = bytes(file_bytes)
+    encoding = detect_encoding(file_bytes[:detection_sample_size])
+    lines = iter_lines(iter_decoded_blocks(file_bytes, encoding))
+    chunks = list(split_into_chunks(lines, get_token_counter(model), chunk_tokens))
+    return chunks, sum(n_tokens for _, n_tokens in chunks), encoding
+
+
+def tokenize(text:str) -> List[str]:
+    return _word.findall(text.lower())
+
+
+class DocumentIndex:
+    '''
+    A BM25 index of the chunks of the documents attached in one chat.
+    The index holds at most max_chunks chunks; when a new document doesn't fit, the oldest documents are dropped.
+
+    Args:
+    max_chunks (int): the max number of chunks indexed
+    '''
+    k1 = 1.5  # BM25 term frequency saturation
+    b = 0.75  # BM25 length normalization
+
+    def __init__(self, max_chunks:int=5000):
+        self.max_chunks = max_chunks
+        self.documents = []  # [name, [chunk ids]], oldest first
+        self._chunks = {}  # chunk id -> (document name, part number, number of parts, text, n_tokens, length in terms)
+        self._postings = {}  # term -> {chunk id: term count}
+        self._total_length = 0
+        self._next_id = 0
+
+    def __len__(self) -> int:
+        return len(self._chunks)
+
+    def add_document(self, name:str, chunks:List[Tuple[str, int]]) -> None:
+        '''
+        Indexes the (text, n_tokens) chunks of a document. A document with more than max_chunks chunks keeps its first max_chunks.
+        '''
+        chunks = chunks[:self.max_chunks]
+        while self.documents and len(self._chunks)+len(chunks) > self.max_chunks:
+            self._drop_document(0)
+        chunk_ids = []
+        for part, (text, n_tokens) in enumerate(chunks):
+            chunk_id = self._next_id
+            self._next_id += 1
+            term_counts = Counter(tokenize(text))
+            length = sum(term_counts.values())
+            self._chunks[chunk_id] = (name, part+1, len(chunks), text, n_tokens, length)
+            for term, count in term_counts.items():
+                self._postings.setdefault(term, {})[chunk_id] = count
+            self._total_length += length
+            chunk_ids.append(chunk_id)
+        self.documents.append([name, chunk_ids])
+
+    def _drop_document(self, index:int) -> None:
+        _, chunk_ids = self.documents.pop(index)
+        for chunk_id in chunk_ids:
+            text, length = self._chunks[chunk_id][3], self._chunks[chunk_id][5]
+            for term in set(tokenize(text)):
+                postings = self._postings[term]
+                del postings[chunk_id]
+                if not postings:
+                    del self._postings[term]
+            self._total_length -= length
+            del self._chunks[chunk_id]
+
+    def search(self, query:str, max_tokens:int, fallback_to_latest:bool=False) -> List[Tuple[str, int, int, str]]:
+        '''
+        Returns the chunks most relevant to the query by BM25 score, as many as fit in max_tokens, in document order.
+        If no chunk matches the query (e.g. 'summarize this'), no chunks are returned,
+        or with fallback_to_latest the first chunks of the latest document.
+
+        Returns:
+        chunks (list): (document name, part number, number of parts, text) tuples
+        '''
+        if not self._chunks:
+            return []
+        scores = Counter()
+        n_chunks = len(self._chunks)
+        average_length = self._total_length/n_chunks or 1
+        for term in set(tokenize(query)):
+            postings = self._postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1+(n_chunks-len(postings)+0.5)/(len(postings)+0.5))
+            for chunk_id, count in postings.items():
+                length = self._chunks[chunk_id][5]
+                scores[chunk_id] += idf*count*(self.k1+1)/(count+self.k1*(1-self.b+self.b*length/average_length))
+        if not scores and not fallback_to_latest:
+            return []
+        ranked = sorted(scores, key=scores.get, reverse=True) if scores else self.documents[-1][1]
+        selected = []
+        n_tokens = 0
+        for chunk_id in ranked:
+            chunk_tokens = self._chunks[chunk_id][4]
+            if n_tokens+chunk_tokens > max_tokens:
+                if scores:
+                    continue  # a smaller, less relevant chunk may still fit
+                break
+            selected.append(chunk_id)
+            n_tokens += chunk_tokens
+        return [self._chunks[chunk_id][:4] for chunk_id in sorted(selected)]
+
+
+class DocumentIndexCache:
+    '''
+    An LRU cache of the DocumentIndex of each chat, bounded by the total number of chunks indexed,
+    so the documents of users who stopped asking about them don't stay in memory.
+
+    Args:
+    max_chunks (int): max total number of chunks in the cached indexes, the least recently used are evicted first
+    max_chunks_per_index (int): the max_chunks of each DocumentIndex
+    '''
+    def __init__(self, max_chunks:int=30000, max_chunks_per_index:int=5000):
+        self.max_chunks = max_chunks
+        self.max_chunks_per_index = max_chunks_per_index
+        self._indexes = OrderedDict()  # user ID -> DocumentIndex
+
+    def __len__(self) -> int:
+        return len(self._indexes)
+
+    def get(self, user_id:str) -> Optional[DocumentIndex]:
+        '''
+        Returns the index of a user, or None if they have none or it was evicted.
+        '''
+        index = self._indexes.get(user_id)
+        if index is not None:
+            self._indexes.move_to_end(user_id)
+        return index
+
+    def get_or_add(self, user_id:str) -> DocumentIndex:
+        '''
+        Returns the index of a user, adding an empty one if they have none. Call evict() once documents were added to it.
+        '''
+        index = self.get(user_id)
+        if index is None:
+            index = self._indexes[user_id] = DocumentIndex(self.max_chunks_per_index)
+        return index
+
+    def evict(self) -> int:
+        '''
+        Evicts the least recently used indexes until the total number of chunks fits max_chunks, keeping the most recent one.
+
+        Returns:
+        n_evicted (int): the number of indexes evicted
+        '''
+        n_chunks = sum(len(index) for index in self._indexes.values())
+        n_evicted = 0
+        while n_chunks > self.max_chunks and len(self._indexes) > 1:
+            _, index = self._indexes.popitem(last=False)
+            n_chunks -= len(index)
+            n_evicted += 1
+        return n_evicted
+
+    def delete(self, user_id:str) -> None:
+        self._indexes.pop(user_id, None)
+
+
+def format_excerpts(chunks:List[Tuple[str, int, int, str]]) -> Optional[str]:
+    '''
+    Formats the chunks returned by DocumentIndex.search as the text of a system message, or returns None if there are none.
+    '''
+    if not chunks:
+        return None
+    parts = ['Excerpts of the documents the user attached, selected as relevant to the next user message:']
+    for name, part, n_parts, text in chunks:
+        parts.append(f'[{name}, part {part} of {n_parts}]\n{text.strip()}')
+    return '\n\n'.join(parts)
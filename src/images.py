@@ -0,0 +1,139 @@
+'''
+Image lifecycle for the chatbot.
+A photo is downloaded once, at the smallest Telegram size adequate for the chosen vision detail level,
+and cached as a data URL by its file_unique_id (Telegram file URLs expire, and embed the bot token).
+Once the photo has been answered, it is replaced in the conversation by a short text description,
+so later turns don't re-send it; it is attached again only to messages that refer to a photo.
+'''
+
+import base64, hashlib, re
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+
+
+low_detail_side = 512  # OpenAI fits low detail images in 512x512
+high_detail_side = 768  # OpenAI scales high detail images down to 768 px on their short side
+high_detail_words = re.compile(
+    r'\b(read|text|written|writing|says?|transcribe|document|receipt|invoice|screenshot|table|code|chart|graph|diagram|'
+    r'handwrit\w*|small|tiny|details?|zoom|numbers?|label|menu|sign)\b', re.IGNORECASE)  # captions asking for fine detail
+image_reference_words = re.compile(r'\b(images?|photos?|pictures?|pics?|screenshots?|look again)\b', re.IGNORECASE)  # messages that refer back to a photo
+description_pattern = re.compile(r'\[Photo (\S+?): ')  # the start of the text that replaces an answered photo
+
+
+def choose_image_detail(caption:str, default_detail:str='low') -> str:
+    '''
+    Returns 'high' if the caption asks about fine detail (e.g. text to read), else default_detail.
+    '''
+    if caption and high_detail_words.search(caption):
+        return 'high'
+    return default_detail
+
+def choose_photo_size(photo_sizes:list, detail:str):
+    '''
+    Returns the smallest of the sizes Telegram sent of a photo that is large enough for the vision detail level,
+    or the largest size if none is: OpenAI would scale a larger image down anyway, so its extra pixels are wasted download and upload.
+
+    Args:
+    photo_sizes (list): the PhotoSize objects of the message (update.message.photo), each with width and height
+    detail (str): the vision detail level, 'low' or 'high'
+
+    Returns:
+    photo_size (PhotoSize): the chosen size
+    '''
+    by_area = sorted(photo_sizes, key=lambda size: size.width*size.height)
+    for size in by_area:
+        if detail == 'low' and max(size.width, size.height) >= low_detail_side:
+            return size
+        if detail != 'low' and min(size.width, size.height) >= high_detail_side:
+            return size
+    return by_area[-1]
+
+def make_data_url(image_bytes:bytes, mime_type:str='image/jpeg') -> str:
+    '''
+    Returns the image as a base64 data URL, which the API accepts in place of a download URL. Telegram photos are JPEG.
+    '''
+    return f'data:{mime_type};base64,'+base64.b64encode(bytes(image_bytes)).decode('ascii')
+
+def get_image_id(url:str) -> str:
+    '''
+    Returns an ID for an image known only by its URL (e.g. one in a conversation stored before a restart).
+    '''
+    return hashlib.sha256(url.encode('utf-8')).hexdigest()[:16]
+
+def format_description(image_id:str, description:str) -> str:
+    return f'[Photo {image_id}: {description.strip()}]'
+
+def find_described_images(messages:list) -> List[str]:
+    '''
+    Returns the IDs of the photos that were replaced by descriptions in the messages, oldest first.
+    '''
+    image_ids = []
+    for message in messages:
+        content = message.get('content') or ''
+        parts = [content] if isinstance(content, str) else [part.get('text') or '' for part in content if part.get('type') == 'text']
+        for text in parts:
+            image_ids.extend(description_pattern.findall(text))
+    return image_ids
+
+def refers_to_image(text:str) -> bool:
+    return bool(text) and image_reference_words.search(text) is not None
+
+
+class ImageCache:
+    '''
+    A size-bounded LRU cache of photos as data URLs, with their detail level, keyed by image ID (the file_unique_id),
+    and a count-bounded cache of their descriptions. Data URLs can be looked up by URL too, to find the ID of an image part.
+
+    Args:
+    max_bytes (int): max total length of the cached data URLs, the least recently used are evicted first
+    max_descriptions (int): max number of cached descriptions
+    '''
+    def __init__(self, max_bytes:int=64*1024*1024, max_descriptions:int=10000):
+        self.max_bytes = max_bytes
+        self.max_descriptions = max_descriptions
+        self.n_bytes = 0
+        self._images = OrderedDict()  # image ID -> (data URL, detail)
+        self._ids = {}  # data URL -> image ID
+        self._descriptions = OrderedDict()  # image ID -> description
+
+    def __len__(self) -> int:
+        return len(self._images)
+
+    def put(self, image_id:str, data_url:str, detail:str) -> None:
+        if image_id in self._images:
+            self._remove(image_id)
+        self._images[image_id] = (data_url, detail)
+        self._ids[data_url] = image_id
+        self.n_bytes += len(data_url)
+        while self.n_bytes > self.max_bytes and len(self._images) > 1:
+            self._remove(next(iter(self._images)))
+
+    def _remove(self, image_id:str) -> None:
+        data_url, _ = self._images.pop(image_id)
+        if self._ids.get(data_url) == image_id:
+            del self._ids[data_url]
+        self.n_bytes -= len(data_url)
+
+    def get(self, image_id:str) -> Optional[Tuple[str, str]]:
+        '''
+        Returns the (data URL, detail) of a cached image, or None.
+        '''
+        entry = self._images.get(image_id)
+        if entry is not None:
+            self._images.move_to_end(image_id)
+        return entry
+
+    def id_for_url(self, url:str) -> Optional[str]:
+        return self._ids.get(url)
+
+    def get_description(self, image_id:str) -> Optional[str]:
+        description = self._descriptions.get(image_id)
+        if description is not None:
+            self._descriptions.move_to_end(image_id)
+        return description
+
+    def put_description(self, image_id:str, description:str) -> None:
+        self._descriptions[image_id] = description
+        self._descriptions.move_to_end(image_id)
+        while len(self._descriptions) > self.max_descriptions:
+            self._descriptions.popitem(last=False)
@@ -0,0 +1,225 @@
+'''
+Metrics and tracing for the chatbot.
+Counters and histograms are kept in a registry and exposed in the Prometheus text format on a /metrics endpoint.
+Runtime events are logged as JSON lines, each carrying the ID of the Telegram update being handled,
+so all the stages of one update (download, transcoding, transcription, completion, retries, sending) can be correlated.
+'''
+
+import contextvars, json, logging, threading, time, uuid
+from contextlib import contextmanager
+from aiohttp import web
+
+
+default_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _escape_label_value(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_labels(labels:tuple) -> str:
+    if not labels:
+        return ''
+    return '{'+','.join(f'{key}="{_escape_label_value(value)}"' for key, value in labels)+'}'
+
+
+class Counter:
+    '''
+    A monotonically increasing value per combination of label values.
+    '''
+    def __init__(self, name:str, help:str):
+        self.name = name
+        self.help = help
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount:float=1, **labels) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0)+amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(tuple(sorted(labels.items())), 0)
+
+    def render(self) -> list:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        with self._lock:
+            for key, value in self._values.items():
+                lines.append(f'{self.name}{_format_labels(key)} {value}')
+        return lines
+
+
+class Histogram:
+    '''
+    The distribution of observed values (e.g. durations in seconds) per combination of label values, in cumulative buckets.
+    '''
+    def __init__(self, name:str, help:str, buckets:tuple=default_buckets):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(sorted(buckets))
+        self._values = {}  # labels -> [bucket counts, sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value:float, **labels) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0]*len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def render(self) -> list:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            for key, (bucket_counts, total, count) in self._values.items():
+                for bound, bucket_count in zip(self.buckets, bucket_counts):
+                    lines.append(f'{self.name}_bucket{_format_labels(key+(("le", bound),))} {bucket_count}')
+                lines.append(f'{self.name}_bucket{_format_labels(key+(("le", "+Inf"),))} {count}')
+                lines.append(f'{self.name}_sum{_format_labels(key)} {total}')
+                lines.append(f'{self.name}_count{_format_labels(key)} {count}')
+        return lines
+
+
+class MetricsRegistry:
+    '''
+    Holds the metrics of the process and renders them in the Prometheus text exposition format.
+    '''
+    def __init__(self):
+        self._metrics = []
+
+    def counter(self, name:str, help:str) -> Counter:
+        metric = Counter(name, help)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name:str, help:str, buckets:tuple=default_buckets) -> Histogram:
+        metric = Histogram(name, help, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines)+'\n'
+
+
+### The chatbot's metrics ###
+#############################
+registry = MetricsRegistry()
+updates_total = registry.counter('chatbot_updates_total', 'Telegram updates received, by handler.')
+openai_requests_total = registry.counter('chatbot_openai_requests_total', 'OpenAI API requests sent, by model and kind.')
+openai_retries_total = registry.counter('chatbot_openai_retries_total', 'OpenAI API requests retried, by model.')
+openai_errors_total = registry.counter('chatbot_openai_errors_total', 'OpenAI API errors, by model and error type (e.g. RateLimitError).')
+tokens_total = registry.counter('chatbot_tokens_total', 'Tokens used, by model and direction (in: prompt, out: completion).')
+response_cache_total = registry.counter('chatbot_response_cache_total', 'Response cache lookups, by result (hit, miss, bypass).')
+stage_seconds = registry.histogram('chatbot_stage_seconds', 'Duration of the stages of handling an update, by stage.')
+route_requests_total = registry.counter('chatbot_route_requests_total', 'Chat requests, by route (e.g. light, standard, vision) and model.')
+route_seconds = registry.histogram('chatbot_route_seconds', 'Time to answer chat requests, by route and model.')
+cost_usd_total = registry.counter('chatbot_cost_usd_total', 'Estimated OpenAI cost in USD from the token usage, by route (or request kind) and model.')
+model_fallbacks_total = registry.counter('chatbot_model_fallbacks_total', 'Requests switched to a fallback model, by model and fallback model.')
+telegram_flood_waits_total = registry.counter('chatbot_telegram_flood_waits_total', 'Telegram 429 (RetryAfter) responses, each holding back the sends to one chat.')
+telegram_markdown_fallbacks_total = registry.counter('chatbot_telegram_markdown_fallbacks_total', 'Messages sent as plain text because Telegram could not parse their Markdown.')
+unauthorized_updates_total = registry.counter('chatbot_unauthorized_updates_total', 'Updates from users who are not in the allowed IDs, stopped before any handler.')
+config_reloads_total = registry.counter('chatbot_config_reloads_total', 'Reloads of the allowed IDs, system prompt and settings files after they changed, by result (ok or error).')
+coalesced_messages_total = registry.counter('chatbot_coalesced_messages_total', 'User messages merged into a newer message of the same burst instead of being answered on their own.')
+superseded_generations_total = registry.counter('chatbot_superseded_generations_total', 'Replies cancelled while being generated because the user sent a newer message.')
+batch_jobs_total = registry.counter('chatbot_batch_jobs_total', '/batch jobs, by result (queued, completed, failed).')
+batches_total = registry.counter('chatbot_batches_total', 'OpenAI batches submitted and ended, by status (submitted, submit_error, completed, failed, expired, cancelled).')
+
+
+### Tracing and structured logs ###
+###################################
+request_id_var = contextvars.ContextVar('request_id', default='-')
+logger = logging.getLogger('chatbot')
+
+
+class JsonFormatter(logging.Formatter):
+    '''
+    Formats log records as JSON lines, with the current request ID and the fields passed to log_event.
+    '''
+    def format(self, record:logging.LogRecord) -> str:
+        entry = {
+            'time': round(record.created, 3),
+            'level': record.levelname.lower(),
+            'event': record.getMessage(),
+            'request_id': getattr(record, 'request_id', request_id_var.get()),
+        }
+        entry.update(getattr(record, 'fields', {}))
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+def setup_json_logging(level:int=logging.INFO) -> None:
+    '''
+    Sends the chatbot's log events to stderr as JSON lines.
+    '''
+    handler = logging.StreamHandler()
+    handler.setFormatter(JsonFormatter())
+    logger.handlers = [handler]
+    logger.setLevel(level)
+    logger.propagate = False
+
+def log_event(event:str, level:int=logging.INFO, exc_info=None, **fields) -> None:
+    '''
+    Logs an event with structured fields, tagged with the current request ID.
+    An exception passed as exc_info is logged with its traceback.
+    '''
+    logger.log(level, event, exc_info=exc_info, extra={'fields': fields, 'request_id': request_id_var.get()})
+
+def new_request_id(update_id:int=None) -> str:
+    '''
+    Returns a new request ID, starting with the Telegram update ID if given.
+    '''
+    suffix = uuid.uuid4().hex[:8]
+    return suffix if update_id is None else f'{update_id}-{suffix}'
+
+def set_request_id(request_id:str) -> None:
+    '''
+    Sets the request ID of the current task, used by log_event and span.
+    '''
+    request_id_var.set(request_id)
+
+@contextmanager
+def span(stage:str, **fields):
+    '''
+    Times a stage of handling an update: records its duration in the stage_seconds histogram and logs it with the request ID.
+    Works around synchronous code and around awaits alike.
+    '''
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter()-t0
+        stage_seconds.observe(seconds, stage=stage)
+        log_event('span', stage=stage, seconds=round(seconds, 4), **fields)
+
+
+### /metrics endpoint ###
+#########################
+async def handle_metrics(request: web.Request) -> web.Response:
+    return web.Response(text=registry.render(), content_type='text/plain', charset='utf-8', headers={'X-Content-Type-Options': 'nosniff'})
+
+def add_metrics_route(app: web.Application) -> None:
+    '''
+    Adds the /metrics endpoint to an aiohttp app.
+    '''
+    app.router.add_get('/metrics', handle_metrics)
+
+async def start_metrics_server(listen:str, port:int) -> web.AppRunner:
+    '''
+    Starts a standalone HTTP server with the /metrics endpoint, for modes without a webhook server.
+
+    Returns:
+    runner (web.AppRunner): the server runner; cleanup() stops it
+    '''
+    app = web.Application()
+    add_metrics_route(app)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, listen, port).start()
+    log_event('metrics server started', address=str(runner.addresses))
+    return runner
@@ -0,0 +1,95 @@
+'''
+Model routing for the chatbot.
+Each chat request is classified into a route by cheap local heuristics (images, document excerpts, the length of the
+latest message, the prompt size and the conversation depth), and each route is served by a configurable model,
+so trivial messages go to a cheaper model. Users can pin a model with a command, and a request whose model is
+held back by its rate limits is sent to a fallback model instead.
+'''
+
+import re
+from typing import Callable, Optional, Tuple
+
+
+acknowledgement = re.compile(r'^\W*(thanks?( you)?|thx|ty|cool|great|nice|got it|perfect|bye|hi|hello|hey)\b[\W\s]*$', re.IGNORECASE)
+complex_words = re.compile(
+    r'(```|\b(explain|why|prove|derive|analy[sz]e|compare|debug|refactor|implement|code|function|algorithm|step by step|'
+    r'essay|translate|summari[sz]e|plan|design|calculate|solve)\b)', re.IGNORECASE)  # messages that need the stronger model even when short
+
+
+def has_image(message:dict) -> bool:
+    content = message.get('content') or ''
+    return not isinstance(content, str) and any(part.get('type') == 'image_url' for part in content)
+
+def classify_request(messages:list, n_pinned:int, has_documents:bool, count_tokens:Callable[[str], int], prompt_tokens:int,
+                     light_max_message_tokens:int=40, light_max_prompt_tokens:int=4000, light_max_depth:int=20) -> str:
+    '''
+    Classifies a chat request, whose last message is the user message being answered, into a route:
+    'vision' if the message has an image, 'documents' if document excerpts are sent with it, 'light' for an acknowledgement,
+    or for a short message without signs of a complex task in a small and shallow conversation, else 'standard'.
+    A short answer to a question of the assistant (e.g. 'yes' to 'Shall I write the code?') continues its task, so it is not light.
+
+    Args:
+    messages (list): the request messages, ending with the user message
+    n_pinned (int): the number of pinned messages at the start (system message and summary), not counted in the depth
+    has_documents (bool): whether document excerpts are sent with the request
+    count_tokens (Callable[[str], int]): the token counter of the model
+    prompt_tokens (int): the prompt tokens of the request
+    light_max_message_tokens (int): max tokens of the latest message for the light route
+    light_max_prompt_tokens (int): max prompt tokens for the light route
+    light_max_depth (int): max number of unpinned messages for the light route
+
+    Returns:
+    route (str): the route name
+    '''
+    message = messages[-1]
+    if has_image(message):
+        return 'vision'
+    if has_documents:
+        return 'documents'
+    content = message.get('content') or ''
+    text = content if isinstance(content, str) else ' '.join(part.get('text') or '' for part in content if part.get('type') == 'text')
+    if acknowledgement.match(text):
+        return 'light'
+    previous = messages[-2] if len(messages) > n_pinned+1 else {}
+    answers_question = previous.get('role') == 'assistant' and str(previous.get('content') or '').rstrip().endswith('?')
+    if (count_tokens(text) <= light_max_message_tokens and prompt_tokens <= light_max_prompt_tokens
+            and len(messages)-n_pinned <= light_max_depth and not complex_words.search(text) and not answers_question):
+        return 'light'
+    return 'standard'
+
+def choose_model(route:str, routes:dict, default_model:str, fallbacks:dict, override:Optional[str]=None,
+                 wait_time:Callable[[str], float]=None, fallback_wait_seconds:float=5) -> Tuple[str, Optional[str]]:
+    '''
+    Returns the model to send a request on a route to, and the fallback model to switch to if it fails.
+    A model the user pinned is used as is, without fallback. If the model's rate limits would hold the request for more than fallback_wait_seconds,
+    and the fallback's would not, the request goes to the fallback model at once.
+
+    Args:
+    route (str): the route of the request
+    routes (dict): the model of each route; routes not listed use default_model
+    default_model (str): the model of unlisted routes
+    fallbacks (dict): the fallback model of each model, if any
+    override (str): the model the user pinned, defaults to None (routed)
+    wait_time (Callable[[str], float]): returns the seconds a request to a model would wait for its rate limits, defaults to None (not checked)
+    fallback_wait_seconds (float): the longest wait accepted before switching to the fallback model
+
+    Returns:
+    (model, fallback_model) (Tuple[str, Optional[str]]): the model and its fallback, or None if it has none
+    '''
+    if override:
+        return override, None
+    model = routes.get(route, default_model)
+    fallback_model = fallbacks.get(model)
+    if fallback_model is not None and wait_time is not None and wait_time(model) > fallback_wait_seconds and wait_time(fallback_model) <= fallback_wait_seconds:
+        return fallback_model, None
+    return model, fallback_model
+
+def get_model_price(model:str, prices:dict) -> Optional[Tuple[float, float]]:
+    '''
+    Returns the (prompt, completion) price in USD per million tokens of a model, also for dated model versions
+    (e.g. 'gpt-4o-2024-05-13' is priced as 'gpt-4o'), or None if unknown.
+    '''
+    for name in sorted(prices, key=len, reverse=True):
+        if model == name or model.startswith(name+'-2'):
+            return prices[name]
+    return None
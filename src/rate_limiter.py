@@ -0,0 +1,330 @@
+'''
+Client-side rate limiting and retry policy for the OpenAI API requests.
+Requests are paced per model against the requests and tokens per minute of the OpenAI account, instead of being sent
+as fast as they come, rejected with 429 errors and retried in lockstep. Waiting requests are granted in priority order,
+so interactive replies go before background work such as summaries. The limits are corrected from the rate limit
+headers of the responses, a 429 pauses the model for everyone until the time the API asks for, and only errors
+that can succeed on a retry are retried, after a jittered backoff.
+'''
+
+import asyncio, bisect, contextlib, itertools, random, re, time
+from typing import Optional
+
+import openai
+
+from shared_state import SharedState
+
+
+interactive_priority = 0  # requests a user is waiting for
+background_priority = 1  # requests whose result nobody is waiting for yet, e.g. conversation summaries
+
+_duration_part = re.compile(r'(\d+(?:\.\d+)?)(ms|s|m|h)')
+_duration_units = {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600}
+
+
+def parse_duration(text:str) -> Optional[float]:
+    '''
+    Parses a duration in the format of the x-ratelimit-reset-* headers, e.g. '20ms', '1.5s' or '6m0s', into seconds.
+    '''
+    parts = _duration_part.findall(text or '')
+    if not parts:
+        return None
+    return sum(float(value)*_duration_units[unit] for value, unit in parts)
+
+def is_retryable_error(error:Exception) -> bool:
+    '''
+    Returns True for the errors a retry can fix: rate limits (except an exhausted quota), timeouts, connection errors
+    and server errors. Other errors, e.g. invalid requests or authentication errors, would fail again and are not retried.
+    '''
+    if isinstance(error, openai.RateLimitError):
+        return getattr(error, 'code', None) != 'insufficient_quota'
+    return isinstance(error, (openai.APIConnectionError, openai.InternalServerError))
+
+def retry_after_seconds(error:Exception) -> Optional[float]:
+    '''
+    Returns the time the API asks to wait before retrying, from the headers of an error response, or None if it doesn't say.
+    '''
+    response = getattr(error, 'response', None)
+    if response is None:
+        return None
+    headers = response.headers
+    try:
+        if headers.get('retry-after-ms'):
+            return float(headers['retry-after-ms'])/1000
+        if headers.get('retry-after'):
+            return float(headers['retry-after'])
+    except ValueError:
+        pass
+    resets = [parse_duration(headers.get(name)) for name in ('x-ratelimit-reset-requests', 'x-ratelimit-reset-tokens')]
+    resets = [reset for reset in resets if reset is not None]
+    return max(resets) if resets else None
+
+def backoff_delay(attempt:int, base:float=1, cap:float=20) -> float:
+    '''
+    Returns a random delay before retry number attempt (0 for the first retry), up to base*2**attempt seconds and at most cap.
+    The randomness spreads the retries of requests that failed together, so they don't hit the API together again.
+    '''
+    return random.uniform(0, min(cap, base*2**attempt))
+
+
+class TokenBucket:
+    '''
+    Paces the use of a per-minute limit: the bucket refills continuously at limit/60 per second,
+    and holds at most burst_seconds worth of it. A limit of None means unlimited.
+
+    Args:
+    limit (float): the limit per minute, or None
+    burst_seconds (float): the seconds of refill the bucket can hold, i.e. how much can be used at once after idle time
+    '''
+    def __init__(self, limit:Optional[float], burst_seconds:float):
+        self.burst_seconds = burst_seconds
+        self.limit = None
+        self.level = 0.0
+        self._updated = time.monotonic()
+        self.set_limit(limit)
+
+    def set_limit(self, limit:Optional[float]) -> None:
+        if limit == self.limit:
+            return
+        full = self.limit is None
+        self.limit = limit
+        if limit is not None:
+            self.capacity = max(1.0, limit*self.burst_seconds/60)
+            self.level = self.capacity if full else min(self.level, self.capacity)
+
+    def _refill(self, now:float) -> None:
+        if self.limit is not None:
+            self.level = min(self.capacity, self.level+(now-self._updated)*self.limit/60)
+        self._updated = now
+
+    def wait_time(self, amount:float, now:float) -> float:
+        '''
+        Returns the seconds until amount can be taken, 0 if it can be taken now. Amounts above the capacity only need a full bucket.
+        '''
+        if self.limit is None:
+            return 0
+        self._refill(now)
+        missing = min(amount, self.capacity)-self.level
+        return 0 if missing <= 0 else missing*60/self.limit
+
+    def take(self, amount:float, now:float) -> None:
+        if self.limit is not None:
+            self._refill(now)
+            self.level -= min(amount, self.capacity)
+
+    def refund(self, amount:float, now:float) -> None:
+        if self.limit is not None:
+            self._refill(now)
+            self.level = min(self.capacity, self.level+amount)
+
+    def cap_level(self, remaining:float, now:float) -> None:
+        '''
+        Lowers the level to what the API reports as remaining, if that is less, e.g. because other clients share the account.
+        '''
+        if self.limit is not None:
+            self._refill(now)
+            self.level = min(self.level, remaining)
+
+
+class _ModelBudget:
+    def __init__(self, requests_per_minute:Optional[int], tokens_per_minute:Optional[int], burst_seconds:float):
+        self.requests = TokenBucket(requests_per_minute, burst_seconds)
+        self.tokens = TokenBucket(tokens_per_minute, burst_seconds)
+        self.paused_until = 0.0
+
+    def wait_time(self, tokens:int, now:float) -> float:
+        return max(self.paused_until-now, self.requests.wait_time(1, now), self.tokens.wait_time(tokens, now))
+
+
+class RateLimitTicket:
+    '''
+    A granted request slot. Set used_tokens to the actual token usage of the response, if known,
+    so the difference to the reserved tokens is given back to the budget.
+    '''
+    def __init__(self, model:str, reserved_tokens:int):
+        self.model = model
+        self.reserved_tokens = reserved_tokens
+        self.used_tokens = None
+
+
+class _Waiter:
+    def __init__(self, priority:int, sequence:int, model:str, tokens:int, future:asyncio.Future):
+        self.priority = priority
+        self.sequence = sequence
+        self.model = model
+        self.tokens = tokens
+        self.future = future
+
+    def __lt__(self, other:'_Waiter') -> bool:
+        return (self.priority, self.sequence) < (other.priority, other.sequence)
+
+
+class RateLimitGovernor:
+    '''
+    Grants OpenAI requests in priority order (then first come, first served), within a limit on the requests in flight
+    and within the requests and tokens per minute of each model. Models without configured limits are only limited
+    once the rate limit headers of their responses tell the limits.
+    With a shared state, the requests and tokens of each minute are also counted across all the worker processes,
+    and a request that would exceed the limits of the current minute waits for the next one.
+
+    Args:
+    requests_per_minute (dict): requests per minute by model name, defaults to None (learned from the headers)
+    tokens_per_minute (dict): tokens per minute by model name, defaults to None (learned from the headers)
+    max_in_flight (int): max number of requests in flight at once, defaults to 16; None for unlimited
+    burst_seconds (float): the seconds of the per-minute limits that can be used at once after idle time, defaults to 5
+    shared_state (SharedState): optional counters shared with the other worker processes, defaults to None
+    '''
+    def __init__(self, requests_per_minute:dict=None, tokens_per_minute:dict=None, max_in_flight:Optional[int]=16, burst_seconds:float=5, shared_state:SharedState=None):
+        self.requests_per_minute = dict(requests_per_minute or {})
+        self.tokens_per_minute = dict(tokens_per_minute or {})
+        self.max_in_flight = max_in_flight
+        self.burst_seconds = burst_seconds
+        self.shared_state = shared_state
+        self.in_flight = 0
+        self._budgets = {}
+        self._waiters = []  # sorted by priority, then arrival
+        self._sequence = itertools.count()
+        self._timer = None
+
+    def _budget(self, model:str) -> _ModelBudget:
+        budget = self._budgets.get(model)
+        if budget is None:
+            budget = self._budgets[model] = _ModelBudget(self.requests_per_minute.get(model), self.tokens_per_minute.get(model), self.burst_seconds)
+        return budget
+
+    def pending(self) -> int:
+        '''
+        Returns the number of requests waiting to be granted.
+        '''
+        return sum(1 for waiter in self._waiters if not waiter.future.done())
+
+    def wait_time(self, model:str, tokens:int=0) -> float:
+        '''
+        Returns the seconds a request to the model, reserving the given number of tokens, would wait for the model's rate limits
+        (not counting the requests already waiting or the limit on requests in flight).
+        '''
+        return self._budget(model).wait_time(tokens, time.monotonic())
+
+    def _grant(self) -> None:
+        # grants the waiters that fit, in priority order; a model's waiters can't overtake its first blocked waiter
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        now = time.monotonic()
+        blocked_models = set()
+        next_check = None
+        still_waiting = []
+        for waiter in self._waiters:
+            if waiter.future.done():
+                continue  # cancelled while waiting
+            if (self.max_in_flight is not None and self.in_flight >= self.max_in_flight) or waiter.model in blocked_models:
+                still_waiting.append(waiter)
+                continue
+            budget = self._budget(waiter.model)
+            delay = budget.wait_time(waiter.tokens, now)
+            if delay > 0:
+                blocked_models.add(waiter.model)
+                still_waiting.append(waiter)
+                next_check = delay if next_check is None else min(next_check, delay)
+                continue
+            budget.requests.take(1, now)
+            budget.tokens.take(waiter.tokens, now)
+            self.in_flight += 1
+            waiter.future.set_result(None)
+        self._waiters = still_waiting
+        if next_check is not None:
+            self._timer = asyncio.get_running_loop().call_later(next_check, self._grant)
+
+    async def acquire(self, model:str, tokens:int=0, priority:int=interactive_priority) -> RateLimitTicket:
+        '''
+        Waits until a request to the model, reserving the given number of tokens, may be sent, and returns its ticket.
+        The ticket must be given back with release() when the response has been received.
+        '''
+        future = asyncio.get_running_loop().create_future()
+        bisect.insort(self._waiters, _Waiter(priority, next(self._sequence), model, tokens, future))
+        self._grant()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self._release_slot()
+            raise
+        ticket = RateLimitTicket(model, tokens)
+        if self.shared_state is not None:
+            try:
+                await self._reserve_shared(model, tokens)
+            except BaseException:
+                self.release(ticket)
+                raise
+        return ticket
+
+    async def _reserve_shared(self, model:str, tokens:int) -> None:
+        requests_per_minute = self._budget(model).requests.limit
+        tokens_per_minute = self._budget(model).tokens.limit
+        while True:
+            minute = int(time.time()//60)
+            n_requests = await self.shared_state.incr(f'requests:{model}:{minute}', 1, ttl=120)
+            n_tokens = await self.shared_state.incr(f'tokens:{model}:{minute}', tokens, ttl=120)
+            over_requests = requests_per_minute is not None and n_requests > requests_per_minute
+            # a request larger than the whole minute's budget is let through in an otherwise unused minute
+            over_tokens = tokens_per_minute is not None and n_tokens > tokens_per_minute and n_tokens > tokens
+            if not (over_requests or over_tokens):
+                return
+            await asyncio.sleep((minute+1)*60-time.time()+random.uniform(0, 1))
+
+    def _release_slot(self) -> None:
+        self.in_flight -= 1
+        self._grant()
+
+    def release(self, ticket:RateLimitTicket) -> None:
+        '''
+        Gives back a ticket's slot, and the reserved tokens the response didn't use.
+        '''
+        if ticket.used_tokens is not None and ticket.used_tokens < ticket.reserved_tokens:
+            self._budget(ticket.model).tokens.refund(ticket.reserved_tokens-ticket.used_tokens, time.monotonic())
+        self._release_slot()
+
+    @contextlib.asynccontextmanager
+    async def request(self, model:str, tokens:int=0, priority:int=interactive_priority):
+        '''
+        Context manager form of acquire and release: async with governor.request(model, tokens) as ticket: ...
+        '''
+        ticket = await self.acquire(model, tokens, priority)
+        try:
+            yield ticket
+        finally:
+            self.release(ticket)
+
+    def update_from_headers(self, model:str, headers) -> None:
+        '''
+        Updates a model's limits and remaining budget from the x-ratelimit-* headers of an API response.
+        When the API reports nothing remaining, the model is paused until the reported reset time.
+        '''
+        now = time.monotonic()
+        budget = self._budget(model)
+        for kind, bucket in (('requests', budget.requests), ('tokens', budget.tokens)):
+            try:
+                limit = headers.get(f'x-ratelimit-limit-{kind}')
+                remaining = headers.get(f'x-ratelimit-remaining-{kind}')
+                if limit is not None:
+                    bucket.set_limit(float(limit))
+                if remaining is not None:
+                    bucket.cap_level(float(remaining), now)
+                    if float(remaining) <= 0:
+                        reset = parse_duration(headers.get(f'x-ratelimit-reset-{kind}'))
+                        if reset:
+                            budget.paused_until = max(budget.paused_until, now+reset)
+            except ValueError:
+                continue
+        self._grant()
+
+    def pause(self, model:str, seconds:float) -> None:
+        '''
+        Stops granting requests to a model for the given seconds, e.g. after a 429 response, and empties its request bucket
+        so the requests resume gradually afterwards.
+        '''
+        now = time.monotonic()
+        budget = self._budget(model)
+        budget.paused_until = max(budget.paused_until, now+seconds)
+        budget.requests.cap_level(0, now)
+        self._grant()
@@ -0,0 +1,105 @@
+'''
+Cache of GPT responses for identical requests, e.g. FAQ-style questions or the same document or photo forwarded again.
+A request is identified by a hash of its normalized message list, model and temperature. Images are identified by
+the ID a content_id function finds for their URL (e.g. the file_unique_id of a cached photo) rather than by their
+(expiring) download URL, and by a hash of the URL otherwise.
+'''
+
+import hashlib, json, re, time
+from collections import OrderedDict
+from typing import Callable, Optional
+
+
+long_text_length = 1024  # text parts longer than this are replaced by their hash in the cache key, to keep keys small
+
+_whitespace = re.compile(r'\s+')
+
+
+def hash_text(text:str) -> str:
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+class ResponseCache:
+    '''
+    A size-bounded LRU cache of GPT responses with a time-to-live, and hit/miss counters.
+    Requests with a temperature above max_temperature bypass the cache, since their responses are meant to vary.
+
+    Args:
+    max_entries (int): max number of cached responses, the least recently used are evicted first
+    ttl (float): seconds a cached response stays valid
+    max_temperature (float): the highest temperature whose responses are cached
+    content_id (Callable[[str], Optional[str]]): optional function returning the content ID of an image URL, or None if it has none,
+        e.g. of the cached photos, whose data URLs are then not kept by this cache, defaults to None
+    '''
+    def __init__(self, max_entries:int=1000, ttl:float=3600, max_temperature:float=0.7, content_id:Callable[[str], Optional[str]]=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_temperature = max_temperature
+        self.content_id = content_id
+        self.hits = 0
+        self.misses = 0
+        self.bypassed = 0
+        self._entries = OrderedDict()  # key -> (expiry time, response)
+
+    def _normalize_text(self, text:str) -> str:
+        text = _whitespace.sub(' ', text).strip()
+        return 'sha256:'+hash_text(text) if len(text) > long_text_length else text
+
+    def _normalize_message(self, message:dict) -> list:
+        content = message.get('content') or ''
+        if isinstance(content, str):
+            return [message.get('role'), self._normalize_text(content)]
+        parts = []
+        for part in content:
+            if part.get('type') == 'text':
+                parts.append(self._normalize_text(part.get('text') or ''))
+            elif part.get('type') == 'image_url':
+                url = part['image_url'].get('url', '')
+                content_hash = (self.content_id and self.content_id(url)) or hash_text(url)
+                parts.append(['image', content_hash, part['image_url'].get('detail', 'auto')])
+            else:
+                parts.append(part)
+        return [message.get('role'), parts]
+
+    def make_key(self, messages:list, model:str, temperature:float) -> Optional[str]:
+        '''
+        Returns the cache key of a request, or None if the request bypasses the cache because of its temperature.
+        '''
+        if temperature > self.max_temperature:
+            self.bypassed += 1
+            return None
+        normalized = [model, temperature, [self._normalize_message(message) for message in messages]]
+        return hash_text(json.dumps(normalized, ensure_ascii=False, separators=(',', ':')))
+
+    def get(self, key:Optional[str]) -> Optional[str]:
+        '''
+        Returns the cached response for a key, or None on a miss. Expired responses are dropped.
+        '''
+        if key is None:
+            return None
+        entry = self._entries.get(key)
+        if entry is None or entry[0] <= time.time():
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key:Optional[str], response:str) -> None:
+        '''
+        Caches a response for a key, evicting the least recently used responses beyond max_entries.
+        '''
+        if key is None:
+            return
+        self._entries[key] = (time.time()+self.ttl, response)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        '''
+        Returns the hit, miss and bypass counters and the number of cached responses.
+        '''
+        return {'hits': self.hits, 'misses': self.misses, 'bypassed': self.bypassed, 'entries': len(self._entries)}
@@ -0,0 +1,99 @@
+'''
+Job scheduling for the chatbot's handlers.
+Each user's messages are processed one at a time, in the order they arrived, while different users are processed in parallel.
+Queues are bounded, so a flood of messages is rejected instead of growing memory without limit,
+and CPU or blocking IO work is offloaded to a shared pool of worker threads or processes.
+'''
+
+import asyncio, logging
+from collections import deque
+from concurrent.futures import Executor, ThreadPoolExecutor, ProcessPoolExecutor
+from typing import Awaitable, Callable
+
+from metrics import log_event
+
+
+class ChatJobScheduler:
+    '''
+    Runs async jobs in a FIFO queue per user, with one worker task per user that has pending jobs.
+    A user's worker task is started on their first job and ends as soon as their queue is empty,
+    so idle users take no memory.
+
+    Args:
+    max_pending_per_user (int): max number of queued or running jobs of a single user
+    max_pending_total (int): max number of queued or running jobs of all users together
+    media_workers (int): number of workers in the pool used by run_in_executor
+    use_processes (bool): use a process pool instead of a thread pool for run_in_executor, for CPU-bound work
+    '''
+    def __init__(self, max_pending_per_user:int=5, max_pending_total:int=1000, media_workers:int=4, use_processes:bool=False):
+        self.max_pending_per_user = max_pending_per_user
+        self.max_pending_total = max_pending_total
+        self.executor: Executor = ProcessPoolExecutor(media_workers) if use_processes else ThreadPoolExecutor(media_workers, thread_name_prefix='media')
+        self.n_pending = 0
+        self._queues = {}
+        self._workers = {}
+
+    def pending_for(self, user_id:str) -> int:
+        '''
+        Returns the number of queued or running jobs of a user.
+        '''
+        queue = self._queues.get(user_id)
+        return 0 if queue is None else queue.n_pending
+
+    def submit(self, user_id:str, job:Callable[[], Awaitable]) -> bool:
+        '''
+        Queues a job for a user. The job is a function returning an awaitable, called when the user's previous jobs are done.
+
+        Args:
+        user_id (str): the user the job belongs to; jobs of the same user never run concurrently
+        job (Callable[[], Awaitable]): the job to run
+
+        Returns:
+        accepted (bool): False if the job was rejected because the user's queue or the global queue is full
+        '''
+        if self.n_pending >= self.max_pending_total or self.pending_for(user_id) >= self.max_pending_per_user:
+            return False
+        queue = self._queues.get(user_id)
+        if queue is None:
+            queue = self._queues[user_id] = _UserQueue()
+        queue.jobs.append(job)
+        queue.n_pending += 1
+        self.n_pending += 1
+        if user_id not in self._workers:
+            self._workers[user_id] = asyncio.create_task(self._run_user_jobs(user_id, queue))
+        return True
+
+    async def _run_user_jobs(self, user_id:str, queue:'_UserQueue'):
+        while queue.jobs:
+            job = queue.jobs.popleft()
+            try:
+                await job()
+            except Exception as e:
+                log_event('error in job', level=logging.ERROR, exc_info=e, user_id=user_id, error_type=type(e).__name__, error=str(e))
+            finally:
+                queue.n_pending -= 1
+                self.n_pending -= 1
+        # no await between the empty check and the cleanup, so a job submitted meanwhile can't be lost
+        del self._queues[user_id]
+        del self._workers[user_id]
+
+    async def run_in_executor(self, func:Callable, *args):
+        '''
+        Runs a blocking function in the media worker pool and awaits its result.
+        With a process pool, the function and its arguments must be picklable (e.g. a module-level function).
+        '''
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    async def shutdown(self):
+        '''
+        Waits for the running user queues to finish and shuts the worker pool down.
+        '''
+        if self._workers:
+            await asyncio.gather(*self._workers.values(), return_exceptions=True)
+        self.executor.shutdown(wait=True)
+
+
+class _UserQueue:
+    def __init__(self):
+        self.jobs = deque()
+        self.n_pending = 0
@@ -0,0 +1,214 @@
+'''
+Scale-out mode for the chatbot: chats are sharded by user ID across several worker processes, or across several bot nodes.
+A front webhook server receives all updates from Telegram and routes each one to the shard of its user,
+so a user's updates are always handled by the same worker, in order, while different users are handled in parallel.
+The workers share the conversation store and the counters of a SharedState, both backed by files in the files directory.
+'''
+
+import asyncio, hmac, logging, multiprocessing, os, signal
+from typing import Optional
+
+import aiohttp
+from aiohttp import web
+
+from webhook_server import secret_token_header, max_update_size
+from metrics import add_metrics_route, setup_json_logging, log_event
+
+
+def shard_for_user(user_id:int, n_shards:int) -> int:
+    '''
+    Returns the shard index of a user. The mapping is stable across restarts and processes.
+    '''
+    return int(user_id) % n_shards
+
+def get_update_user_id(data:dict) -> Optional[int]:
+    '''
+    Returns the ID of the user who caused a raw Telegram update (a JSON dict), or of its chat, or None if it has neither.
+    '''
+    for value in data.values():
+        if not isinstance(value, dict):
+            continue
+        user = value.get('from') or value.get('user')
+        if isinstance(user, dict) and 'id' in user:
+            return user['id']
+        chat = value.get('chat')
+        if isinstance(chat, dict) and 'id' in chat:
+            return chat['id']
+    return None
+
+
+def run_shard_worker(shard_index:int, updates:multiprocessing.Queue, telegram_token:str, openai_key:str, shared_state_path:str, param_overrides:dict=None, base_urls:dict=None) -> None:
+    '''
+    The entry point of a worker process: builds the bot application and processes the raw updates received on the queue,
+    until None is received.
+
+    Args:
+    shard_index (int): the index of the worker's shard, for logging
+    updates (multiprocessing.Queue): the queue of raw updates (JSON dicts) routed to this worker
+    telegram_token (str): the Telegram API token
+    openai_key (str): the OpenAI API key
+    shared_state_path (str): the path of the SQLite file backing the shared counters
+    param_overrides (dict): optional chatbot parameters to override in the worker, by name, defaults to None
+    base_urls (dict): optional 'telegram_base_url' and 'openai_base_url' arguments for build_application, defaults to None
+    '''
+    import chatbot  # imported in the worker process, chatbot imports this module
+    from shared_state import SQLiteSharedState
+    from telegram import Update
+
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # the front process stops the workers through the queue
+    for name, value in (param_overrides or {}).items():
+        setattr(chatbot, name, value)
+    setup_json_logging()
+    # each worker serves its own metrics, on the port after the previous worker's
+    metrics_port = None if chatbot.metrics_port is None else chatbot.metrics_port+1+shard_index
+
+    # each worker keeps its own /batch jobs, which belong to the users of its shard
+    batch_store_path, extension = os.path.splitext(os.path.join(os.path.dirname(os.path.realpath(chatbot.__file__)), chatbot.batch_store_file))
+    batch_store_path = f'{batch_store_path}.{shard_index}{extension}'
+
+    async def process_updates():
+        application = chatbot.build_application(telegram_token, openai_key, shared_state=SQLiteSharedState(shared_state_path), metrics_port=metrics_port,
+                                                batch_store_path=batch_store_path, **(base_urls or {}))
+        await application.initialize()
+        await application.post_init(application)
+        await application.start()
+        print(f'shard worker {shard_index} started')
+        loop = asyncio.get_running_loop()
+        while True:
+            data = await loop.run_in_executor(None, updates.get)
+            if data is None:
+                break
+            try:
+                await application.update_queue.put(Update.de_json(data, application.bot))
+            except Exception as e:
+                log_event('invalid update received by shard worker', level=logging.WARNING, shard=shard_index, error_type=type(e).__name__, error=str(e))
+        await application.stop()
+        await application.post_stop(application)
+        await application.shutdown()
+        await application.post_shutdown(application)
+        print(f'shard worker {shard_index} stopped')
+
+    asyncio.run(process_updates())
+
+
+class ShardRouter:
+    '''
+    Routes raw updates to shards: local worker processes, started by start(), or remote bot nodes given by their webhook URLs.
+    Remote nodes must run in webhook mode with the same secret token and register_webhook disabled.
+
+    Args:
+    n_workers (int): the number of local worker processes, used if node_urls is empty
+    node_urls (list): the webhook URLs of remote bot nodes, defaults to None
+    '''
+    def __init__(self, n_workers:int, node_urls:list=None):
+        self.node_urls = list(node_urls or [])
+        self.n_shards = len(self.node_urls) or n_workers
+        self.queues = []
+        self.processes = []
+        self._session = None
+
+    def start(self, telegram_token:str, openai_key:str, shared_state_path:str, param_overrides:dict=None, base_urls:dict=None) -> None:
+        '''
+        Starts the local worker processes, unless routing to remote nodes.
+        '''
+        if self.node_urls:
+            return
+        context = multiprocessing.get_context('spawn')
+        for shard_index in range(self.n_shards):
+            queue = context.Queue()
+            process = context.Process(target=run_shard_worker, args=(shard_index, queue, telegram_token, openai_key, shared_state_path, param_overrides, base_urls), daemon=True)
+            process.start()
+            self.queues.append(queue)
+            self.processes.append(process)
+
+    async def route(self, data:dict, secret_token:str) -> bool:
+        '''
+        Sends a raw update to the shard of its user. Updates without a user go to shard 0.
+
+        Returns:
+        delivered (bool): False if a remote node could not be reached, so Telegram should retry
+        '''
+        user_id = get_update_user_id(data)
+        shard_index = 0 if user_id is None else shard_for_user(user_id, self.n_shards)
+        if not self.node_urls:
+            self.queues[shard_index].put(data)
+            return True
+        if self._session is None:
+            self._session = aiohttp.ClientSession()
+        try:
+            async with self._session.post(self.node_urls[shard_index], json=data, headers={secret_token_header: secret_token}) as response:
+                return response.status == 200
+        except aiohttp.ClientError as e:
+            log_event('error forwarding update to node', level=logging.ERROR, shard=shard_index, error_type=type(e).__name__, error=str(e))
+            return False
+
+    async def stop(self) -> None:
+        '''
+        Stops the local worker processes after they have processed their queued updates.
+        '''
+        for queue in self.queues:
+            queue.put(None)
+        loop = asyncio.get_running_loop()
+        for process in self.processes:
+            await loop.run_in_executor(None, process.join)
+        if self._session is not None:
+            await self._session.close()
+
+
+def create_router_app(router:ShardRouter, secret_token:str, path:str) -> web.Application:
+    '''
+    Creates the aiohttp app of the front webhook server, which checks the secret token and routes each update to its shard.
+    The /metrics endpoint of the front server has the metrics of the front process only; each worker serves its own.
+    '''
+    async def receive_update(request: web.Request) -> web.Response:
+        if not hmac.compare_digest(request.headers.get(secret_token_header, '').encode('utf-8'), secret_token.encode('utf-8')):
+            return web.Response(status=403)
+        try:
+            data = await request.json()
+        except Exception:
+            return web.Response(status=400)
+        if not isinstance(data, dict):
+            return web.Response(status=400)
+        delivered = await router.route(data, secret_token)
+        return web.Response(status=200 if delivered else 502)
+
+    async def health(request: web.Request) -> web.Response:
+        return web.Response(text='ok')
+
+    app = web.Application(client_max_size=max_update_size)
+    app.router.add_post(path, receive_update)
+    app.router.add_get('/healthz', health)
+    add_metrics_route(app)
+    return app
+
+async def run_sharded_webhook_server(router:ShardRouter, telegram_token:str, openai_key:str, shared_state_path:str, webhook_url:str, secret_token:str, listen:str, port:int, path:str, register:bool=True, stop_event:asyncio.Event=None) -> None:
+    '''
+    Runs the front webhook server and the shards until SIGINT or SIGTERM is received (or stop_event is set).
+    Arguments are as for webhook_server.run_webhook_server, plus the router and what the workers need to build their applications.
+    '''
+    from telegram import Bot, Update
+
+    if register and not webhook_url:
+        raise ValueError('webhook_url must be set to run in webhook mode')
+    stop_event = stop_event or asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except (NotImplementedError, RuntimeError):
+            pass
+
+    router.start(telegram_token, openai_key, shared_state_path)
+    runner = web.AppRunner(create_router_app(router, secret_token, path), access_log=None)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, listen, port).start()
+        print(f'sharded webhook server listening on {runner.addresses} at {path}, routing to {router.n_shards} shards')
+        if register:
+            async with Bot(telegram_token) as bot:
+                await bot.set_webhook(url=webhook_url, secret_token=secret_token, allowed_updates=Update.ALL_TYPES)
+            print(f'webhook set to {webhook_url}')
+        await stop_event.wait()
+    finally:
+        await runner.cleanup()
+        await router.stop()
@@ -0,0 +1,111 @@
+'''
+Counters shared by all the processes of a sharded chatbot deployment, e.g. request and token counts per minute for rate limiting.
+SharedState is the interface; SQLiteSharedState shares the counters between processes on one machine through a database file,
+and InMemorySharedState is a stand-in for a single process (or for tests), with the same semantics as the Redis INCRBY/EXPIRE pattern.
+'''
+
+import asyncio, sqlite3, threading, time
+from concurrent.futures import ThreadPoolExecutor
+
+
+prune_every = 1000  # expired counters are deleted once every this many increments
+
+
+class SharedState:
+    '''
+    Interface of a store of integer counters with expiry, shared between processes.
+    '''
+    async def incr(self, key:str, amount:int=1, ttl:float=None) -> int:
+        '''
+        Adds amount to a counter, creating it at 0 if it doesn't exist or has expired, and returns the new value.
+        If ttl is given and the counter is created, it expires ttl seconds later.
+        '''
+        raise NotImplementedError
+
+    async def get(self, key:str) -> int:
+        '''
+        Returns the value of a counter, 0 if it doesn't exist or has expired.
+        '''
+        raise NotImplementedError
+
+    async def close(self) -> None:
+        pass
+
+
+class InMemorySharedState(SharedState):
+    '''
+    Counters kept in the memory of the current process.
+    '''
+    def __init__(self):
+        self._values = {}
+        self._lock = threading.Lock()
+        self._n_incr = 0
+
+    async def incr(self, key:str, amount:int=1, ttl:float=None) -> int:
+        now = time.time()
+        with self._lock:
+            self._n_incr += 1
+            if self._n_incr % prune_every == 0:
+                self._values = {k: v for k, v in self._values.items() if v[1] is None or v[1] > now}
+            value, expires = self._values.get(key, (0, None))
+            if key not in self._values or (expires is not None and expires <= now):
+                value, expires = 0, (None if ttl is None else now+ttl)
+            value += amount
+            self._values[key] = (value, expires)
+            return value
+
+    async def get(self, key:str) -> int:
+        with self._lock:
+            value, expires = self._values.get(key, (0, None))
+            if expires is not None and expires <= time.time():
+                return 0
+            return value
+
+
+class SQLiteSharedState(SharedState):
+    '''
+    Counters kept in an SQLite database file, shared by all processes that open the same file.
+    Each update is one short write transaction, run in a background thread so the event loop is not blocked.
+
+    Args:
+    filename (str): the path of the database file, created if it doesn't exist
+    '''
+    def __init__(self, filename:str):
+        self.filename = filename
+        self.connection = sqlite3.connect(filename, timeout=30, check_same_thread=False, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS counters (key TEXT PRIMARY KEY, value INTEGER NOT NULL, expires REAL)')
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='shared-state')
+        self._n_incr = 0
+
+    def _incr(self, key:str, amount:int, ttl:float) -> int:
+        now = time.time()
+        self._n_incr += 1
+        self.connection.execute('BEGIN IMMEDIATE')
+        try:
+            if self._n_incr % prune_every == 0:
+                self.connection.execute('DELETE FROM counters WHERE expires IS NOT NULL AND expires <= ?', (now,))
+            else:
+                self.connection.execute('DELETE FROM counters WHERE key = ? AND expires IS NOT NULL AND expires <= ?', (key, now))
+            self.connection.execute('INSERT OR IGNORE INTO counters (key, value, expires) VALUES (?, 0, ?)', (key, None if ttl is None else now+ttl))
+            self.connection.execute('UPDATE counters SET value = value + ? WHERE key = ?', (amount, key))
+            value = self.connection.execute('SELECT value FROM counters WHERE key = ?', (key,)).fetchone()[0]
+            self.connection.execute('COMMIT')
+        except Exception:
+            self.connection.execute('ROLLBACK')
+            raise
+        return value
+
+    def _get(self, key:str) -> int:
+        row = self.connection.execute('SELECT value FROM counters WHERE key = ? AND (expires IS NULL OR expires > ?)', (key, time.time())).fetchone()
+        return 0 if row is None else row[0]
+
+    async def incr(self, key:str, amount:int=1, ttl:float=None) -> int:
+        return await asyncio.get_running_loop().run_in_executor(self._executor, self._incr, key, amount, ttl)
+
+    async def get(self, key:str) -> int:
+        return await asyncio.get_running_loop().run_in_executor(self._executor, self._get, key)
+
+    async def close(self) -> None:
+        await asyncio.get_running_loop().run_in_executor(self._executor, self.connection.close)
+        self._executor.shutdown(wait=True)
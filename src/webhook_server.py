@@ -0,0 +1,112 @@
+'''
+Webhook mode for the chatbot, as an alternative to polling.
+An aiohttp server receives the updates that Telegram pushes to the webhook URL, checks the secret token sent with them,
+and hands them to the bot application's update queue. The server answers Telegram as soon as the update is queued.
+A single instance must receive all the updates of a user, since it keeps their conversation in memory;
+to scale out, route the updates by user ID with the sharding front in sharding.py.
+'''
+
+import asyncio, hmac, logging, signal
+from aiohttp import web
+from telegram import Update
+from telegram.ext import Application
+from metrics import add_metrics_route, log_event
+
+
+secret_token_header = 'X-Telegram-Bot-Api-Secret-Token'
+max_update_size = 1024*1024  # updates are small JSON documents; larger requests are rejected
+
+
+def create_webhook_app(application: Application, secret_token: str, path: str) -> web.Application:
+    '''
+    Creates the aiohttp app that receives the updates on the given path, plus a /healthz endpoint for load balancer checks
+    and a /metrics endpoint for Prometheus.
+
+    Args:
+    application (Application): the Telegram bot application, whose update queue receives the updates
+    secret_token (str): the secret token Telegram was given when the webhook was set
+    path (str): the URL path that receives the updates
+
+    Returns:
+    app (web.Application): the aiohttp app
+    '''
+    async def receive_update(request: web.Request) -> web.Response:
+        # compared as bytes, since compare_digest raises TypeError on non-ASCII strings
+        if not hmac.compare_digest(request.headers.get(secret_token_header, '').encode('utf-8'), secret_token.encode('utf-8')):
+            return web.Response(status=403)
+        try:
+            data = await request.json()
+            update = Update.de_json(data, application.bot)
+        except Exception as e:
+            log_event('invalid update received on webhook', level=logging.WARNING, error_type=type(e).__name__, error=str(e))
+            return web.Response(status=400)
+        await application.update_queue.put(update)
+        return web.Response()
+
+    async def health(request: web.Request) -> web.Response:
+        return web.Response(text='ok')
+
+    app = web.Application(client_max_size=max_update_size)
+    app.router.add_post(path, receive_update)
+    app.router.add_get('/healthz', health)
+    add_metrics_route(app)
+    return app
+
+async def start_webhook_server(application: Application, secret_token: str, listen: str, port: int, path: str) -> web.AppRunner:
+    '''
+    Starts the webhook HTTP server. The application must already be initialized and started.
+
+    Returns:
+    runner (web.AppRunner): the server runner; its addresses attribute holds the bound addresses, and cleanup() stops it
+    '''
+    runner = web.AppRunner(create_webhook_app(application, secret_token, path), access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, listen, port)
+    await site.start()
+    print(f'webhook server listening on {runner.addresses} at {path}')
+    return runner
+
+async def run_webhook_server(application: Application, webhook_url: str, secret_token: str, listen: str, port: int, path: str, register: bool=True, stop_event: asyncio.Event=None) -> None:
+    '''
+    Runs the bot in webhook mode until SIGINT or SIGTERM is received (or stop_event is set), with the same application lifecycle as polling.
+
+    Args:
+    application (Application): the Telegram bot application
+    webhook_url (str): the public HTTPS URL that Telegram sends updates to
+    secret_token (str): the secret token Telegram sends with each update
+    listen (str): the interface to listen on
+    port (int): the port to listen on
+    path (str): the URL path that receives the updates
+    register (bool): set the webhook with Telegram on startup, defaults to True
+    stop_event (asyncio.Event): optional event that stops the server when set, defaults to None
+    '''
+    if register and not webhook_url:
+        raise ValueError('webhook_url must be set to run in webhook mode')
+    stop_event = stop_event or asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except (NotImplementedError, RuntimeError):
+            pass  # not supported on Windows, Ctrl+C raises KeyboardInterrupt instead
+
+    await application.initialize()
+    if application.post_init is not None:
+        await application.post_init(application)
+    await application.start()
+    runner = None
+    try:
+        if register:
+            await application.bot.set_webhook(url=webhook_url, secret_token=secret_token, allowed_updates=Update.ALL_TYPES)
+            print(f'webhook set to {webhook_url}')
+        runner = await start_webhook_server(application, secret_token, listen, port, path)
+        await stop_event.wait()
+    finally:
+        if runner is not None:
+            await runner.cleanup()
+        await application.stop()
+        if application.post_stop is not None:
+            await application.post_stop(application)
+        await application.shutdown()
+        if application.post_shutdown is not None:
+            await application.post_shutdown(application)
@@ -0,0 +1,35 @@
+'''
+Tests of the Markdown repair of delivery.py.
+
+Usage:
+python -m pytest tests
+'''
+
+import os, sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'src'))
+
+from delivery import repair_markdown, split_message
+
+
+def test_mid_line_fence():
+    text = 'Use `a_b` and ```python\nx=1\n```'
+    assert repair_markdown(text) == text
+
+def test_mid_line_fence_left_open():
+    assert repair_markdown('Run this: ```python\nx = a_b*2') == 'Run this: ```python\nx = a_b*2\n```'
+
+def test_one_line_fence():
+    assert repair_markdown('Run ```ls -l``` then `cd a_b`') == 'Run ```ls -l``` then `cd a_b`'
+
+def test_dunder_names():
+    assert repair_markdown('Override __init__ and read obj.__dict__') == 'Override \\_\\_init\\_\\_ and read obj.\\_\\_dict\\_\\_'
+
+def test_dunder_names_next_to_italics():
+    assert repair_markdown('_Note_: __init__ runs first') == '_Note_: \\_\\_init\\_\\_ runs first'
+
+def test_split_keeps_mid_line_fence():
+    text = 'intro '*10+'```\n'+'line\n'*20+'```'
+    parts = split_message(text, limit=80)
+    assert parts[0] == 'intro '*9+'intro'
+    assert all(part.startswith('```\n') and part.endswith('\n```') and len(part) <= 80 for part in parts[1:])